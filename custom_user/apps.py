@@ -1,5 +1,21 @@
 from django.apps import AppConfig
+from django.core import checks
+from django.db.models.signals import (
+    post_delete,
+    post_save,
+)
 
 
 class CustomUserConfig(AppConfig):
     name = 'custom_user'
+
+    def ready(self):
+        from custom_user.backends import (
+            check_user_cache,
+            invalidate_cached_user,
+        )
+
+        checks.register(check_user_cache)
+        User = self.get_model('User')
+        post_save.connect(invalidate_cached_user, sender=User)
+        post_delete.connect(invalidate_cached_user, sender=User)
@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.contrib.auth.backends import AllowAllUsersModelBackend
+from django.core import checks
+from django.core.cache import cache
+
+
+USER_CACHE_KEY = 'user:{}'
+CACHED_USER_BACKEND = 'custom_user.backends.CachedUserBackend'
+# Caches that are not shared by the processes of a deployment.
+PROCESS_LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+class CachedUserBackend(AllowAllUsersModelBackend):
+    """
+        Caches the user object that AuthenticationMiddleware loads on every
+        request, saving a query on User per request. The cached user is
+        removed whenever the user is saved or deleted, Eg: on a password
+        change, which also ends the user's other sessions.
+        Only the cache of the process that saved the user is invalidated,
+        so the 'default' cache must be shared by all processes. Enabled
+        with USER_CACHE_ENABLED. See check_user_cache
+    """
+
+    def get_user(self, user_id):
+        key = USER_CACHE_KEY.format(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super(CachedUserBackend, self).get_user(user_id)
+            if user is not None:
+                cache.set(key, user, settings.USER_CACHE_TIMEOUT)
+        return user
+
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    cache.delete(USER_CACHE_KEY.format(instance.pk))
+
+
+def check_user_cache(app_configs, **kwargs):
+    """
+        CachedUserBackend needs a 'default' cache shared by all processes.
+        With a per process cache, other workers would keep serving a
+        deactivated user, or an old password hash, until it expires.
+    """
+
+    if CACHED_USER_BACKEND not in settings.AUTHENTICATION_BACKENDS:
+        return []
+    if settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHE_BACKENDS:
+        return []
+    return [checks.Error(
+        'CachedUserBackend requires a cache shared by all processes.',
+        hint='Set CACHE_URL, Eg: to a Redis or Memcached cache, or disable USER_CACHE_ENABLED.',
+        id='custom_user.E001',
+    )]
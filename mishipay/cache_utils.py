@@ -0,0 +1,65 @@
+import time
+from django.conf import settings
+from django.core.cache import caches
+
+
+PRODUCT_CACHE_KEY = 'shopify:product:{}'
+
+
+def get_cache():
+    """
+        Returns the cache Shopify data is kept in, SHOPIFY_CACHE_ALIAS.
+    """
+
+    return caches[settings.SHOPIFY_CACHE_ALIAS]
+
+
+def get_cached_products(ids):
+    """
+        Returns a tuple where first item is the list of cached products
+        with the given ids, the second item is the list of ids that were
+        not found in the cache and the third item is the list of ids of
+        cached products older than SHOPIFY_PRODUCT_CACHE_TIMEOUT, which
+        are stale and should be refreshed.
+    """
+
+    keys = {PRODUCT_CACHE_KEY.format(_id): str(_id) for _id in ids}
+    cached = get_cache().get_many(keys.keys())
+    fresh_after = time.time() - settings.SHOPIFY_PRODUCT_CACHE_TIMEOUT
+
+    products = []
+    missing_ids = []
+    stale_ids = []
+    for key, _id in keys.items():
+        # Entries cached before they carried the time they were
+        # cached at are treated as missing.
+        if not isinstance(cached.get(key), tuple):
+            missing_ids.append(_id)
+            continue
+        cached_at, product = cached[key]
+        products.append(product)
+        if cached_at < fresh_after:
+            stale_ids.append(_id)
+    return products, missing_ids, stale_ids
+
+
+def cache_products(products):
+    """
+        Cache products by id, along with the time they were cached at.
+        Products are expected to be already trimmed by
+        filter_relevant_product_information.
+    """
+
+    cached_at = time.time()
+    get_cache().set_many(
+        {PRODUCT_CACHE_KEY.format(product['id']): (cached_at, product) for product in products},
+        settings.SHOPIFY_PRODUCT_STALE_TIMEOUT
+    )
+
+
+def invalidate_products(product_ids):
+    """
+        Remove products from the cache.
+    """
+
+    get_cache().delete_many([PRODUCT_CACHE_KEY.format(product_id) for product_id in product_ids])
@@ -0,0 +1,302 @@
+import sqlite3
+from django.db import (
+    IntegrityError,
+    connection,
+    transaction,
+)
+from django.db.models import (
+    Case,
+    F,
+    IntegerField,
+    Value,
+    When,
+)
+from django.utils import timezone
+from mishipay.catalog import get_product_fields
+from mishipay.models import (
+    CartItem,
+    Product,
+)
+from mishipay.shopify_utils import get_products
+
+
+SNAPSHOT_FIELDS = ('product_title', 'price', 'variant_id', 'inventory_item_id')
+
+PRODUCT_DOES_NOT_EXIST_MSG = 'Product does not exist'
+
+
+def get_product_snapshots(product_ids):
+    """
+        Returns a tuple where first item is a dict of product id to the
+        details of the product stored with a cart item, and the second
+        item is an error message. Details are taken from the local Product
+        table. Products missing from it are retrieved with get_products.
+        The dict has the details of every product that was found, even if
+        some were not, in which case the error message is
+        PRODUCT_DOES_NOT_EXIST_MSG, or the error retrieving them.
+    """
+
+    product_ids = set(int(product_id) for product_id in product_ids)
+    snapshots = {
+        product['shopify_product_id']: {
+            'product_title': product['title'],
+            'price': product['price'],
+            'variant_id': product['variant_id'],
+            'inventory_item_id': product['inventory_item_id'],
+        }
+        for product in Product.objects.filter(shopify_product_id__in=product_ids).values(
+            'shopify_product_id', 'title', 'price', 'variant_id', 'inventory_item_id'
+        )
+    }
+
+    missing_product_ids = product_ids - set(snapshots)
+    if missing_product_ids:
+        products, err_msg = get_products(ids=missing_product_ids)
+        if err_msg:
+            return snapshots, err_msg
+        for product in products:
+            product_fields = get_product_fields(product)
+            snapshots[product['id']] = {
+                'product_title': product_fields['title'],
+                'price': product_fields['price'],
+                'variant_id': product_fields['variant_id'],
+                'inventory_item_id': product_fields['inventory_item_id'],
+            }
+
+    if product_ids - set(snapshots):
+        return snapshots, PRODUCT_DOES_NOT_EXIST_MSG
+    return snapshots, ''
+
+
+def get_cart(user):
+    """
+        Returns (cart_items, cart_total, err_msg) for the user's cart.
+        Cart items are rendered from the product snapshots stored with
+        them. A single query on the local Product table, which is kept
+        current by webhooks, flags items whose price has changed since
+        they were added (price_changed, current_price) or which no longer
+        have enough stock (out_of_stock, inventory_quantity).
+        Cart items added before snapshots were stored get one here. Items
+        whose product no longer exists in the store are removed, so that
+        the cart shows what would be ordered.
+    """
+
+    cart_items_queryset = CartItem.objects.filter(user=user).order_by('id')
+    cart_items = list(cart_items_queryset.values(
+        'id', 'product_id', 'quantity', 'snapshot_at', *SNAPSHOT_FIELDS
+    ))
+
+    err_msg = ''
+    missing_snapshot_product_ids = [
+        cart_item['product_id'] for cart_item in cart_items if cart_item['snapshot_at'] is None
+    ]
+    if missing_snapshot_product_ids:
+        snapshots, err_msg = get_product_snapshots(missing_snapshot_product_ids)
+        snapshot_at = timezone.now()
+        for cart_item in cart_items:
+            if cart_item['product_id'] in snapshots:
+                cart_item.update(snapshots[cart_item['product_id']])
+                cart_item['snapshot_at'] = snapshot_at
+                cart_items_queryset.filter(id=cart_item['id']).update(
+                    snapshot_at=snapshot_at, **snapshots[cart_item['product_id']]
+                )
+        if err_msg == PRODUCT_DOES_NOT_EXIST_MSG:
+            cart_items_queryset.filter(
+                product_id__in=set(missing_snapshot_product_ids) - set(snapshots)
+            ).delete()
+            err_msg = 'Some products in your cart are no longer available and were removed.'
+        # Items of products that could not be retrieved are left out until
+        # they can be.
+        cart_items = [cart_item for cart_item in cart_items if cart_item['snapshot_at'] is not None]
+
+    current_products = {
+        product['shopify_product_id']: product
+        for product in Product.objects.filter(
+            shopify_product_id__in=[cart_item['product_id'] for cart_item in cart_items]
+        ).values('shopify_product_id', 'price', 'inventory_quantity')
+    }
+
+    cart_total = 0
+    for cart_item in cart_items:
+        product_price = float(cart_item['price'])
+        cart_item['price'] = product_price
+        cart_item['amount'] = round(cart_item['quantity'] * product_price, 2)
+        del cart_item['snapshot_at']
+
+        current_product = current_products.get(cart_item['product_id'])
+        cart_item['price_changed'] = bool(current_product) and float(current_product['price']) != product_price
+        cart_item['current_price'] = float(current_product['price']) if current_product else product_price
+        cart_item['out_of_stock'] = bool(current_product) and current_product['inventory_quantity'] < cart_item['quantity']
+        cart_item['inventory_quantity'] = current_product['inventory_quantity'] if current_product else None
+
+        cart_total = cart_total + cart_item['quantity'] * product_price
+
+    return cart_items, round(cart_total, 2), err_msg
+
+
+def apply_cart_changes(user, upserts, deletes):
+    """
+        Apply a batch of changes to the user's cart in one transaction.
+        upserts is a list of {'product_id': .., 'quantity': ..}. Products
+        not yet in the cart are added with a single bulk_create and the
+        quantities of the others are set with a single UPDATE. An upsert
+        with quantity 0 removes the product. deletes is a list of product
+        ids to remove. A product added by a concurrent request in the
+        meantime is incremented by the quantity instead.
+        Returns an error message, which is empty on success.
+    """
+
+    quantity_map = {}
+    for upsert in upserts:
+        quantity_map[upsert['product_id']] = upsert['quantity']
+    delete_product_ids = set(deletes)
+    for product_id, quantity in list(quantity_map.items()):
+        if quantity == 0 or product_id in delete_product_ids:
+            delete_product_ids.add(product_id)
+            del quantity_map[product_id]
+
+    new_product_ids = set(quantity_map) - set(CartItem.objects.filter(
+        user=user, product_id__in=quantity_map.keys()
+    ).values_list('product_id', flat=True))
+    snapshots = {}
+    if new_product_ids:
+        snapshots, err_msg = get_product_snapshots(new_product_ids)
+        if err_msg:
+            return err_msg
+    snapshot_at = timezone.now()
+
+    with transaction.atomic():
+        if delete_product_ids:
+            CartItem.objects.filter(user=user, product_id__in=delete_product_ids).delete()
+
+        if not quantity_map:
+            return ''
+
+        existing_cart_item_ids = dict(CartItem.objects.select_for_update().filter(
+            user=user, product_id__in=quantity_map.keys()
+        ).values_list('product_id', 'id'))
+
+        # Django 1.11 has no bulk_update, so all existing items are
+        # updated with a single CASE expression instead.
+        if existing_cart_item_ids:
+            CartItem.objects.filter(id__in=existing_cart_item_ids.values()).update(quantity=Case(
+                *[
+                    When(id=cart_item_id, then=Value(quantity_map[product_id]))
+                    for product_id, cart_item_id in existing_cart_item_ids.items()
+                ],
+                output_field=IntegerField()
+            ))
+
+        new_cart_items = []
+        for product_id, quantity in quantity_map.items():
+            if product_id in existing_cart_item_ids:
+                continue
+            if product_id not in snapshots:
+                # Added by a concurrent request since the snapshots were
+                # taken and removed again. Snapshotted when rendered.
+                snapshots[product_id] = {}
+            new_cart_items.append(CartItem(
+                user=user,
+                product_id=product_id,
+                quantity=quantity,
+                snapshot_at=snapshot_at if snapshots[product_id] else None,
+                **snapshots[product_id]
+            ))
+        try:
+            with transaction.atomic():
+                CartItem.objects.bulk_create(new_cart_items)
+        except IntegrityError:
+            # A concurrent request added some of the products first, as
+            # only existing items are locked. Those are incremented
+            # instead, like add_to_cart does.
+            for cart_item in new_cart_items:
+                try:
+                    with transaction.atomic():
+                        cart_item.save(force_insert=True)
+                except IntegrityError:
+                    CartItem.objects.filter(
+                        user=user, product_id=cart_item.product_id
+                    ).update(quantity=F('quantity') + cart_item.quantity)
+    return ''
+
+
+# Adds a product to the cart, or increments its quantity if it is already
+# there, in a single statement. ON CONFLICT is supported by PostgreSQL and
+# SQLite 3.24+, RETURNING by PostgreSQL and SQLite 3.35+. The snapshot of
+# the product is refreshed, as the user has just seen its current details.
+UPSERT_CART_ITEM_SQL = """
+    INSERT INTO {table} (
+        product_id, quantity, user_id,
+        product_title, price, variant_id, inventory_item_id, snapshot_at
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (product_id, user_id)
+    DO UPDATE SET
+        quantity = {table}.quantity + excluded.quantity,
+        product_title = excluded.product_title,
+        price = excluded.price,
+        variant_id = excluded.variant_id,
+        inventory_item_id = excluded.inventory_item_id,
+        snapshot_at = excluded.snapshot_at
+    RETURNING id, quantity
+"""
+
+
+def supports_upsert():
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+def add_to_cart(user, product_id, quantity=1):
+    """
+        Add quantity of a product to the user's cart. If the product is
+        already in the cart, its quantity is incremented instead. Safe
+        under concurrent requests, Eg: double clicks, as the database
+        resolves the conflict on ('product_id', 'user').
+        Returns a tuple where first item is (cart_item_id, quantity) of the
+        cart item and the second item is an error message.
+    """
+
+    snapshots, err_msg = get_product_snapshots([product_id])
+    if err_msg:
+        return None, err_msg
+    snapshot = snapshots[product_id]
+    snapshot_at = timezone.now()
+
+    if supports_upsert():
+        price_field = CartItem._meta.get_field('price')
+        snapshot_at_field = CartItem._meta.get_field('snapshot_at')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                UPSERT_CART_ITEM_SQL.format(table=connection.ops.quote_name(CartItem._meta.db_table)),
+                [
+                    product_id, quantity, user.id,
+                    snapshot['product_title'],
+                    price_field.get_db_prep_save(price_field.to_python(snapshot['price']), connection),
+                    snapshot['variant_id'],
+                    snapshot['inventory_item_id'],
+                    snapshot_at_field.get_db_prep_save(snapshot_at, connection),
+                ]
+            )
+            return tuple(cursor.fetchone()), ''
+
+    # Other databases increment with an UPDATE and insert only if there
+    # was nothing to update. An insert that loses a race with another
+    # request violates unique_together and is retried as an UPDATE.
+    cart_items = CartItem.objects.filter(user=user, product_id=product_id)
+    for attempt in range(2):
+        if cart_items.update(quantity=F('quantity') + quantity, snapshot_at=snapshot_at, **snapshot):
+            return tuple(cart_items.values_list('id', 'quantity').get()), ''
+        if attempt == 0:
+            try:
+                with transaction.atomic():
+                    cart_item = CartItem.objects.create(
+                        user=user, product_id=product_id, quantity=quantity,
+                        snapshot_at=snapshot_at, **snapshot
+                    )
+                return (cart_item.id, cart_item.quantity), ''
+            except IntegrityError:
+                pass
+    return None, 'Could not add product to cart. Please try again.'
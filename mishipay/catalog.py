@@ -0,0 +1,312 @@
+import logging
+from datetime import timedelta
+from urllib.parse import quote
+from django.conf import settings
+from django.db import (
+    connection,
+    transaction,
+)
+from django.utils import timezone
+from requests.exceptions import RequestException
+from mishipay.cache_utils import invalidate_products
+from mishipay.db_utils import bulk_update
+from mishipay.models import (
+    Product,
+    ProductVariant,
+    SyncCheckpoint
+)
+from mishipay.constants import SHOPIFY_PAGE_LIMIT
+from mishipay.shopify_client import (
+    SHOPIFY_UNAVAILABLE_MSG,
+    ShopifyUnavailable,
+    get_background_executor,
+    is_shopify_available,
+)
+from mishipay.shopify_utils import (
+    ShopifyAPIError,
+    iter_products,
+    filter_relevant_product_information,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# The SyncCheckpoint of the last load of an empty catalog.
+CATALOG_FILL_RESOURCE = 'catalog_fill'
+# An empty catalog is loaded at most once in this many seconds.
+CATALOG_FILL_INTERVAL = 5 * 60
+
+
+def get_product_fields(product):
+    """
+        Map a product trimmed by filter_relevant_product_information
+        to Product model fields.
+    """
+
+    # Varients have not been considered in scope of this application.
+    # Hence we simple use the first one. A product must have atleast 1.
+    variant = product['variants'][0]
+    images = sorted(product['images'], key=lambda image: image['position'])
+    inventory_quantity = int(variant['inventory_quantity'])
+    return {
+        'title': product['title'],
+        'body_html': product.get('body_html') or '',
+        'image_src': images[0]['src'] if images else '',
+        'variant_id': variant['id'],
+        'inventory_item_id': variant['inventory_item_id'],
+        'price': variant['price'],
+        'inventory_quantity': inventory_quantity,
+        'in_stock': inventory_quantity > 0,
+    }
+
+
+# Product fields that are copied from Shopify. See get_product_fields
+PRODUCT_FIELDS = (
+    'title', 'body_html', 'image_src', 'variant_id', 'inventory_item_id',
+    'price', 'inventory_quantity', 'in_stock',
+)
+PRODUCT_VARIANT_FIELDS = ('title', 'inventory_item_id', 'price', 'inventory_quantity', 'position')
+
+
+def save_products(products):
+    """
+        Create or update Product objects, along with their ProductVariant
+        objects, for the given trimmed products. Existing products are
+        updated with a single UPDATE per batch and new products are
+        inserted with a single bulk_create.
+    """
+
+    product_fields_map = {
+        product['id']: get_product_fields(product) for product in products
+    }
+    if not product_fields_map:
+        return
+
+    with transaction.atomic():
+        existing_product_ids = set(Product.objects.filter(
+            shopify_product_id__in=product_fields_map.keys()
+        ).values_list('shopify_product_id', flat=True))
+
+        bulk_update(Product, 'shopify_product_id', {
+            shopify_product_id: product_fields_map[shopify_product_id]
+            for shopify_product_id in existing_product_ids
+        }, PRODUCT_FIELDS)
+
+        Product.objects.bulk_create([
+            Product(shopify_product_id=shopify_product_id, **product_fields)
+            for shopify_product_id, product_fields in product_fields_map.items()
+            if shopify_product_id not in existing_product_ids
+        ])
+
+        save_product_variants(products)
+
+
+def save_product_variants(products):
+    """
+        Create or update ProductVariant objects for all the variants of
+        the given trimmed products, whose Product objects must exist, and
+        delete variants that the products no longer have.
+    """
+
+    product_pks = dict(Product.objects.filter(
+        shopify_product_id__in=[product['id'] for product in products]
+    ).values_list('shopify_product_id', 'id'))
+
+    variant_fields_map = {}
+    variant_product_pks = {}
+    for product in products:
+        for position, variant in enumerate(product['variants'], 1):
+            variant_fields_map[variant['id']] = {
+                'title': variant['title'] or '',
+                'inventory_item_id': variant['inventory_item_id'],
+                'price': variant['price'],
+                'inventory_quantity': int(variant['inventory_quantity'] or 0),
+                'position': position,
+            }
+            variant_product_pks[variant['id']] = product_pks[product['id']]
+
+    existing_variant_ids = set(ProductVariant.objects.filter(
+        shopify_variant_id__in=variant_fields_map.keys()
+    ).values_list('shopify_variant_id', flat=True))
+
+    bulk_update(ProductVariant, 'shopify_variant_id', {
+        shopify_variant_id: variant_fields_map[shopify_variant_id]
+        for shopify_variant_id in existing_variant_ids
+    }, PRODUCT_VARIANT_FIELDS)
+
+    ProductVariant.objects.bulk_create([
+        ProductVariant(
+            product_id=variant_product_pks[shopify_variant_id],
+            shopify_variant_id=shopify_variant_id,
+            **variant_fields
+        )
+        for shopify_variant_id, variant_fields in variant_fields_map.items()
+        if shopify_variant_id not in existing_variant_ids
+    ])
+
+    ProductVariant.objects.filter(
+        product_id__in=product_pks.values()
+    ).exclude(
+        shopify_variant_id__in=variant_fields_map.keys()
+    ).delete()
+
+
+def delete_products(shopify_product_ids):
+    Product.objects.filter(shopify_product_id__in=shopify_product_ids).delete()
+
+
+def refresh_catalog(updated_at_min=None, progress=None):
+    """
+        Load all products from Shopify into the Product and ProductVariant
+        tables, one page at a time, and remove products that no longer
+        exist in the store. Cached copies of the loaded products are
+        dropped. Products are stamped with the time the load started as
+        they are saved, so that those that were not seen are deleted
+        without holding every product id in memory.
+        If updated_at_min is passed, only products updated since then are
+        loaded and no product is removed, as deleted products can not be
+        told apart from products that have not changed.
+        progress, if passed, is called with the number of products loaded
+        so far after every page.
+        Returns a tuple where first item is the number of products loaded
+        and the second item is an error message.
+    """
+
+    extra_query_param = ''
+    if updated_at_min is not None:
+        extra_query_param = '&updated_at_min={}'.format(quote(updated_at_min.isoformat()))
+
+    started_at = timezone.now()
+    product_count = 0
+
+    def save_page(page):
+        product_ids = [product['id'] for product in page]
+        save_products(page)
+        Product.objects.filter(shopify_product_id__in=product_ids).update(synced_at=started_at)
+        invalidate_products(product_ids)
+
+    page = []
+    try:
+        for product in filter_relevant_product_information(iter_products(extra_query_param=extra_query_param)):
+            product_count = product_count + 1
+            page.append(product)
+            if len(page) == SHOPIFY_PAGE_LIMIT:
+                save_page(page)
+                page = []
+                if progress:
+                    progress(product_count)
+        save_page(page)
+        if progress:
+            progress(product_count)
+    except ShopifyUnavailable:
+        return 0, SHOPIFY_UNAVAILABLE_MSG
+    except RequestException:
+        return 0, 'Error retrieving products'
+    except ShopifyAPIError as e:
+        return 0, 'Error retrieving products: {}'.format(e)
+
+    if updated_at_min is None:
+        # Products created since the load started, Eg: by webhooks, are
+        # stamped with the time they were created and kept.
+        Product.objects.filter(synced_at__lt=started_at).delete()
+    return product_count, ''
+
+
+def claim_catalog_fill():
+    """
+        Returns True if the caller may load the empty catalog. Claims are
+        kept in the database, as the SyncCheckpoint of
+        CATALOG_FILL_RESOURCE, so that the catalog is loaded by a single
+        process at a time, at most once every CATALOG_FILL_INTERVAL
+        seconds.
+    """
+
+    now = timezone.now()
+    checkpoint, created = SyncCheckpoint.objects.get_or_create(
+        resource=CATALOG_FILL_RESOURCE,
+        defaults={'synced_at': now}
+    )
+    if created:
+        return True
+    # Only one of the processes that find an expired claim moves it.
+    return bool(SyncCheckpoint.objects.filter(
+        resource=CATALOG_FILL_RESOURCE,
+        synced_at__lte=now - timedelta(seconds=CATALOG_FILL_INTERVAL)
+    ).update(synced_at=now))
+
+
+def fill_catalog():
+    """
+        Load the catalog with refresh_catalog if the Product table is
+        empty.
+    """
+
+    if Product.objects.exists():
+        return
+    product_count, err_msg = refresh_catalog()
+    if err_msg:
+        logger.warning('Could not load the catalog: %s', err_msg)
+
+
+def fill_catalog_in_background():
+    """
+        Load the catalog with fill_catalog, Eg: before the first run of the
+        sync_shopify command, without waiting for it. The catalog is loaded
+        on the background thread pool, so that it never holds up the
+        threads that checkout calls share, and only if it is claimed with
+        claim_catalog_fill. Nothing is loaded while Shopify is
+        unavailable. If CATALOG_FILL_ALWAYS_EAGER is True, the catalog is
+        loaded before returning instead, Eg: in tests.
+        Returns the Future of the load, or None if it is not loaded in the
+        background.
+    """
+
+    if not is_shopify_available() or not claim_catalog_fill():
+        return None
+
+    if settings.CATALOG_FILL_ALWAYS_EAGER:
+        fill_catalog()
+        return None
+
+    def fill():
+        try:
+            fill_catalog()
+        finally:
+            # Threads of the pool are not part of a request, so their
+            # connection is not closed by Django.
+            connection.close()
+
+    return get_background_executor().submit_detached(fill)
+
+
+def get_product_page(after=None, before=None, limit=None):
+    """
+        Returns a tuple of (products, previous cursor, next cursor) for a
+        page of in stock products ordered by Shopify product id. Cursors
+        are product ids, so every page is a single index range scan no
+        matter how deep it is. A cursor is None if there is no such page.
+    """
+
+    limit = limit or settings.PRODUCT_LISTING_PAGE_SIZE
+    products = Product.objects.filter(in_stock=True)
+
+    if before:
+        # Walk backwards from the cursor and restore the order afterwards.
+        products = list(products.filter(
+            shopify_product_id__lt=before
+        ).order_by('-shopify_product_id')[:limit + 1])
+        has_previous = len(products) > limit
+        products = products[:limit][::-1]
+        has_next = True
+    else:
+        if after:
+            products = products.filter(shopify_product_id__gt=after)
+        products = list(products.order_by('shopify_product_id')[:limit + 1])
+        has_next = len(products) > limit
+        products = products[:limit]
+        has_previous = bool(after)
+
+    previous_cursor = products[0].shopify_product_id if products and has_previous else None
+    next_cursor = products[-1].shopify_product_id if products and has_next else None
+    return products, previous_cursor, next_cursor
@@ -1,2 +1,18 @@
 ORDER_TYPE_PLACED = "placed"
 ORDER_TYPE_CANCELLED = "cancelled"
+
+ORDER_JOB_STATUS_PENDING = "pending"
+ORDER_JOB_STATUS_RUNNING = "running"
+ORDER_JOB_STATUS_SUCCEEDED = "succeeded"
+ORDER_JOB_STATUS_FAILED = "failed"
+
+# Shopify webhook topics that are applied to the local tables.
+WEBHOOK_TOPIC_PRODUCTS_CREATE = "products/create"
+WEBHOOK_TOPIC_PRODUCTS_UPDATE = "products/update"
+WEBHOOK_TOPIC_PRODUCTS_DELETE = "products/delete"
+WEBHOOK_TOPIC_INVENTORY_LEVELS_UPDATE = "inventory_levels/update"
+WEBHOOK_TOPIC_ORDERS_UPDATED = "orders/updated"
+WEBHOOK_TOPIC_ORDERS_CANCELLED = "orders/cancelled"
+
+# Maximum number of items Shopify returns in a single page.
+SHOPIFY_PAGE_LIMIT = 250
@@ -0,0 +1,56 @@
+from django.db import connection
+from django.db.models import (
+    Case,
+    Value,
+    When,
+)
+
+
+def bulk_update(model, key_field, rows, fields):
+    """
+        Update many rows of a model with a single UPDATE per batch, as
+        Django 1.11 has no bulk_update. rows is a dict of a value of
+        key_field to a dict of the new values of fields, Eg:
+        bulk_update(Product, 'shopify_product_id', {1: {'price': '10.00'}}, ['price'])
+        Rows whose values are already stored are skipped, so that syncing
+        mostly unchanged data, Eg: a catalog, costs a SELECT per batch.
+        Each field of the other rows is set with a CASE expression on
+        key_field, which does not need to be unique. Batches are sized to
+        stay within the database's limit on query parameters, Eg: 999 on
+        SQLite.
+    """
+
+    if not rows:
+        return
+
+    model_fields = {field: model._meta.get_field(field) for field in fields}
+    keys = list(rows.keys())
+    # One parameter for the key in the WHERE clause, and two, the key and
+    # the value, for every field in the CASE expressions.
+    batch_size = connection.ops.bulk_batch_size([None] * (1 + 2 * len(fields)), keys) or len(keys)
+
+    changed_keys = []
+    for index in range(0, len(keys), batch_size):
+        stored_rows = model.objects.filter(
+            **{'{}__in'.format(key_field): keys[index:index + batch_size]}
+        ).values(key_field, *fields)
+        changed_keys.extend(set(
+            stored_row[key_field] for stored_row in stored_rows
+            if any(
+                model_field.to_python(rows[stored_row[key_field]][field]) != stored_row[field]
+                for field, model_field in model_fields.items()
+            )
+        ))
+
+    for index in range(0, len(changed_keys), batch_size):
+        batch = changed_keys[index:index + batch_size]
+        model.objects.filter(**{'{}__in'.format(key_field): batch}).update(**{
+            field: Case(
+                *[
+                    When(**{key_field: key, 'then': Value(rows[key][field], output_field=model_field)})
+                    for key in batch
+                ],
+                output_field=model_field
+            )
+            for field, model_field in model_fields.items()
+        })
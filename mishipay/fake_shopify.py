@@ -0,0 +1,284 @@
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+from socketserver import ThreadingMixIn
+from urllib.parse import (
+    parse_qs,
+    quote,
+    urlparse,
+)
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+class FakeShopifyStore(object):
+    """
+        In memory state of the fake Shopify store. Holds a catalog of
+        `product_count` products, each with a single varient stocked at a
+        single location, and the orders placed on the store.
+    """
+
+    location_id = 1
+
+    def __init__(self, product_count=100, inventory_quantity=1000000):
+        self.lock = threading.Lock()
+        self.products = {}
+        self.inventory_levels = {}
+        self.orders = {}
+        self.order_ids = itertools.count(5000000000001)
+        self.line_item_ids = itertools.count(6000000000001)
+
+        for index in range(1, product_count + 1):
+            product_id = 1000000000000 + index
+            variant_id = 2000000000000 + index
+            inventory_item_id = 3000000000000 + index
+            self.products[product_id] = {
+                'id': product_id,
+                'title': 'Product {}'.format(index),
+                'body_html': '<p>Description of product {}</p>'.format(index),
+                'images': [{
+                    'id': 4000000000000 + index,
+                    'src': 'https://cdn.example.com/products/{}.jpg'.format(index),
+                    'position': 1,
+                }],
+                'variants': [{
+                    'id': variant_id,
+                    'title': 'Default Title',
+                    'inventory_item_id': inventory_item_id,
+                    'inventory_quantity': inventory_quantity,
+                    'price': '{}.00'.format(index % 100 + 1),
+                }],
+            }
+            self.inventory_levels[inventory_item_id] = {
+                'inventory_item_id': inventory_item_id,
+                'location_id': self.location_id,
+                'available': inventory_quantity,
+            }
+
+    def get_products(self, ids=None):
+        products = sorted(self.products.values(), key=lambda product: product['id'])
+        if ids is not None:
+            products = [product for product in products if product['id'] in ids]
+        return products
+
+    def get_orders(self, ids=None, created_at_min=None):
+        orders = sorted(self.orders.values(), key=lambda order: order['id'])
+        if ids is not None:
+            orders = [order for order in orders if order['id'] in ids]
+        if created_at_min is not None:
+            orders = [order for order in orders if parse_datetime(order['created_at']) >= created_at_min]
+        return orders
+
+    def adjust_inventory_level(self, inventory_item_id, available_adjustment):
+        with self.lock:
+            inventory_level = self.inventory_levels[inventory_item_id]
+            inventory_level['available'] = inventory_level['available'] + available_adjustment
+            for product in self.products.values():
+                variant = product['variants'][0]
+                if variant['inventory_item_id'] == inventory_item_id:
+                    variant['inventory_quantity'] = inventory_level['available']
+            return dict(inventory_level)
+
+    def create_order(self, order_data):
+        variant_product_map = {
+            product['variants'][0]['id']: product for product in self.products.values()
+        }
+        line_items = []
+        for line_item in order_data['order']['line_items']:
+            product = variant_product_map[line_item['variant_id']]
+            line_items.append({
+                'id': next(self.line_item_ids),
+                'product_id': product['id'],
+                'variant_id': line_item['variant_id'],
+                'title': product['title'],
+                'quantity': line_item['quantity'],
+                'price': product['variants'][0]['price'],
+            })
+        total_price = '{:.2f}'.format(
+            sum(float(line_item['price']) * line_item['quantity'] for line_item in line_items)
+        )
+        now = timezone.now().isoformat()
+        order = {
+            'id': next(self.order_ids),
+            'contact_email': order_data.get('email'),
+            'email': order_data.get('email'),
+            'phone': order_data.get('phone'),
+            'created_at': now,
+            'updated_at': now,
+            'cancelled_at': None,
+            'financial_status': 'paid',
+            'fulfillment_status': None,
+            'line_items': line_items,
+            'note_attributes': order_data['order'].get('note_attributes') or [],
+            'subtotal_price': total_price,
+            'total_line_items_price': total_price,
+            'total_price': total_price,
+        }
+        with self.lock:
+            self.orders[order['id']] = order
+        return order
+
+    def cancel_order(self, order_id):
+        with self.lock:
+            order = self.orders[order_id]
+            order['cancelled_at'] = timezone.now().isoformat()
+            order['updated_at'] = order['cancelled_at']
+            return order
+
+
+class FakeShopifyRequestHandler(BaseHTTPRequestHandler):
+    """
+        Serves the subset of the Shopify Admin API used by this application.
+        Every response is delayed by the latency of the server, to stand in
+        for the round-trip to Shopify.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Do not log every request.
+        return
+
+    def send_json(self, data, status=200, headers=None):
+        time.sleep(self.server.latency)
+        self.server.count_request()
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Shopify-Shop-Api-Call-Limit', '1/40')
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self, resource, items, query_params, path):
+        """
+            Send a page of items with a Link header pointing to the next
+            page, the way Shopify's cursor pagination does.
+        """
+        limit = int(query_params.get('limit', ['50'])[0])
+        start = int(query_params.get('page_info', ['0'])[0])
+        headers = {}
+        if start + limit < len(items):
+            # Shopify keeps the filters in page_info. Here they are carried
+            # over as they are, as page_info is an offset.
+            filter_query_params = ''.join(
+                '&{}={}'.format(name, quote(query_params[name][0]))
+                for name in ('ids', 'created_at_min') if name in query_params
+            )
+            headers['Link'] = '<http://{}{}?limit={}&page_info={}{}>; rel="next"'.format(
+                self.headers['Host'], path, limit, start + limit, filter_query_params
+            )
+        self.send_json({resource: items[start:start + limit]}, headers=headers)
+
+    def get_ids(self, query_params, name='ids'):
+        if name not in query_params:
+            return None
+        return [int(_id) for _id in query_params[name][0].split(',') if _id]
+
+    def read_json(self):
+        content_length = int(self.headers.get('Content-Length') or 0)
+        if not content_length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(content_length).decode('utf-8'))
+        except ValueError:
+            return {}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query_params = parse_qs(url.query)
+        store = self.server.store
+
+        if url.path == '/admin/products.json':
+            return self.send_page('products', store.get_products(self.get_ids(query_params)), query_params, url.path)
+
+        if url.path == '/admin/orders.json':
+            created_at_min = query_params.get('created_at_min', [None])[0]
+            return self.send_page('orders', store.get_orders(
+                self.get_ids(query_params),
+                parse_datetime(created_at_min) if created_at_min else None
+            ), query_params, url.path)
+
+        match = re.match(r'^/admin/orders/(\d+)\.json$', url.path)
+        if match and int(match.group(1)) in store.orders:
+            return self.send_json({'order': store.orders[int(match.group(1))]})
+
+        if url.path == '/admin/inventory_levels.json':
+            inventory_item_ids = self.get_ids(query_params, 'inventory_item_ids') or []
+            return self.send_json({'inventory_levels': [
+                store.inventory_levels[inventory_item_id] for inventory_item_id in inventory_item_ids
+                if inventory_item_id in store.inventory_levels
+            ]})
+
+        self.send_json({'errors': 'Not Found'}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        data = self.read_json()
+        store = self.server.store
+
+        if url.path == '/admin/inventory_levels/adjust.json':
+            if data.get('inventory_item_id') not in store.inventory_levels:
+                return self.send_json({'errors': 'Inventory item does not exist'}, status=422)
+            inventory_level = store.adjust_inventory_level(
+                data['inventory_item_id'], data['available_adjustment']
+            )
+            return self.send_json({'inventory_level': inventory_level})
+
+        if url.path == '/admin/orders.json':
+            return self.send_json({'order': store.create_order(data)}, status=201)
+
+        match = re.match(r'^/admin/orders/(\d+)/cancel\.json$', url.path)
+        if match and int(match.group(1)) in store.orders:
+            return self.send_json({'order': store.cancel_order(int(match.group(1)))})
+
+        self.send_json({'errors': 'Not Found'}, status=404)
+
+
+class FakeShopifyServer(ThreadingMixIn, HTTPServer):
+    """
+        A local stand-in for the Shopify Admin API, for benchmarks. Serves
+        products, inventory levels, inventory adjustments, orders and order
+        cancellation from a FakeShopifyStore, with a configurable latency
+        in seconds added to every response.
+
+        Usage:
+            server = FakeShopifyServer(store=FakeShopifyStore(product_count=500), latency=0.05)
+            server.start()
+            # Point settings.SHOPIFY_STORE_URL to server.url
+            server.stop()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, store=None, latency=0, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), FakeShopifyRequestHandler)
+        self.store = store or FakeShopifyStore()
+        self.latency = latency
+        self.request_count = 0
+        self.request_count_lock = threading.Lock()
+
+    def count_request(self):
+        with self.request_count_lock:
+            self.request_count = self.request_count + 1
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,167 @@
+import json
+import logging
+import re
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """
+        Shopify calls made while handling a single request. Calls can be
+        recorded from several threads, Eg: concurrent inventory adjustments.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shopify_calls = []
+
+    def add_shopify_call(self, shopify_call):
+        with self.lock:
+            self.shopify_calls.append(shopify_call)
+
+    @property
+    def shopify_call_count(self):
+        return len(self.shopify_calls)
+
+    @property
+    def shopify_time(self):
+        return sum(shopify_call['latency'] for shopify_call in self.shopify_calls)
+
+
+def start_request_stats():
+    _local.request_stats = RequestStats()
+    return _local.request_stats
+
+
+def get_request_stats():
+    return getattr(_local, 'request_stats', None)
+
+
+def end_request_stats():
+    request_stats = get_request_stats()
+    _local.request_stats = None
+    return request_stats
+
+
+def bind_request_stats(fn):
+    """
+        Wrap a function that is run on another thread (Eg: on a thread
+        pool) so that Shopify calls it makes are counted against the
+        request of the calling thread.
+    """
+
+    request_stats = get_request_stats()
+
+    def wrapper(*args, **kwargs):
+        previous_request_stats = get_request_stats()
+        _local.request_stats = request_stats
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.request_stats = previous_request_stats
+    return wrapper
+
+
+def get_endpoint(method, url):
+    """
+        Name of a Shopify endpoint without ids, so that calls to the same
+        endpoint are grouped. Eg: 'POST /admin/orders/{id}/cancel.json'
+    """
+
+    return '{} {}'.format(method, re.sub(r'/\d+', '/{id}', urlparse(url).path))
+
+
+def record_shopify_call(method, url, response, latency):
+    """
+        Record a call to Shopify, against the current request and in the
+        process wide metrics. response is None if the call failed without
+        a response, Eg: on a timeout.
+    """
+
+    rate_limit_headroom = None
+    if response is not None:
+        try:
+            level, size = [int(value) for value in response.headers.get('X-Shopify-Shop-Api-Call-Limit', '').split('/')]
+            rate_limit_headroom = size - level
+        except ValueError:
+            pass
+
+    shopify_call = {
+        'endpoint': get_endpoint(method, url),
+        'status': response.status_code if response is not None else 'error',
+        'latency': latency,
+        'bytes': len(response.content) if response is not None else 0,
+        'rate_limit_headroom': rate_limit_headroom,
+    }
+
+    request_stats = get_request_stats()
+    if request_stats is not None:
+        request_stats.add_shopify_call(shopify_call)
+    metrics.record_shopify_call(shopify_call)
+    logger.debug(json.dumps(dict(shopify_call, event='shopify_call')))
+
+
+class Metrics(object):
+    """
+        Process wide counters, rendered in the Prometheus text exposition
+        format. Each process (Eg: gunicorn worker) keeps its own counters.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+
+    def increment(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters[key] + value
+
+    def set_gauge(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def record_shopify_call(self, shopify_call):
+        labels = {'endpoint': shopify_call['endpoint']}
+        self.increment('shopify_requests_total', dict(labels, status=str(shopify_call['status'])))
+        self.increment('shopify_request_duration_seconds_sum', labels, shopify_call['latency'])
+        self.increment('shopify_request_duration_seconds_count', labels)
+        self.increment('shopify_response_bytes_total', labels, shopify_call['bytes'])
+        if shopify_call['rate_limit_headroom'] is not None:
+            self.set_gauge('shopify_rate_limit_headroom', {}, shopify_call['rate_limit_headroom'])
+
+    def record_request(self, view, status, duration, shopify_call_count, shopify_time, db_query_count, db_time):
+        labels = {'view': view}
+        self.increment('http_requests_total', dict(labels, status=str(status)))
+        self.increment('http_request_duration_seconds_sum', labels, duration)
+        self.increment('http_request_duration_seconds_count', labels)
+        self.increment('http_request_shopify_calls_total', labels, shopify_call_count)
+        self.increment('http_request_shopify_duration_seconds_sum', labels, shopify_time)
+        self.increment('http_request_db_queries_total', labels, db_query_count)
+        self.increment('http_request_db_duration_seconds_sum', labels, db_time)
+
+    def render(self):
+        with self.lock:
+            samples = sorted(list(self.counters.items()) + list(self.gauges.items()))
+
+        lines = []
+        for (name, labels), value in samples:
+            label_string = ','.join(
+                '{}="{}"'.format(label, label_value.replace('\\', '\\\\').replace('"', '\\"'))
+                for label, label_value in labels
+            )
+            if label_string:
+                lines.append('{}{{{}}} {}'.format(name, label_string, value))
+            else:
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
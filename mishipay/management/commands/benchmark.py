@@ -0,0 +1,330 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from custom_user.models import User
+from mishipay.catalog import refresh_catalog
+from mishipay.fake_shopify import (
+    FakeShopifyServer,
+    FakeShopifyStore,
+)
+from mishipay.models import Order
+from mishipay.shopify_client import reset_session
+
+
+logger = logging.getLogger(__name__)
+
+
+VIEWS = ('product_listing', 'cart', 'place_order', 'my_orders', 'cancel_order')
+
+CART_SIZE = 3
+
+
+def get_percentile(latencies, percentile):
+    """
+        Nearest rank percentile of a sorted list of latencies.
+    """
+    if not latencies:
+        return 0
+    rank = max(0, int(round(percentile / 100.0 * len(latencies))) - 1)
+    return latencies[min(rank, len(latencies) - 1)]
+
+
+class ViewBenchmark(object):
+    """
+        Drives a single view with the Django test client as one user. Each
+        user has their own cart and orders, so concurrent users do not
+        interfere with each other. setup() runs before timing starts and
+        request() is the timed part of an iteration.
+    """
+
+    def __init__(self, view, client, user, store, iterations):
+        self.view = view
+        self.client = client
+        self.user = user
+        self.store = store
+        self.iterations = iterations
+        self.shopify_order_ids = []
+
+    def add_to_cart(self, products):
+        for product in products:
+            self.client.post(
+                reverse('add_to_cart'),
+                json.dumps({'product_id': product['id'], 'quantity': 1}),
+                content_type='application/json'
+            )
+
+    def get_place_order_url(self):
+        # A new idempotency key per order, as the Cart page sends, so that
+        # orders for the same cart are not treated as repeats.
+        return '{}?idempotency_key={}'.format(reverse('place_order'), uuid.uuid4().hex)
+
+    def place_order(self):
+        products = self.store.get_products()
+        start = (self.user.id * CART_SIZE) % max(1, len(products) - CART_SIZE)
+        self.add_to_cart(products[start:start + CART_SIZE])
+        return self.client.get(self.get_place_order_url(), follow=True)
+
+    def setup(self):
+        if self.view == 'cart':
+            self.add_to_cart(self.store.get_products()[:CART_SIZE])
+        elif self.view == 'my_orders':
+            for index in range(10):
+                self.place_order()
+        elif self.view == 'cancel_order':
+            for index in range(self.iterations):
+                self.place_order()
+            self.shopify_order_ids = list(
+                Order.objects.filter(user=self.user).values_list('shopify_order_id', flat=True)
+            )
+
+    def prepare(self):
+        # Untimed work that has to be done before each iteration.
+        if self.view == 'place_order':
+            products = self.store.get_products()
+            start = (self.user.id * CART_SIZE) % max(1, len(products) - CART_SIZE)
+            self.add_to_cart(products[start:start + CART_SIZE])
+
+    def request(self):
+        if self.view == 'product_listing':
+            return self.client.get(reverse('product_listing'))
+        if self.view == 'cart':
+            return self.client.get(reverse('cart'))
+        if self.view == 'place_order':
+            return self.client.get(self.get_place_order_url(), follow=True)
+        if self.view == 'my_orders':
+            return self.client.get(reverse('my_orders'))
+        if self.view == 'cancel_order':
+            shopify_order_id = self.shopify_order_ids.pop()
+            return self.client.get(
+                reverse('cancel_order', kwargs={'shopify_order_id': shopify_order_id}),
+                follow=True
+            )
+
+    @staticmethod
+    def is_error(response):
+        # None if the request raised.
+        if response is None or response.status_code >= 400:
+            return True
+        # Failed orders redirect with an error message.
+        redirect_chain = getattr(response, 'redirect_chain', [])
+        return bool(redirect_chain) and 'err_msg=' in redirect_chain[-1][0]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark ProductListing, Cart, place_order, MyOrders and cancel_order '
+        'against a local fake Shopify server. Reports throughput, latency '
+        'percentiles and Shopify calls per request for each view.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--views',
+            nargs='+',
+            choices=VIEWS,
+            default=list(VIEWS),
+            help='Views to benchmark.'
+        )
+        parser.add_argument(
+            '--products',
+            type=int,
+            default=100,
+            help='Number of products in the fake store.'
+        )
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=50,
+            help='Latency of the fake Shopify server in milliseconds.'
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=20,
+            help='Number of timed requests per view per user.'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=1,
+            help='Number of users making requests at the same time.'
+        )
+        parser.add_argument(
+            '--output',
+            help='Write results as JSON to this file.'
+        )
+        parser.add_argument(
+            '--baseline',
+            help='Compare results with a JSON file written using --output.'
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=10,
+            help='Percent by which p95 latency may exceed the baseline.'
+        )
+
+    def handle(self, *args, **options):
+        # Do not log a line for every benchmarked request.
+        logging.getLogger('mishipay.middleware').setLevel(logging.WARNING)
+
+        server = FakeShopifyServer(
+            store=FakeShopifyStore(product_count=options['products']),
+            latency=options['latency'] / 1000.0
+        )
+        server.start()
+
+        # Concurrent users need a database that can be written to from
+        # several threads. An in memory SQLite database can not.
+        test_database_file = None
+        if connection.vendor == 'sqlite' and options['concurrency'] > 1:
+            test_database_file = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False).name
+            connection.settings_dict['TEST']['NAME'] = test_database_file
+
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(SHOPIFY_STORE_URL=server.url, ORDER_JOBS_ALWAYS_EAGER=True):
+                reset_session()
+                # Load the local product table before any view is timed, as
+                # the sync_shopify command would. An empty table is loaded
+                # in the background by the Product Listing instead, which
+                # would be timed along with it.
+                product_count, err_msg = refresh_catalog()
+                if err_msg:
+                    raise CommandError('Could not load the catalog: {}'.format(err_msg))
+                results = {}
+                for view in options['views']:
+                    results[view] = self.run_benchmark(view, server, options)
+        finally:
+            reset_session()
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            if test_database_file and os.path.exists(test_database_file):
+                os.remove(test_database_file)
+            server.stop()
+
+        self.report(results)
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(results, output_file, indent=2, sort_keys=True)
+
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def run_benchmark(self, view, server, options):
+        for alias in settings.CACHES:
+            caches[alias].clear()
+
+        benchmarks = []
+        for index in range(options['concurrency']):
+            user = User.objects.create_user(
+                username='benchmark-{}-{}'.format(view, index),
+                email='benchmark-{}@example.com'.format(index),
+                password='benchmark',
+                address='Benchmark Address',
+                phone_number=9999999999
+            )
+            client = Client()
+            client.force_login(user)
+            benchmark = ViewBenchmark(view, client, user, server.store, options['requests'])
+            benchmark.setup()
+            # Warm up, Eg: fill the caches and connection pools.
+            if view == 'place_order':
+                benchmark.prepare()
+                benchmark.request()
+            elif view != 'cancel_order':
+                benchmark.request()
+            benchmarks.append(benchmark)
+
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def run(benchmark):
+            try:
+                for iteration in range(options['requests']):
+                    benchmark.prepare()
+                    start = time.perf_counter()
+                    try:
+                        response = benchmark.request()
+                    except Exception:
+                        # Counted as an error rather than ending the run of
+                        # this user, which would leave the view unmeasured.
+                        logger.exception('%s request failed', view)
+                        response = None
+                    latency = time.perf_counter() - start
+                    with lock:
+                        latencies.append(latency)
+                        if ViewBenchmark.is_error(response):
+                            errors.append(response)
+            finally:
+                connection.close()
+
+        shopify_request_count = server.request_count
+        threads = [threading.Thread(target=run, args=(benchmark,)) for benchmark in benchmarks]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        # Shopify calls made during untimed preparation are included.
+        shopify_request_count = server.request_count - shopify_request_count
+
+        latencies.sort()
+        return {
+            'requests': len(latencies),
+            'errors': len(errors),
+            'throughput': len(latencies) / elapsed if elapsed else 0,
+            'p50': get_percentile(latencies, 50) * 1000,
+            'p95': get_percentile(latencies, 95) * 1000,
+            'p99': get_percentile(latencies, 99) * 1000,
+            'shopify_calls': shopify_request_count / float(len(latencies) or 1),
+        }
+
+    def report(self, results):
+        row = '{:<16}{:>10}{:>8}{:>12}{:>10}{:>10}{:>10}{:>16}'
+        self.stdout.write(row.format(
+            'View', 'Requests', 'Errors', 'Req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'Shopify calls'
+        ))
+        for view, result in results.items():
+            self.stdout.write(row.format(
+                view, result['requests'], result['errors'],
+                '{:.1f}'.format(result['throughput']),
+                '{:.1f}'.format(result['p50']),
+                '{:.1f}'.format(result['p95']),
+                '{:.1f}'.format(result['p99']),
+                '{:.1f}'.format(result['shopify_calls']),
+            ))
+
+    def compare(self, results, baseline_file, tolerance):
+        with open(baseline_file) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = []
+        for view, result in results.items():
+            if view not in baseline:
+                continue
+            allowed_p95 = baseline[view]['p95'] * (1 + tolerance / 100.0)
+            if result['p95'] > allowed_p95:
+                regressions.append('{}: p95 {:.1f} ms, baseline {:.1f} ms'.format(
+                    view, result['p95'], baseline[view]['p95']
+                ))
+
+        if regressions:
+            raise CommandError('Performance regressions:\n{}'.format('\n'.join(regressions)))
+        self.stdout.write('No regressions against {}'.format(baseline_file.name))
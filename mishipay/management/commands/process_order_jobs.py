@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from mishipay.order_jobs import (
+    claim_next_order_job,
+    run_order_job,
+)
+
+
+class Command(BaseCommand):
+    help = 'Process queued order placements and cancellations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once there are no pending jobs instead of waiting for new ones.'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1,
+            help='Seconds to wait before checking again when there are no pending jobs.'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            # Like a request, reopen connections that have outlived
+            # CONN_MAX_AGE or are broken, Eg: after a database restart.
+            close_old_connections()
+            job = claim_next_order_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+
+            job = run_order_job(job)
+            self.stdout.write('Order job {}: {} {}'.format(job.id, job.order_type, job.status))
@@ -0,0 +1,45 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from mishipay.webhooks import (
+    delete_processed_webhook_events,
+    process_webhook_events,
+)
+
+
+class Command(BaseCommand):
+    help = 'Apply received Shopify webhooks to the local tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once there are no unprocessed webhooks instead of waiting for new ones.'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1,
+            help='Seconds to wait before checking again when there are no unprocessed webhooks.'
+        )
+
+    def handle(self, *args, **options):
+        # Events are applied in the order they were received, so a single
+        # worker should run.
+        deleted_at = None
+        while True:
+            close_old_connections()
+            if deleted_at is None or time.monotonic() - deleted_at > 60 * 60:
+                deleted_count = delete_processed_webhook_events()
+                deleted_at = time.monotonic()
+                if deleted_count:
+                    self.stdout.write('Deleted {} processed webhooks'.format(deleted_count))
+
+            processed_count = process_webhook_events()
+            if not processed_count:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write('Processed {} webhooks'.format(processed_count))
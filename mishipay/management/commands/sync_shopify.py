@@ -0,0 +1,46 @@
+import time
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from mishipay.sync import (
+    SYNC_RESOURCES,
+    sync_resource,
+)
+
+
+class Command(BaseCommand):
+    help = 'Load products, variants, inventory levels and orders from Shopify into the local tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Only retrieve what was updated since the last sync of each resource.'
+        )
+        parser.add_argument(
+            '--resource',
+            action='append',
+            dest='resources',
+            choices=SYNC_RESOURCES,
+            help='Resource to sync. May be repeated. Defaults to all of them.'
+        )
+
+    def handle(self, *args, **options):
+        resources = [
+            resource for resource in SYNC_RESOURCES
+            if not options['resources'] or resource in options['resources']
+        ]
+
+        for resource in resources:
+            started_at = time.monotonic()
+
+            def progress(count):
+                self.stdout.write('{}: {} synced'.format(resource, count))
+
+            count, err_msg = sync_resource(resource, incremental=options['incremental'], progress=progress)
+            if err_msg:
+                raise CommandError('{}: {}'.format(resource, err_msg))
+            self.stdout.write(self.style.SUCCESS('{}: {} synced in {:.1f}s'.format(
+                resource, count, time.monotonic() - started_at
+            )))
@@ -0,0 +1,121 @@
+import copy
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+
+_local = threading.local()
+
+
+class Memo(object):
+    """
+        Results of Shopify reads made while handling a single request,
+        Eg: the same products read by a view and by the functions it calls.
+        Values are copied in and out, as callers modify what they get.
+        A value read bypassing the product cache is fresh, and is also
+        served to reads that allow cached values, but not the other way.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, fresh=False):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or (fresh and not entry[1]):
+            return None
+        return copy.deepcopy(entry[0])
+
+    def set(self, key, value, fresh=False):
+        with self.lock:
+            self.entries[key] = (copy.deepcopy(value), fresh)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def get_memo():
+    return getattr(_local, 'memo', None)
+
+
+def start_memo():
+    _local.memo = Memo()
+    return _local.memo
+
+
+def end_memo():
+    _local.memo = None
+
+
+def clear_memo():
+    """
+        Forget all memoized reads of the current request, Eg: after a write
+        to Shopify changed what they would return.
+    """
+
+    memo = get_memo()
+    if memo is not None:
+        memo.clear()
+
+
+@contextmanager
+def memo_scope():
+    """
+        Memoize Shopify reads within the block, Eg: an order job run by the
+        process_order_jobs worker.
+    """
+
+    previous_memo = get_memo()
+    start_memo()
+    try:
+        yield
+    finally:
+        _local.memo = previous_memo
+
+
+def bind_memo(fn):
+    """
+        Wrap a function that is run on another thread (Eg: on a thread
+        pool) so that it shares the memo of the calling thread.
+    """
+
+    memo = get_memo()
+
+    def wrapper(*args, **kwargs):
+        previous_memo = get_memo()
+        _local.memo = memo
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.memo = previous_memo
+    return wrapper
+
+
+def memoize_in_request(get_key):
+    """
+        Decorator for functions returning a (result, err_msg) tuple. Within
+        a memo scope, a successful result is memoized under the key
+        returned by get_key, which is called with the same arguments as the
+        function and returns a tuple of (key, fresh).
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            memo = get_memo()
+            if memo is None:
+                return fn(*args, **kwargs)
+
+            key, fresh = get_key(*args, **kwargs)
+            result = memo.get(key, fresh)
+            if result is not None:
+                return result, ''
+
+            result, err_msg = fn(*args, **kwargs)
+            if not err_msg:
+                memo.set(key, result, fresh)
+            return result, err_msg
+        return wrapper
+    return decorator
@@ -0,0 +1,121 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.deprecation import MiddlewareMixin
+
+from mishipay.instrumentation import (
+    end_request_stats,
+    metrics,
+    start_request_stats,
+)
+from mishipay.memo import (
+    end_memo,
+    start_memo,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_queries_logged_after(queries_log, last_query):
+    """
+        Returns the queries added to queries_log after last_query, which is
+        None if the log was empty. The log is a deque that drops its oldest
+        queries once full, so its length can not tell how many were added.
+    """
+
+    queries = list(queries_log)
+    for index in range(len(queries) - 1, -1, -1):
+        if queries[index] is last_query:
+            return queries[index + 1:]
+    return queries
+
+
+class RequestTimingMiddleware(MiddlewareMixin):
+    """
+        Times every request and counts the Shopify calls and database
+        queries it makes. The totals are sent to the client in a
+        Server-Timing header, logged as a single JSON line and added to the
+        metrics served at /metrics/. The JSON line is logged at DEBUG level.
+        Database queries are counted only if REQUEST_TIMING_DB_QUERIES is
+        True, as they are counted with Django's debug cursor, which keeps
+        the SQL of every query of the request.
+        Should be the first middleware, so that the time of all other
+        middlewares is included.
+    """
+
+    def process_request(self, request):
+        request._timing_started_at = time.monotonic()
+        request._timing_stats = start_request_stats()
+        if settings.REQUEST_TIMING_DB_QUERIES:
+            request._timing_force_debug_cursor = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+            # The log may be in use already, Eg: with DEBUG on or in tests,
+            # so only the queries added during this request are counted.
+            request._timing_last_query = connection.queries_log[-1] if connection.queries_log else None
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_timing_stats'):
+            return response
+
+        duration = time.monotonic() - request._timing_started_at
+        request_stats = end_request_stats() or request._timing_stats
+
+        db_query_count = 0
+        db_time = 0
+        if settings.REQUEST_TIMING_DB_QUERIES:
+            queries = get_queries_logged_after(connection.queries_log, request._timing_last_query)
+            db_query_count = len(queries)
+            db_time = sum(float(query['time']) for query in queries)
+            connection.force_debug_cursor = request._timing_force_debug_cursor
+            if not connection.queries_logged:
+                # Nobody else reads the log, so do not let it grow.
+                connection.queries_log.clear()
+
+        response['Server-Timing'] = ', '.join([
+            'shopify;dur={:.1f};desc="{} calls"'.format(request_stats.shopify_time * 1000, request_stats.shopify_call_count),
+            'db;dur={:.1f};desc="{} queries"'.format(db_time * 1000, db_query_count),
+            'total;dur={:.1f}'.format(duration * 1000),
+        ])
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        view = resolver_match.url_name if resolver_match and resolver_match.url_name else 'unknown'
+        metrics.record_request(
+            view, response.status_code, duration,
+            request_stats.shopify_call_count, request_stats.shopify_time,
+            db_query_count, db_time
+        )
+        logger.debug(json.dumps({
+            'event': 'request',
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'duration': round(duration, 4),
+            'shopify_calls': request_stats.shopify_call_count,
+            'shopify_time': round(request_stats.shopify_time, 4),
+            'shopify_endpoints': sorted(set(
+                shopify_call['endpoint'] for shopify_call in request_stats.shopify_calls
+            )),
+            'db_queries': db_query_count,
+            'db_time': round(db_time, 4),
+        }))
+        return response
+
+
+class ShopifyMemoMiddleware(MiddlewareMixin):
+    """
+        Gives every request its own memo of Shopify reads, so that the
+        same products or orders are retrieved at most once per request.
+        See mishipay/memo.py
+    """
+
+    def process_request(self, request):
+        start_memo()
+
+    def process_response(self, request, response):
+        end_memo()
+        return response
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 10:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mishipay', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shopify_product_id', models.BigIntegerField(unique=True)),
+                ('title', models.CharField(max_length=255)),
+                ('body_html', models.TextField(blank=True)),
+                ('image_src', models.URLField(blank=True, max_length=1024)),
+                ('variant_id', models.BigIntegerField()),
+                ('inventory_item_id', models.BigIntegerField(db_index=True)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('inventory_quantity', models.IntegerField(default=0)),
+                ('in_stock', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['in_stock', 'shopify_product_id'], name='mishipay_pr_in_stoc_a40cc3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['in_stock', 'price'], name='mishipay_pr_in_stoc_4a1938_idx'),
+        ),
+    ]
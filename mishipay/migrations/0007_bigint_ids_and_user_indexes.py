@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mishipay', '0006_cartitem_snapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cartitem',
+            name='product_id',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='shopify_order_id',
+            field=models.BigIntegerField(unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='cartitem',
+            index=models.Index(fields=['user', 'product_id', 'quantity'], name='mishipay_ca_user_id_abb6c4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'shopify_order_id'], name='mishipay_or_user_id_797d38_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='mishipay_or_user_id_d96e54_idx'),
+        ),
+    ]
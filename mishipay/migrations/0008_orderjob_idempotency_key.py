@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:10
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mishipay', '0007_bigint_ids_and_user_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderjob',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='orderjob',
+            unique_together=set([('user', 'idempotency_key')]),
+        ),
+    ]
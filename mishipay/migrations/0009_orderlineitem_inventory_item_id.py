@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mishipay', '0008_orderjob_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderlineitem',
+            name='inventory_item_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mishipay', '0010_webhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shopify_variant_id', models.BigIntegerField(unique=True)),
+                ('title', models.CharField(max_length=255)),
+                ('inventory_item_id', models.BigIntegerField(db_index=True)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('inventory_quantity', models.IntegerField(default=0)),
+                ('position', models.IntegerField(default=1)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='mishipay.Product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(max_length=32, unique=True)),
+                ('synced_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mishipay', '0013_webhookevent_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='synced_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,10 +1,28 @@
 from django.db import models
+from django.utils import timezone
 from custom_user.models import User
+from mishipay.constants import (
+    ORDER_TYPE_PLACED,
+    ORDER_TYPE_CANCELLED,
+    ORDER_JOB_STATUS_PENDING,
+    ORDER_JOB_STATUS_RUNNING,
+    ORDER_JOB_STATUS_SUCCEEDED,
+    ORDER_JOB_STATUS_FAILED,
+)
 
 
 class Order(models.Model):
+    """
+        A Shopify order placed by a user. Fields other than the ids are a
+        local copy of the Shopify order, kept up to date when the order is
+        placed or cancelled and by the orders/updated webhook, so that
+        orders can be listed without calling Shopify. synced_at is None
+        for orders that have not been copied yet. Until then, created_at
+        is the time the order was placed locally.
+    """
 
-    shopify_order_id = models.IntegerField(
+    # Shopify ids are 64 bit.
+    shopify_order_id = models.BigIntegerField(
         unique=True
     )
 
@@ -14,13 +32,122 @@ class Order(models.Model):
         on_delete=models.CASCADE
     )
 
+    email = models.CharField(
+        max_length=254,
+        blank=True
+    )
+
+    financial_status = models.CharField(
+        max_length=32,
+        blank=True
+    )
+
+    fulfillment_status = models.CharField(
+        max_length=32,
+        blank=True
+    )
+
+    subtotal_price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        null=True,
+        blank=True
+    )
+
+    total_line_items_price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        null=True,
+        blank=True
+    )
+
+    total_price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        null=True,
+        blank=True
+    )
+
+    created_at = models.DateTimeField(
+        default=timezone.now
+    )
+
+    cancelled_at = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
+    synced_at = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
+    class Meta:
+        indexes = [
+            # A user's order ids, and the order being cancelled.
+            models.Index(fields=['user', 'shopify_order_id']),
+            # My Orders pages, newest first.
+            models.Index(fields=['user', 'created_at', 'id']),
+        ]
+
     def __str__(self):
         return "{} | {}".format(self.user.username, self.shopify_order_id)
 
 
+class OrderLineItem(models.Model):
+    """
+        Local copy of a line item of a Shopify order.
+    """
+
+    order = models.ForeignKey(
+        Order,
+        related_name='line_items',
+        on_delete=models.CASCADE
+    )
+
+    shopify_line_item_id = models.BigIntegerField()
+
+    product_id = models.BigIntegerField(
+        null=True,
+        blank=True
+    )
+
+    variant_id = models.BigIntegerField(
+        null=True,
+        blank=True
+    )
+
+    # Not part of Shopify's line item. Kept so that an order can be
+    # cancelled and its inventory restored without retrieving products.
+    inventory_item_id = models.BigIntegerField(
+        null=True,
+        blank=True
+    )
+
+    title = models.CharField(
+        max_length=255
+    )
+
+    quantity = models.IntegerField()
+
+    price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2
+    )
+
+    def __str__(self):
+        return "Order Line Item: {} | {}".format(self.order.shopify_order_id, self.title)
+
+
 class CartItem(models.Model):
+    """
+        A product in a user's cart. Product details are a snapshot taken
+        when the product was added, so that the cart is rendered without
+        calling Shopify. See mishipay/cart.py
+    """
 
-    product_id = models.IntegerField()
+    # Shopify ids are 64 bit.
+    product_id = models.BigIntegerField()
 
     quantity = models.IntegerField(
         default=1
@@ -32,11 +159,349 @@ class CartItem(models.Model):
         on_delete=models.CASCADE
     )
 
+    product_title = models.CharField(
+        max_length=255,
+        blank=True,
+        default=''
+    )
+
+    price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        null=True,
+        blank=True
+    )
+
+    variant_id = models.BigIntegerField(
+        null=True,
+        blank=True
+    )
+
+    inventory_item_id = models.BigIntegerField(
+        null=True,
+        blank=True
+    )
+
+    snapshot_at = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
     class Meta:
         # Ideally this should be ('product_id', 'varient_id', 'user')
         # but since we are concerned about varients at the moment, we
         # ignore that as of now.
         unique_together = ('product_id', 'user')
+        indexes = [
+            # A user's cart, Eg: which listed products are in cart.
+            models.Index(fields=['user', 'product_id', 'quantity']),
+        ]
+
+    def __str__(self):
+        return "Cart Item: {} | {}".format(self.product_title or self.product_id, self.user.username)
+
+
+class Product(models.Model):
+    """
+        Local copy of a Shopify product, holding only what is needed to
+        list products. Varients have not been considered in scope of this
+        application, so the first varient's details are stored.
+    """
+
+    shopify_product_id = models.BigIntegerField(
+        unique=True
+    )
+
+    title = models.CharField(
+        max_length=255
+    )
+
+    body_html = models.TextField(
+        blank=True
+    )
+
+    image_src = models.URLField(
+        max_length=1024,
+        blank=True
+    )
+
+    variant_id = models.BigIntegerField()
+
+    # Indexed because stock updates look products up by inventory item.
+    inventory_item_id = models.BigIntegerField(
+        db_index=True
+    )
+
+    price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2
+    )
+
+    inventory_quantity = models.IntegerField(
+        default=0
+    )
+
+    in_stock = models.BooleanField(
+        default=False
+    )
+
+    # When a full load of the catalog last saw the product. Products it
+    # did not see no longer exist in the store. See refresh_catalog
+    synced_at = models.DateTimeField(
+        default=timezone.now
+    )
+
+    updated_at = models.DateTimeField(
+        auto_now=True
+    )
+
+    class Meta:
+        indexes = [
+            # Product listing pages, in Shopify order.
+            models.Index(fields=['in_stock', 'shopify_product_id']),
+            # Product listing pages, by price.
+            models.Index(fields=['in_stock', 'price']),
+        ]
+
+    def __str__(self):
+        return "{} | {}".format(self.shopify_product_id, self.title)
+
+
+class ProductVariant(models.Model):
+    """
+        Local copy of a variant of a Shopify product, loaded by the
+        sync_shopify management command. The first variant of a product is
+        also kept on the Product itself, as the rest of the application
+        only deals with it.
+    """
+
+    product = models.ForeignKey(
+        Product,
+        related_name='variants',
+        on_delete=models.CASCADE
+    )
+
+    shopify_variant_id = models.BigIntegerField(
+        unique=True
+    )
+
+    title = models.CharField(
+        max_length=255
+    )
+
+    # Indexed because stock updates look variants up by inventory item.
+    inventory_item_id = models.BigIntegerField(
+        db_index=True
+    )
+
+    price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2
+    )
+
+    inventory_quantity = models.IntegerField(
+        default=0
+    )
+
+    position = models.IntegerField(
+        default=1
+    )
+
+    updated_at = models.DateTimeField(
+        auto_now=True
+    )
+
+    def __str__(self):
+        return "{} | {}".format(self.shopify_variant_id, self.title)
+
+
+class OrderJob(models.Model):
+    """
+        An order placement or cancellation queued to be processed by the
+        process_order_jobs management command, off the request thread.
+        For a placement, the payload is a JSON map of product id to
+        quantity. On success, the result is the JSON of the Shopify order.
+        A placement holds an idempotency key, so that a repeated request
+        reuses the job instead of placing the order again. A job left
+        running for longer than ORDER_JOB_TIMEOUT seconds, Eg: by a worker
+        that was killed, is failed. See mishipay/order_jobs.py
+    """
+
+    ORDER_TYPE_CHOICES = (
+        (ORDER_TYPE_PLACED, 'Place Order'),
+        (ORDER_TYPE_CANCELLED, 'Cancel Order'),
+    )
+
+    STATUS_CHOICES = (
+        (ORDER_JOB_STATUS_PENDING, 'Pending'),
+        (ORDER_JOB_STATUS_RUNNING, 'Running'),
+        (ORDER_JOB_STATUS_SUCCEEDED, 'Succeeded'),
+        (ORDER_JOB_STATUS_FAILED, 'Failed'),
+    )
+
+    order_type = models.CharField(
+        max_length=16,
+        choices=ORDER_TYPE_CHOICES
+    )
+
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=ORDER_JOB_STATUS_PENDING
+    )
+
+    user = models.ForeignKey(
+        User,
+        related_name='order_jobs',
+        on_delete=models.CASCADE
+    )
+
+    shopify_order_id = models.BigIntegerField(
+        null=True,
+        blank=True
+    )
+
+    payload = models.TextField(
+        blank=True
+    )
+
+    result = models.TextField(
+        blank=True
+    )
+
+    err_msg = models.CharField(
+        max_length=1024,
+        blank=True
+    )
+
+    idempotency_key = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True
+    )
+
+    # When a worker started running the job.
+    claimed_at = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
+    created_at = models.DateTimeField(
+        auto_now_add=True
+    )
+
+    updated_at = models.DateTimeField(
+        auto_now=True
+    )
+
+    class Meta:
+        # Concurrent duplicate requests can not both create a job.
+        unique_together = ('user', 'idempotency_key')
+        indexes = [
+            # Workers pick the oldest pending job.
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return "Order Job: {} | {} | {}".format(self.order_type, self.status, self.user.username)
+
+
+class InventoryLevel(models.Model):
+    """
+        Local copy of a Shopify inventory level. Inventory levels can only
+        be adjusted with the id of the location the item is stocked at,
+        which almost never changes. Keeping it locally saves a call to
+        Shopify on every order placement and cancellation.
+    """
+
+    inventory_item_id = models.BigIntegerField(
+        unique=True
+    )
+
+    location_id = models.BigIntegerField()
+
+    available = models.IntegerField(
+        default=0
+    )
+
+    updated_at = models.DateTimeField(
+        auto_now=True
+    )
+
+    def __str__(self):
+        return "Inventory Level: {} | {}".format(self.inventory_item_id, self.available)
+
+
+class WebhookEvent(models.Model):
+    """
+        A Shopify webhook, stored as received so that it is acknowledged
+        at once and applied to the local tables by the process_webhooks
+        management command. Shopify may deliver a webhook more than once
+        with the same webhook id, which is unique, so it is stored once.
+        processed_at is None until the event has been applied, or until
+        applying it has failed WEBHOOK_MAX_ATTEMPTS times. A failed event
+        is retried from next_attempt_at. See mishipay/webhooks.py
+    """
+
+    webhook_id = models.CharField(
+        max_length=64,
+        unique=True
+    )
+
+    topic = models.CharField(
+        max_length=64
+    )
+
+    payload = models.TextField()
+
+    err_msg = models.CharField(
+        max_length=1024,
+        blank=True
+    )
+
+    # Number of failed attempts to apply the event.
+    attempts = models.PositiveIntegerField(
+        default=0
+    )
+
+    next_attempt_at = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
+    received_at = models.DateTimeField(
+        auto_now_add=True
+    )
+
+    processed_at = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
+    class Meta:
+        indexes = [
+            # The worker picks the oldest unprocessed events.
+            models.Index(fields=['processed_at', 'id']),
+        ]
+
+    def __str__(self):
+        return "Webhook Event: {} | {}".format(self.topic, self.webhook_id)
+
+
+class SyncCheckpoint(models.Model):
+    """
+        When a Shopify resource (Eg: 'products') was last synced by the
+        sync_shopify management command. An incremental sync retrieves only
+        the items updated since synced_at, which is the time the last
+        complete sync started.
+    """
+
+    resource = models.CharField(
+        max_length=32,
+        unique=True
+    )
+
+    synced_at = models.DateTimeField()
 
     def __str__(self):
-        return "Cart Item: {} | {}".format(self.product_title, self.user.username)
+        return "Sync Checkpoint: {} | {}".format(self.resource, self.synced_at)
@@ -0,0 +1,319 @@
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import (
+    DatabaseError,
+    IntegrityError,
+    transaction,
+)
+from django.db.models import Q
+from django.utils import timezone
+from mishipay.models import (
+    CartItem,
+    InventoryLevel,
+    OrderJob
+)
+from mishipay.constants import (
+    ORDER_TYPE_PLACED,
+    ORDER_TYPE_CANCELLED,
+    ORDER_JOB_STATUS_PENDING,
+    ORDER_JOB_STATUS_RUNNING,
+    ORDER_JOB_STATUS_SUCCEEDED,
+    ORDER_JOB_STATUS_FAILED,
+)
+from mishipay.shopify_utils import (
+    create_order,
+    cancel_order,
+    save_created_order,
+    try_save_inventory_levels,
+)
+from mishipay.memo import memo_scope
+from mishipay.shopify_client import (
+    SHOPIFY_UNAVAILABLE_MSG,
+    is_shopify_available,
+)
+from mishipay.shopify_async import (
+    gather,
+    get_inventory_levels_async,
+    get_products_async,
+    run_sync,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_idempotency_key(cart_product_id_quantity_map=None, client_key=None):
+    """
+        Returns the idempotency key of an order placement. The key sent by
+        the client is used if there is one. Otherwise the key is derived
+        from the cart contents, so that the same cart is not ordered twice
+        within ORDER_IDEMPOTENCY_WINDOW seconds.
+    """
+
+    if client_key:
+        key = 'client:{}'.format(client_key)
+    else:
+        key = 'cart:{}'.format(json.dumps(
+            sorted((int(product_id), quantity) for product_id, quantity in cart_product_id_quantity_map.items())
+        ))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def get_idempotent_order_job(user, idempotency_key):
+    """
+        Returns the order placement of the user with the given idempotency
+        key, if it was created within ORDER_IDEMPOTENCY_WINDOW seconds and
+        has not failed. Otherwise returns None.
+    """
+
+    return OrderJob.objects.filter(
+        user=user,
+        idempotency_key=idempotency_key,
+        created_at__gte=timezone.now() - timedelta(seconds=settings.ORDER_IDEMPOTENCY_WINDOW)
+    ).exclude(
+        status=ORDER_JOB_STATUS_FAILED
+    ).first()
+
+
+def enqueue_order_placement(user, cart_product_id_quantity_map, idempotency_key=None):
+    """
+        Queue an order for the given products. cart_product_id_quantity_map
+        is a dict of product id to quantity.
+        If a placement with the same idempotency key (see
+        get_idempotency_key) was queued within ORDER_IDEMPOTENCY_WINDOW
+        seconds, that job is returned instead, whether it is still pending,
+        running or has succeeded. A failed placement, or one outside the
+        window, releases its key so that the order can be placed again.
+    """
+
+    if idempotency_key is None:
+        idempotency_key = get_idempotency_key(cart_product_id_quantity_map)
+
+    for attempt in range(2):
+        job = get_idempotent_order_job(user, idempotency_key)
+        if job is not None:
+            return job
+
+        OrderJob.objects.filter(
+            Q(status=ORDER_JOB_STATUS_FAILED) |
+            Q(created_at__lt=timezone.now() - timedelta(seconds=settings.ORDER_IDEMPOTENCY_WINDOW)),
+            user=user,
+            idempotency_key=idempotency_key
+        ).update(idempotency_key=None)
+        try:
+            with transaction.atomic():
+                job = OrderJob.objects.create(
+                    order_type=ORDER_TYPE_PLACED,
+                    user=user,
+                    payload=json.dumps(cart_product_id_quantity_map),
+                    idempotency_key=idempotency_key
+                )
+            break
+        except IntegrityError:
+            # A concurrent request with the same key created its job
+            # first. Return that job on the next attempt.
+            job = None
+
+    if job is None:
+        job = get_idempotent_order_job(user, idempotency_key)
+        if job is not None:
+            return job
+        raise IntegrityError('Could not queue order with idempotency key {}'.format(idempotency_key))
+
+    if settings.ORDER_JOBS_ALWAYS_EAGER:
+        run_order_job(job)
+    return job
+
+
+def enqueue_order_cancellation(user, shopify_order_id):
+    """
+        Queue the cancellation of an order.
+    """
+
+    job = OrderJob.objects.create(
+        order_type=ORDER_TYPE_CANCELLED,
+        user=user,
+        shopify_order_id=shopify_order_id
+    )
+    if settings.ORDER_JOBS_ALWAYS_EAGER:
+        run_order_job(job)
+    return job
+
+
+# Error message of jobs that were left running. The order may or may not
+# have been placed or cancelled on Shopify.
+ORDER_JOB_TIMED_OUT_MSG = 'Your request could not be completed. Please check My Orders before trying again.'
+
+
+def fail_timed_out_order_jobs():
+    """
+        Fail jobs that have been running for longer than ORDER_JOB_TIMEOUT
+        seconds, Eg: as their worker crashed or was killed. They are not
+        run again, as they may have placed or cancelled the order on
+        Shopify already. Failing them releases their idempotency key, so
+        that the user can try again. Returns the number of jobs failed.
+        Placements that recorded their Shopify order are succeeded instead,
+        the local copy of their order is created and their products are
+        removed from the cart.
+        See record_created_order
+    """
+
+    timed_out_at = timezone.now() - timedelta(seconds=settings.ORDER_JOB_TIMEOUT)
+    timed_out_jobs = OrderJob.objects.filter(
+        Q(claimed_at__lt=timed_out_at) |
+        # Jobs claimed before claimed_at was recorded.
+        Q(claimed_at__isnull=True, updated_at__lt=timed_out_at),
+        status=ORDER_JOB_STATUS_RUNNING
+    )
+
+    placed_jobs = timed_out_jobs.filter(
+        order_type=ORDER_TYPE_PLACED,
+        shopify_order_id__isnull=False
+    ).select_related('user')
+    for job in placed_jobs:
+        succeeded = OrderJob.objects.filter(
+            id=job.id,
+            status=ORDER_JOB_STATUS_RUNNING
+        ).update(status=ORDER_JOB_STATUS_SUCCEEDED, updated_at=timezone.now())
+        if succeeded:
+            logger.warning('Order job %s timed out after placing order %s', job.id, job.shopify_order_id)
+            save_created_order(job.user, json.loads(job.result))
+            CartItem.objects.filter(
+                user=job.user,
+                product_id__in=[int(product_id) for product_id in json.loads(job.payload)]
+            ).delete()
+
+    return timed_out_jobs.update(
+        status=ORDER_JOB_STATUS_FAILED,
+        err_msg=ORDER_JOB_TIMED_OUT_MSG,
+        updated_at=timezone.now()
+    )
+
+
+def claim_next_order_job():
+    """
+        Returns the oldest pending job after marking it as running, or None
+        if there are no pending jobs. A job is claimed with a conditional
+        update, so that two workers never process the same job. Jobs that
+        timed out are failed first. See fail_timed_out_order_jobs
+    """
+
+    timed_out_count = fail_timed_out_order_jobs()
+    if timed_out_count:
+        logger.warning('Failed %s order jobs that timed out', timed_out_count)
+
+    pending_job_ids = OrderJob.objects.filter(
+        status=ORDER_JOB_STATUS_PENDING
+    ).order_by('created_at').values_list('id', flat=True)
+
+    for job_id in pending_job_ids[:10]:
+        claimed = OrderJob.objects.filter(
+            id=job_id,
+            status=ORDER_JOB_STATUS_PENDING
+        ).update(status=ORDER_JOB_STATUS_RUNNING, claimed_at=timezone.now())
+        if claimed:
+            return OrderJob.objects.select_related('user').get(id=job_id)
+    return None
+
+
+def run_order_job(job):
+    """
+        Place or cancel the order of a job and record the outcome. While
+        Shopify is unavailable, jobs fail at once with a message asking the
+        user to try again later.
+    """
+
+    try:
+        with memo_scope():
+            if not is_shopify_available():
+                order, err_msg = None, SHOPIFY_UNAVAILABLE_MSG
+            elif job.order_type == ORDER_TYPE_PLACED:
+                order, err_msg = place_order(job.user, json.loads(job.payload), job=job)
+            else:
+                order, err_msg = cancel_order(job.shopify_order_id)
+    except Exception:
+        logger.exception('Order job %s failed', job.id)
+        order, err_msg = None, 'Something went wrong. Please try again.'
+
+    if err_msg:
+        job.status = ORDER_JOB_STATUS_FAILED
+        job.err_msg = err_msg[:1024]
+    else:
+        job.status = ORDER_JOB_STATUS_SUCCEEDED
+        job.shopify_order_id = order['id']
+        job.result = json.dumps(order)
+    job.save(update_fields=['status', 'err_msg', 'shopify_order_id', 'result', 'updated_at'])
+    return job
+
+
+def record_created_order(job, order):
+    """
+        Record the Shopify order of a placement job as soon as it is
+        created, before the local copy of the order is written. A job
+        that is lost after this point is not failed, as that would let the
+        user place the order again. See fail_timed_out_order_jobs
+    """
+
+    job.shopify_order_id = order['id']
+    job.result = json.dumps(order)
+    try:
+        OrderJob.objects.filter(id=job.id).update(
+            shopify_order_id=job.shopify_order_id,
+            result=job.result,
+            updated_at=timezone.now()
+        )
+    except DatabaseError:
+        logger.exception('Could not record order %s of order job %s', job.shopify_order_id, job.id)
+
+
+def place_order(user, cart_product_id_quantity_map, job=None):
+    """
+        Place an order on the Shopify store for the given products and
+        remove them from the user's cart. The order is recorded in job, if
+        passed, once it is created. See record_created_order
+    """
+
+    # JSON object keys are strings.
+    cart_product_id_quantity_map = {
+        int(product_id): quantity for product_id, quantity in cart_product_id_quantity_map.items()
+    }
+
+    # Inventory levels of items that have not been ordered before are
+    # needed for their location ids. They are retrieved along with the
+    # products, using the inventory item ids stored with the cart items.
+    inventory_item_ids = set(CartItem.objects.filter(
+        user=user,
+        product_id__in=cart_product_id_quantity_map.keys(),
+        inventory_item_id__isnull=False
+    ).values_list('inventory_item_id', flat=True))
+    inventory_item_ids = inventory_item_ids - set(InventoryLevel.objects.filter(
+        inventory_item_id__in=inventory_item_ids
+    ).values_list('inventory_item_id', flat=True))
+
+    # Prices and stock must be current at checkout, so the
+    # product cache is bypassed.
+    (cart_shopify_products, err_msg), (inventory_levels, inventory_levels_err_msg) = run_sync(gather(
+        get_products_async(ids=cart_product_id_quantity_map.keys(), use_cache=False),
+        get_inventory_levels_async(inventory_item_ids)
+    ))
+    if err_msg:
+        return None, err_msg
+    if not inventory_levels_err_msg:
+        try_save_inventory_levels(inventory_levels)
+
+    for product in cart_shopify_products:
+        product['quantity'] = cart_product_id_quantity_map[product['id']]
+
+    on_created = (lambda order: record_created_order(job, order)) if job else None
+    order, err_msg = create_order(user, cart_shopify_products, on_created=on_created)
+    if err_msg:
+        return None, err_msg
+
+    CartItem.objects.filter(
+        user=user,
+        product_id__in=cart_product_id_quantity_map.keys()
+    ).delete()
+    return order, ''
@@ -0,0 +1,14 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class ProductCursorPagination(CursorPagination):
+    """
+        Cursor pagination for product listing APIs. Unlike page number
+        pagination, no COUNT or OFFSET query is made, so the cost of a
+        page does not grow with the size of the catalog.
+    """
+    ordering = 'shopify_product_id'
+    page_size = settings.PRODUCT_LISTING_PAGE_SIZE
+    page_size_query_param = 'limit'
+    max_page_size = settings.PRODUCT_LISTING_MAX_PAGE_SIZE
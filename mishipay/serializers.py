@@ -1,5 +1,14 @@
-from rest_framework.serializers import ModelSerializer
-from mishipay.models import CartItem
+from rest_framework.serializers import (
+    IntegerField,
+    ListField,
+    ModelSerializer,
+    Serializer,
+)
+from mishipay.models import (
+    CartItem,
+    OrderJob,
+    Product
+)
 
 
 class CartItemSerializer(ModelSerializer):
@@ -7,3 +16,40 @@ class CartItemSerializer(ModelSerializer):
     class Meta:
         model = CartItem
         fields = ('id', 'product_id', 'quantity', 'user')
+
+
+class AddToCartSerializer(Serializer):
+    """
+        Input of add to cart. The user is the requesting user, so it is
+        not part of the input and needs no validation query.
+    """
+    product_id = IntegerField(min_value=1)
+    quantity = IntegerField(min_value=1, default=1)
+
+
+class CartUpsertSerializer(Serializer):
+    product_id = IntegerField(min_value=1)
+    quantity = IntegerField(min_value=0)
+
+
+class CartChangesSerializer(Serializer):
+    """
+        A batch of changes to a cart. A product is added to the cart or has
+        its quantity set by an upsert. An upsert with quantity 0 removes it.
+    """
+    upserts = CartUpsertSerializer(many=True, required=False, default=[])
+    deletes = ListField(child=IntegerField(min_value=1), required=False, default=[])
+
+
+class ProductSerializer(ModelSerializer):
+
+    class Meta:
+        model = Product
+        fields = ('shopify_product_id', 'title', 'price', 'inventory_quantity', 'image_src')
+
+
+class OrderJobSerializer(ModelSerializer):
+
+    class Meta:
+        model = OrderJob
+        fields = ('id', 'order_type', 'status', 'shopify_order_id', 'err_msg')
@@ -0,0 +1,120 @@
+"""
+    asyncio counterparts of the functions in shopify_utils, so that
+    independent Shopify calls of a view run concurrently. They keep the
+    tuple contract of shopify_utils: (result, err_msg).
+    Calls are made by the functions of shopify_utils on the Shopify thread
+    pool (see shopify_client.get_executor), so they share its connection
+    pool, rate limiting and retries. Views, which are synchronous, run
+    coroutines with run_sync.
+
+    Usage:
+        (products, err_msg), (inventory_levels, err_msg) = run_sync(gather(
+            get_products_async(ids=product_ids),
+            get_inventory_levels_async(inventory_item_ids)
+        ))
+"""
+import asyncio
+from functools import partial
+from mishipay.constants import SHOPIFY_PAGE_LIMIT
+from mishipay.models import Order
+from mishipay.shopify_client import get_executor
+from mishipay.shopify_utils import (
+    get_inventory_levels,
+    get_orders,
+    get_products,
+)
+
+
+def run_sync(coroutine):
+    """
+        Run a coroutine to completion from synchronous code and return its
+        result. A new event loop is used for every call.
+    """
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def gather(*coroutines):
+    """
+        Run coroutines concurrently and return their results in order.
+    """
+
+    return await asyncio.gather(*coroutines)
+
+
+async def run_in_shopify_executor(fn, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_executor(), partial(fn, *args, **kwargs))
+
+
+async def run_in_batches(fn, ids, **kwargs):
+    """
+        Call fn with batches of at most SHOPIFY_PAGE_LIMIT ids concurrently
+        and merge the results. Returns an empty list along with the first
+        error message if any batch fails.
+    """
+
+    ids = [str(_id) for _id in ids]
+    batches = [ids[index:index + SHOPIFY_PAGE_LIMIT] for index in range(0, len(ids), SHOPIFY_PAGE_LIMIT)]
+    results = await asyncio.gather(*[
+        run_in_shopify_executor(fn, batch, **kwargs) for batch in batches
+    ])
+
+    items = []
+    for batch_items, err_msg in results:
+        if err_msg:
+            return [], err_msg
+        items.extend(batch_items)
+    return items, ''
+
+
+async def get_products_async(ids=[], use_cache=True):
+    """
+        Counterpart of shopify_utils.get_products. Products with more ids
+        than fit in a page are retrieved in concurrent batches.
+    """
+
+    if not ids:
+        return await run_in_shopify_executor(get_products, use_cache=use_cache)
+    return await run_in_batches(get_products, ids, use_cache=use_cache)
+
+
+async def get_orders_async(shopify_order_ids=[], user=None):
+    """
+        Counterpart of shopify_utils.get_orders. Orders with more ids than
+        fit in a page are retrieved in concurrent batches.
+    """
+
+    shopify_order_ids = [str(shopify_order_id) for shopify_order_id in shopify_order_ids]
+    if user:
+        user_shopify_order_ids = set(
+            str(user_shopify_order_id) for user_shopify_order_id in
+            Order.objects.filter(user=user).values_list('shopify_order_id', flat=True)
+        )
+        shopify_order_ids = [
+            shopify_order_id for shopify_order_id in shopify_order_ids
+            if shopify_order_id in user_shopify_order_ids
+        ] if shopify_order_ids else list(user_shopify_order_ids)
+        if not shopify_order_ids:
+            return [], ''
+
+    if not shopify_order_ids:
+        # All orders are retrieved page after page, as each page links
+        # to the next.
+        return await run_in_shopify_executor(get_orders)
+    return await run_in_batches(lambda batch: get_orders(shopify_order_ids=batch), shopify_order_ids)
+
+
+async def get_inventory_levels_async(inventory_item_ids):
+    """
+        Counterpart of shopify_utils.get_inventory_levels, in concurrent
+        batches.
+    """
+
+    if not inventory_item_ids:
+        return [], ''
+    return await run_in_batches(get_inventory_levels, inventory_item_ids)
@@ -0,0 +1,401 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+from mishipay.instrumentation import (
+    bind_request_stats,
+    metrics,
+    record_shopify_call,
+)
+from mishipay.memo import (
+    bind_memo,
+    clear_memo,
+)
+
+
+# Priorities of Shopify calls. Checkout calls (Eg: inventory adjustments,
+# order creation) may use the whole rate limit bucket, while other calls
+# leave SHOPIFY_RATE_LIMIT_RESERVED calls free for them.
+PRIORITY_CHECKOUT = 'checkout'
+PRIORITY_DEFAULT = 'default'
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+SHOPIFY_UNAVAILABLE_MSG = 'Shopify is currently unavailable. Please try again in a few minutes.'
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShopifyUnavailable(RequestException):
+    """
+        Raised instead of calling Shopify while the circuit breaker is
+        open. It is a RequestException, so callers handle it like any
+        other failed call.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ShopifyUnavailable, self).__init__(SHOPIFY_UNAVAILABLE_MSG, *args, **kwargs)
+
+
+class LeakyBucket(object):
+    """
+        Tracks Shopify's leaky bucket rate limit. Every call adds one to the
+        bucket, which leaks at a fixed rate. Shopify reports the level of
+        the bucket in the X-Shopify-Shop-Api-Call-Limit header (Eg: '32/40')
+        of every response, which replaces our own estimate. The header covers
+        calls made by all processes, so all of them throttle together.
+    """
+
+    def __init__(self, size, leak_rate, reserved):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.reserved = reserved
+        self.level = 0
+        self.leaked_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _leak(self):
+        now = time.monotonic()
+        self.level = max(0, self.level - (now - self.leaked_at) * self.leak_rate)
+        self.leaked_at = now
+
+    def acquire(self, priority=PRIORITY_DEFAULT):
+        """
+            Wait until the bucket has room for a call of the given priority
+            and count the call. Waits at most SHOPIFY_RATE_LIMIT_MAX_WAIT
+            seconds, after which the call is made anyway and is retried if
+            Shopify responds with a 429.
+        """
+
+        limit = self.size - 1
+        if priority != PRIORITY_CHECKOUT:
+            limit = limit - self.reserved
+
+        deadline = time.monotonic() + settings.SHOPIFY_RATE_LIMIT_MAX_WAIT
+        while True:
+            with self.lock:
+                self._leak()
+                if self.level < limit or time.monotonic() >= deadline:
+                    self.level = self.level + 1
+                    return
+                wait = (self.level - limit + 1) / self.leak_rate
+            time.sleep(min(wait, max(0, deadline - time.monotonic())))
+
+    def update(self, call_limit_header):
+        """
+            Update the level and size of the bucket from the
+            X-Shopify-Shop-Api-Call-Limit header of a response.
+        """
+
+        try:
+            level, size = [int(value) for value in call_limit_header.split('/')]
+        except (AttributeError, ValueError):
+            return
+        with self.lock:
+            self.level = level
+            self.size = size
+            self.leaked_at = time.monotonic()
+
+    def fill(self):
+        """
+            Mark the bucket as full, Eg: when Shopify responds with a 429
+            without reporting the level of the bucket.
+        """
+
+        with self.lock:
+            self.level = self.size
+            self.leaked_at = time.monotonic()
+
+
+class CircuitBreaker(object):
+    """
+        Stops calling Shopify while it is down or slow, so that requests
+        fail fast instead of each waiting for a timeout. The breaker opens
+        after failure_threshold consecutive failed calls. A call fails if
+        it raises (Eg: a timeout), gets a 5xx response or takes longer than
+        latency_budget seconds. 429s are handled by the rate limit and do
+        not count.
+        While open, calls raise ShopifyUnavailable without being made.
+        After reset_timeout seconds a single trial call is let through.
+        Its success closes the breaker and its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold, latency_budget, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.latency_budget = latency_budget
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_call = False
+        self.lock = threading.Lock()
+
+    def _refuses_calls(self):
+        return self.opened_at is not None and (
+            self.trial_call or time.monotonic() - self.opened_at < self.reset_timeout
+        )
+
+    @property
+    def is_open(self):
+        """
+            True while calls are refused.
+        """
+
+        with self.lock:
+            return self._refuses_calls()
+
+    def before_call(self):
+        """
+            Raise ShopifyUnavailable if calls are refused. Otherwise the
+            call may be made, and must be recorded with record_call.
+        """
+
+        with self.lock:
+            if self._refuses_calls():
+                raise ShopifyUnavailable()
+            if self.opened_at is not None:
+                self.trial_call = True
+
+    def record_call(self, status_code, latency):
+        """
+            Record the outcome of a call. status_code is None if the call
+            failed without a response.
+        """
+
+        failed = status_code is None or status_code >= 500 or latency > self.latency_budget
+        with self.lock:
+            if not failed:
+                if self.opened_at is not None:
+                    logger.warning('Shopify circuit breaker closed')
+                    metrics.set_gauge('shopify_circuit_open', {}, 0)
+                self.failures = 0
+                self.opened_at = None
+                self.trial_call = False
+                return
+
+            self.failures = self.failures + 1
+            if self.trial_call or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    logger.warning('Shopify circuit breaker opened after %s failed calls', self.failures)
+                    metrics.set_gauge('shopify_circuit_open', {}, 1)
+                self.opened_at = time.monotonic()
+                self.trial_call = False
+
+
+class ShopifySession(Session):
+    """
+        A requests Session for the Shopify Admin API. Connections are
+        pooled and kept alive between calls, so only the first call of
+        a process pays for the TCP + TLS handshake. Shopify API headers
+        are sent with every request and a default timeout is applied
+        unless the caller passes one.
+        Calls are throttled to stay within Shopify's rate limit. Pass
+        priority=PRIORITY_CHECKOUT for calls that must not wait behind
+        listing reads. Writes are checkout calls by default. Responses
+        with a 429 status, and 5xx responses of reads, are retried with
+        exponential backoff and jitter.
+        Every call, including retries, is recorded by the instrumentation
+        module against the current request.
+        Writes clear the memo of Shopify reads of the current request, as
+        they may change what the reads return.
+        While Shopify is down or slow, calls are refused by a circuit
+        breaker and raise ShopifyUnavailable. See CircuitBreaker.
+        Compensating calls, which undo writes already made (Eg: putting
+        items back in the inventory after an order failed), pass
+        compensating=True to be made even while the breaker is open.
+    """
+
+    def __init__(self):
+        super(ShopifySession, self).__init__()
+        self.headers.update(settings.SHOPIFY_API_HEADERS)
+        adapter = HTTPAdapter(
+            pool_connections=settings.SHOPIFY_HTTP_POOL_CONNECTIONS,
+            pool_maxsize=settings.SHOPIFY_HTTP_POOL_MAXSIZE
+        )
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.rate_limit = LeakyBucket(
+            size=settings.SHOPIFY_RATE_LIMIT_BUCKET_SIZE,
+            leak_rate=settings.SHOPIFY_RATE_LIMIT_LEAK_RATE,
+            reserved=settings.SHOPIFY_RATE_LIMIT_RESERVED
+        )
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=settings.SHOPIFY_CIRCUIT_FAILURE_THRESHOLD,
+            latency_budget=settings.SHOPIFY_CIRCUIT_LATENCY_BUDGET,
+            reset_timeout=settings.SHOPIFY_CIRCUIT_RESET_TIMEOUT
+        )
+
+    def request(self, method, url, priority=None, compensating=False, **kwargs):
+        kwargs.setdefault('timeout', (
+            settings.SHOPIFY_HTTP_CONNECT_TIMEOUT,
+            settings.SHOPIFY_HTTP_READ_TIMEOUT
+        ))
+        method = method.upper()
+        if priority is None:
+            priority = PRIORITY_DEFAULT if method in IDEMPOTENT_METHODS else PRIORITY_CHECKOUT
+
+        if method not in IDEMPOTENT_METHODS:
+            clear_memo()
+
+        attempt = 0
+        while True:
+            if not compensating:
+                self.circuit_breaker.before_call()
+            self.rate_limit.acquire(priority)
+            started_at = time.monotonic()
+            try:
+                response = super(ShopifySession, self).request(method, url, **kwargs)
+            except Exception:
+                latency = time.monotonic() - started_at
+                record_shopify_call(method, url, None, latency)
+                self.circuit_breaker.record_call(None, latency)
+                raise
+            latency = time.monotonic() - started_at
+            record_shopify_call(method, url, response, latency)
+            self.circuit_breaker.record_call(response.status_code, latency)
+            call_limit_header = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+            self.rate_limit.update(call_limit_header)
+
+            if response.status_code == 429:
+                if not call_limit_header:
+                    self.rate_limit.fill()
+            elif response.status_code not in RETRY_STATUS_CODES or method not in IDEMPOTENT_METHODS:
+                # A write that failed with a 5xx may still have been applied,
+                # so it is not retried. A 429 is never applied.
+                return response
+
+            if attempt >= settings.SHOPIFY_HTTP_MAX_RETRIES:
+                return response
+            time.sleep(get_retry_delay(response, attempt))
+            attempt = attempt + 1
+
+
+class ShopifyExecutor(ThreadPoolExecutor):
+    """
+        A thread pool whose tasks count their Shopify calls against, and
+        share the memo of, the request that submitted them.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super(ShopifyExecutor, self).submit(bind_memo(bind_request_stats(fn)), *args, **kwargs)
+
+    def submit_detached(self, fn, *args, **kwargs):
+        """
+            Submit a task that is not part of the current request, Eg: a
+            refresh of the cache that the request does not wait for.
+        """
+
+        return super(ShopifyExecutor, self).submit(fn, *args, **kwargs)
+
+
+def get_retry_delay(response, attempt):
+    """
+        Seconds to wait before retrying a call. Shopify's Retry-After
+        header is honoured if present. Otherwise the delay doubles with
+        every attempt. Random jitter is added so that throttled workers
+        do not all retry at the same time.
+    """
+
+    try:
+        delay = float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        delay = settings.SHOPIFY_HTTP_RETRY_BACKOFF * (2 ** attempt)
+    return delay + random.uniform(0, settings.SHOPIFY_HTTP_RETRY_BACKOFF)
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+_background_executor = None
+_background_executor_pid = None
+_background_executor_lock = threading.Lock()
+
+
+def get_session():
+    """
+        Returns the Shopify session of the current process. The session is
+        created on first use. A forked worker (Eg: gunicorn with preload)
+        creates its own session so that sockets are never shared between
+        processes.
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = ShopifySession()
+                _session_pid = pid
+    return _session
+
+
+def get_executor():
+    """
+        Returns the thread pool of the current process used to make
+        Shopify calls concurrently. The pool is shared by all requests,
+        so SHOPIFY_HTTP_MAX_WORKERS bounds the number of concurrent calls
+        a process makes, keeping us within Shopify's rate limit.
+    """
+    global _executor, _executor_pid
+
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ShopifyExecutor(max_workers=settings.SHOPIFY_HTTP_MAX_WORKERS)
+                _executor_pid = pid
+    return _executor
+
+
+def get_background_executor():
+    """
+        Returns the thread pool of the current process for long tasks that
+        are not part of any request, Eg: loading the catalog. Its
+        SHOPIFY_BACKGROUND_MAX_WORKERS threads are separate from those of
+        get_executor, so these tasks never hold up checkout calls.
+    """
+    global _background_executor, _background_executor_pid
+
+    pid = os.getpid()
+    if _background_executor is None or _background_executor_pid != pid:
+        with _background_executor_lock:
+            if _background_executor is None or _background_executor_pid != pid:
+                _background_executor = ShopifyExecutor(max_workers=settings.SHOPIFY_BACKGROUND_MAX_WORKERS)
+                _background_executor_pid = pid
+    return _background_executor
+
+
+def is_shopify_available():
+    """
+        False while the circuit breaker of the current process refuses
+        Shopify calls, Eg: during a Shopify outage.
+    """
+
+    return not get_session().circuit_breaker.is_open
+
+
+def reset_session():
+    """
+        Close the current session. The next call to get_session creates a
+        new one, picking up any change to the Shopify settings.
+    """
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _session_pid = None
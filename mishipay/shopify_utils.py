@@ -1,26 +1,221 @@
-import requests
 import json
+import logging
+import threading
+import uuid
+from datetime import timedelta
+from urllib.parse import quote
 from django.conf import settings
-from mishipay.models import Order
+from django.db import (
+    DatabaseError,
+    transaction,
+)
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from mishipay.db_utils import bulk_update
+from mishipay.models import (
+    InventoryLevel,
+    Order,
+    OrderLineItem,
+    Product,
+    ProductVariant
+)
+from mishipay.shopify_client import (
+    PRIORITY_CHECKOUT,
+    SHOPIFY_UNAVAILABLE_MSG,
+    ShopifyUnavailable,
+    get_session,
+    get_executor,
+    is_shopify_available,
+)
+from mishipay.cache_utils import (
+    get_cached_products,
+    cache_products,
+)
 from mishipay.constants import (
     ORDER_TYPE_PLACED,
-    ORDER_TYPE_CANCELLED
+    ORDER_TYPE_CANCELLED,
+    SHOPIFY_PAGE_LIMIT
 )
-from requests.exceptions import RequestException
+from mishipay.memo import memoize_in_request
+from requests.exceptions import (
+    ConnectionError,
+    ConnectTimeout,
+    RequestException,
+)
+from urllib3.exceptions import NewConnectionError
+
+
+logger = logging.getLogger(__name__)
+
 
+def get_products_memo_key(ids=[], use_cache=True):
+    # Products read bypassing the cache are fresh.
+    return ('products', frozenset(str(_id) for _id in ids)), not use_cache
 
-def get_products(ids=[]):
+
+@memoize_in_request(get_products_memo_key)
+def get_products(ids=[], use_cache=True):
     """
         Returns a tuple where first item is the list of products and the
         second item is an error message. If ids are passed, then product
         list is the list of products with the given ids. If no ids are
-        passed returns a list of all products.
+        passed returns a list of all products, retrieved from Shopify.
+        Pages list products from the local Product table instead. See
+        mishipay/catalog.py
+        Products are trimmed by filter_relevant_product_information and
+        products with the given ids are served from the cache when possible. Only products missing from
+        the cache are retrieved from Shopify. Stale cached products are
+        served as well, and refreshed in the background. Pass
+        use_cache=False to always retrieve fresh products, Eg: at checkout.
+        Within a request, products read once are served from the request's
+        memo. See mishipay/memo.py
         In case an error is encountered, an empty list along with an error
         message is returned.
     """
 
     ids = [str(_id) for _id in ids]
 
+    if not use_cache or not ids:
+        return fetch_products(ids)
+
+    cached_products, missing_ids, stale_ids = get_cached_products(ids)
+    if stale_ids:
+        refresh_products_in_background(stale_ids)
+    if not missing_ids:
+        return cached_products, ''
+
+    products, err_msg = fetch_products(missing_ids)
+    if err_msg:
+        return [], err_msg
+    cache_products(products)
+    return cached_products + products, ''
+
+
+def fetch_products(ids=[]):
+    """
+        Retrieve products from Shopify, bypassing the cache. Returns the
+        same tuple as get_products.
+    """
+
+    try:
+        products = list(filter_relevant_product_information(iter_products(ids)))
+    except ShopifyUnavailable:
+        return [], SHOPIFY_UNAVAILABLE_MSG
+    except RequestException:
+        return [], 'Error retrieving products'
+    except ShopifyAPIError as e:
+        return [], 'Error retrieving products: {}'.format(e)
+    return products, ''
+
+
+# Ids of the products being refreshed in the background, so that each is
+# refreshed by one thread at a time.
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def refresh_products_in_background(ids):
+    """
+        Retrieve products with the given ids from Shopify and cache them on
+        the Shopify thread pool, without waiting for the result. Products
+        that are already being refreshed are skipped, and nothing is
+        refreshed while Shopify is unavailable, so the stale products keep
+        being served.
+    """
+
+    if not is_shopify_available():
+        return
+
+    with _refreshing_lock:
+        refresh_ids = set(str(_id) for _id in ids) - _refreshing
+        if not refresh_ids:
+            return
+        _refreshing.update(refresh_ids)
+
+    def refresh():
+        try:
+            products, err_msg = fetch_products(list(refresh_ids))
+            if err_msg:
+                logger.warning('Could not refresh cached products: %s', err_msg)
+            else:
+                cache_products(products)
+        finally:
+            with _refreshing_lock:
+                _refreshing.difference_update(refresh_ids)
+
+    get_executor().submit_detached(refresh)
+
+
+class ShopifyAPIError(Exception):
+    """
+        Raised by the paginated iterators when Shopify responds with an
+        'error' or 'errors' key. The message is the error sent by Shopify.
+    """
+
+
+def iter_shopify_pages(url, resource, fields_query_param=''):
+    """
+        Generator that yields one page of `resource` items (Eg: 'products')
+        at a time, following the cursor in the Link header of each response
+        until there is no next page. Only a single page is held in memory.
+        Raises RequestException or ShopifyAPIError.
+    """
+
+    while url:
+        response = get_session().get(url)
+        page = response.json()
+        if 'error' in page or 'errors' in page:
+            raise ShopifyAPIError(page.get('error', page.get('errors')))
+
+        yield page[resource]
+
+        # Shopify keeps only page_info and limit in the next page link,
+        # so the requested fields have to be carried over.
+        url = response.links.get('next', {}).get('url')
+        if url and fields_query_param and 'fields=' not in url:
+            url = '{}&{}'.format(url, fields_query_param)
+
+
+def iter_shopify_resource(resource, fields, ids=[], extra_query_param=''):
+    """
+        Generator that yields items of a Shopify resource (Eg: 'products')
+        one by one, with only the given fields. If ids are passed, only
+        items with the given ids are retrieved. Ids are requested in batches
+        of at most SHOPIFY_PAGE_LIMIT so that the request URL stays bounded,
+        and the batches are merged into a single sequence.
+        Raises RequestException or ShopifyAPIError.
+    """
+
+    ids = [str(_id) for _id in ids]
+
+    fields_query_param = 'fields={}'.format(','.join(fields))
+    limit_query_param = 'limit={}'.format(SHOPIFY_PAGE_LIMIT)
+
+    # Will end up as query param strings. One page sequence per batch.
+    ids_query_params = [''] if not ids else [
+        '&ids={}'.format(','.join(ids[index:index + SHOPIFY_PAGE_LIMIT]))
+        for index in range(0, len(ids), SHOPIFY_PAGE_LIMIT)
+    ]
+
+    for ids_query_param in ids_query_params:
+        url = '{}/admin/{}.json?{}&{}{}{}'.format(
+            settings.SHOPIFY_STORE_URL, resource, limit_query_param,
+            fields_query_param, extra_query_param, ids_query_param
+        )
+        for items in iter_shopify_pages(url, resource, fields_query_param):
+            for item in items:
+                yield item
+
+
+def iter_products(ids=[], extra_query_param=''):
+    """
+        Generator that yields products from Shopify one by one. If ids are
+        passed, only products with the given ids are retrieved.
+        extra_query_param is added to the query string of every page,
+        Eg: '&updated_at_min=...'
+        Raises RequestException or ShopifyAPIError.
+    """
+
     # Get only these fields from the Shopify API.
     # Other fields do not have relevancy for this
     # application as of now.
@@ -32,25 +227,7 @@ def get_products(ids=[]):
         'variants'
     ]
 
-    # Will end up as query param string
-    product_ids_query_param = ''
-
-    if ids:
-        product_ids_query_param = '&ids={}'.format(','.join(ids))
-    product_fields_query_param = 'fields={}'.format(','.join(product_required_fields))
-    product_listing_url = '{}/admin/products.json?{}{}'.format(settings.SHOPIFY_STORE_URL, product_fields_query_param, product_ids_query_param)
-    try:
-        products_response = requests.get(product_listing_url, headers=settings.SHOPIFY_API_HEADERS)
-    except RequestException:
-        return [], 'Error retrieving products'
-
-    products = products_response.json()
-
-    if 'error' in products or 'errors' in products:
-        return [], 'Error retrieving products: {}'.format(
-            products.get('error', products.get('errors'))
-        )
-    return products['products'], ''
+    return iter_shopify_resource('products', product_required_fields, ids, extra_query_param)
 
 
 def filter_relevant_product_information(products):
@@ -58,6 +235,8 @@ def filter_relevant_product_information(products):
         Use this method to remove unnecessary nested
         information from products. This will help reduce
         data load on the Frontend.
+        Works as a streaming stage: products are trimmed and
+        yielded one at a time.
     """
 
     for product in products:
@@ -81,28 +260,18 @@ def filter_relevant_product_information(products):
             })
         product['variants'] = variants
 
-    return products
-
-
-def filter_out_of_stock_products(products):
-    """
-        Filter out products that are unavailable.
-    """
-
-    filtered_products = []
-    for product in products:
-        if int(product['variants'][0]['inventory_quantity']) > 0:
-            filtered_products.append(product)
-    return filtered_products
+        yield product
 
 
-def update_inventory(products, order_type=ORDER_TYPE_PLACED):
+def update_inventory(products, order_type=ORDER_TYPE_PLACED, compensating=False):
     """
         Update availability of inventory items. If an order is placed the
         number of inventory items reduce with respect to the order items
         and their quantity. Likewise, if an order is cancelled, the number
         of inventory items increase with respect to the order items and
         their quantity.
+        Pass compensating=True to undo an update that was already made.
+        See ShopifySession.
     """
 
     if order_type == ORDER_TYPE_PLACED:
@@ -119,7 +288,6 @@ def update_inventory(products, order_type=ORDER_TYPE_PLACED):
         return False, 'Invalid Order Type'
 
     # Get Inventory IDs for each product varient added.
-    inventory_ids = []
     inventory_item_id_quantity_map = {}
     for product in products:
         # Varients have not been considered in scope of this application.
@@ -131,57 +299,265 @@ def update_inventory(products, order_type=ORDER_TYPE_PLACED):
             order_type == ORDER_TYPE_PLACED
         ):
             return False, '{} out of stock'.format(product['title'])
-        inventory_ids.append(str(inventory_item_id))
         inventory_item_id_quantity_map[inventory_item_id] = product['quantity'] * quantity_multiplication_factor
 
-    # Get inventory levels for each product that requires an update.
-    # We need location id to update the inventory levels of products.
-    # Hence, though this call may seem redudant but it is a must.
-    inventory_item_ids_query_param = 'inventory_item_ids={}'.format(','.join(inventory_ids))
+    return adjust_inventory(inventory_item_id_quantity_map, compensating=compensating)
+
+
+def get_inventory_levels(inventory_item_ids, compensating=False):
+    """
+        Returns a tuple where first item is the list of Shopify inventory
+        levels of the given inventory items and the second item is an
+        error message.
+    """
+
+    inventory_item_ids_query_param = 'inventory_item_ids={}'.format(
+        ','.join(str(inventory_item_id) for inventory_item_id in inventory_item_ids)
+    )
     inventory_levels_url = '{}/admin/inventory_levels.json?{}'.format(settings.SHOPIFY_STORE_URL, inventory_item_ids_query_param)
     try:
-        inventory_levels_response = requests.get(inventory_levels_url, headers=settings.SHOPIFY_API_HEADERS)
-    except RequestException:
-        return False, 'Error retrieving inventory levels'
-    inventory_levels = inventory_levels_response.json()
+        inventory_levels_response = get_session().get(
+            inventory_levels_url,
+            priority=PRIORITY_CHECKOUT,
+            compensating=compensating
+        )
+        inventory_levels = inventory_levels_response.json()
+    except (RequestException, ValueError):
+        return [], 'Error retrieving inventory levels'
     if 'error' in inventory_levels or 'errors' in inventory_levels:
-        return False, 'Error retrieving Inventory levels: {}'.format(
+        return [], 'Error retrieving Inventory levels: {}'.format(
             inventory_levels.get('error', inventory_levels.get('errors'))
         )
+    return inventory_levels['inventory_levels'], ''
+
+
+def adjust_inventory(inventory_item_id_quantity_map, compensating=False):
+    """
+        Adjust the available quantity of inventory items. Takes a dict of
+        inventory item id to the adjustment, which is negative to remove
+        items from the inventory. Returns a tuple where first item is the
+        status and the second item is an error message.
+    """
 
-    inventory_item_id_location_id_map = {}
-    for inventory_level in inventory_levels['inventory_levels']:
-        inventory_item_id = inventory_level['inventory_item_id']
-        # No need to check for order type here because the quantity map will have
-        # negative quantities for a cancelled order.
-        if inventory_level['available'] < inventory_item_id_quantity_map[inventory_item_id]:
-            return False, 'Some item out of stock'
-        inventory_item_id_location_id_map[inventory_item_id] = inventory_level['location_id']
+    inventory_ids = [str(inventory_item_id) for inventory_item_id in inventory_item_id_quantity_map.keys()]
+
+    # We need location id to update the inventory levels of products.
+    # Location ids are kept locally, so inventory levels are retrieved
+    # from Shopify only for items that have not been seen before.
+    inventory_item_id_location_id_map = dict(InventoryLevel.objects.filter(
+        inventory_item_id__in=inventory_item_id_quantity_map.keys()
+    ).values_list('inventory_item_id', 'location_id'))
+
+    missing_inventory_ids = [
+        inventory_id for inventory_id in inventory_ids
+        if int(inventory_id) not in inventory_item_id_location_id_map
+    ]
+    if missing_inventory_ids:
+        inventory_levels, err_msg = get_inventory_levels(missing_inventory_ids, compensating=compensating)
+        if err_msg:
+            return False, err_msg
+
+        for inventory_level in inventory_levels:
+            inventory_item_id = inventory_level['inventory_item_id']
+            # No need to check for order type here because the quantity map has
+            # negative quantities for a placed order and positive ones for a
+            # cancelled order.
+            if (inventory_level['available'] or 0) + inventory_item_id_quantity_map[inventory_item_id] < 0:
+                return False, 'Some item out of stock'
+            inventory_item_id_location_id_map[inventory_item_id] = inventory_level['location_id']
 
     # Adjust Inventory levels of each product. No bulk operation API.
-    for inventory_item_id in inventory_item_id_quantity_map.keys():
-        inventory_level_adjust_data = {
-            'inventory_item_id': inventory_item_id,
-            'location_id': inventory_item_id_location_id_map[inventory_item_id],
-            'available_adjustment': inventory_item_id_quantity_map[inventory_item_id]
-        }
-        inventory_level_adjust_url = '{}/admin/inventory_levels/adjust.json'.format(settings.SHOPIFY_STORE_URL)
+    inventory_levels, err_msg = adjust_inventory_levels({
+        inventory_item_id: (
+            inventory_item_id_location_id_map[inventory_item_id],
+            inventory_item_id_quantity_map[inventory_item_id]
+        )
+        for inventory_item_id in inventory_item_id_quantity_map.keys()
+    }, compensating=compensating)
+    if err_msg:
+        # A location id kept locally may be stale. Forget them, so that
+        # they are retrieved from Shopify on the next attempt.
         try:
-            inventory_level_adjust_response = requests.post(
-                inventory_level_adjust_url,
-                headers=settings.SHOPIFY_API_HEADERS,
-                data=json.dumps(inventory_level_adjust_data)
+            InventoryLevel.objects.filter(
+                inventory_item_id__in=inventory_item_id_quantity_map.keys()
+            ).delete()
+        except DatabaseError:
+            logger.exception('Could not delete inventory levels of %s', list(inventory_item_id_quantity_map.keys()))
+        return False, err_msg
+
+    # The adjustments were made, so the order must not fail if the local
+    # copy can not be updated.
+    try_save_inventory_levels(inventory_levels)
+    return True, ''
+
+
+def save_inventory_levels(inventory_levels):
+    """
+        Create or update InventoryLevel objects for the given Shopify
+        inventory levels, and keep the stock of the local products and
+        their variants in sync. Every table is updated with a single
+        UPDATE per batch.
+    """
+
+    inventory_level_map = {
+        inventory_level['inventory_item_id']: inventory_level for inventory_level in inventory_levels
+    }
+    if not inventory_level_map:
+        return
+
+    with transaction.atomic():
+        existing_inventory_item_ids = set(InventoryLevel.objects.filter(
+            inventory_item_id__in=inventory_level_map.keys()
+        ).values_list('inventory_item_id', flat=True))
+
+        available_map = {
+            inventory_item_id: inventory_level['available'] or 0
+            for inventory_item_id, inventory_level in inventory_level_map.items()
+        }
+        bulk_update(InventoryLevel, 'inventory_item_id', {
+            inventory_item_id: {
+                'location_id': inventory_level_map[inventory_item_id]['location_id'],
+                'available': available_map[inventory_item_id],
+            }
+            for inventory_item_id in existing_inventory_item_ids
+        }, ['location_id', 'available'])
+        bulk_update(Product, 'inventory_item_id', {
+            inventory_item_id: {'inventory_quantity': available, 'in_stock': available > 0}
+            for inventory_item_id, available in available_map.items()
+        }, ['inventory_quantity', 'in_stock'])
+        bulk_update(ProductVariant, 'inventory_item_id', {
+            inventory_item_id: {'inventory_quantity': available}
+            for inventory_item_id, available in available_map.items()
+        }, ['inventory_quantity'])
+
+        InventoryLevel.objects.bulk_create([
+            InventoryLevel(
+                inventory_item_id=inventory_item_id,
+                location_id=inventory_level['location_id'],
+                available=available_map[inventory_item_id]
             )
-        except RequestException:
-            return False, 'Error updating Inventory'
+            for inventory_item_id, inventory_level in inventory_level_map.items()
+            if inventory_item_id not in existing_inventory_item_ids
+        ])
+
+
+def try_save_inventory_levels(inventory_levels):
+    """
+        save_inventory_levels for callers that must not fail if the local
+        copy of the inventory can not be written, Eg: at checkout after
+        the inventory was adjusted on Shopify. Database errors, Eg: a locked
+        SQLite database, or two first orders of an item inserting its
+        inventory level at the same time, are logged. The local copy is
+        brought up to date by the next webhook or sync.
+        Returns True if the inventory levels were saved.
+    """
+
+    try:
+        save_inventory_levels(inventory_levels)
+    except DatabaseError:
+        logger.exception(
+            'Could not save inventory levels of %s',
+            [inventory_level['inventory_item_id'] for inventory_level in inventory_levels]
+        )
+        return False
+    return True
+
+
+def adjust_inventory_level(inventory_item_id, location_id, available_adjustment, compensating=False):
+    """
+        Adjust the available quantity of an inventory item at a location.
+        Returns a tuple where first item is the adjusted inventory level
+        and the second item is an error message.
+    """
+
+    inventory_level_adjust_data = {
+        'inventory_item_id': inventory_item_id,
+        'location_id': location_id,
+        'available_adjustment': available_adjustment
+    }
+    inventory_level_adjust_url = '{}/admin/inventory_levels/adjust.json'.format(settings.SHOPIFY_STORE_URL)
+    try:
+        inventory_level_adjust_response = get_session().post(
+            inventory_level_adjust_url,
+            data=json.dumps(inventory_level_adjust_data),
+            compensating=compensating
+        )
         inventory_level_adjust = inventory_level_adjust_response.json()
-        if 'error' in inventory_level_adjust or 'errors' in inventory_level_adjust:
-            return False, 'Inventory level adjustment failed: {}'.format(
-                inventory_level_adjust.get('error', inventory_level_adjust.get('errors'))
+    except (RequestException, ValueError):
+        return None, 'Error updating Inventory'
+    if 'error' in inventory_level_adjust or 'errors' in inventory_level_adjust:
+        return None, 'Inventory level adjustment failed: {}'.format(
+            inventory_level_adjust.get('error', inventory_level_adjust.get('errors'))
+        )
+    return inventory_level_adjust['inventory_level'], ''
+
+
+def adjust_inventory_levels(adjustments, compensating=False):
+    """
+        Make the given adjustments concurrently on the shared Shopify thread
+        pool. Adjustments is a dict of the form
+        {inventory_item_id: (location_id, available_adjustment)}.
+        Returns a tuple where first item is the list of adjusted inventory
+        levels and the second item is an error message.
+        Adjustments are all or nothing. If any of them fails, the ones that
+        succeeded are reverted so that the inventory is left as it was.
+    """
+
+    executor = get_executor()
+    futures = {
+        inventory_item_id: executor.submit(
+            adjust_inventory_level, inventory_item_id, location_id, available_adjustment, compensating
+        )
+        for inventory_item_id, (location_id, available_adjustment) in adjustments.items()
+    }
+    results = {
+        inventory_item_id: get_adjustment_result(inventory_item_id, future)
+        for inventory_item_id, future in futures.items()
+    }
+
+    err_msgs = [err_msg for inventory_level, err_msg in results.values() if err_msg]
+    if not err_msgs:
+        return [inventory_level for inventory_level, err_msg in results.values()], ''
+
+    # Revert adjustments that succeeded. Reverts are made even if the
+    # circuit breaker opened in the meantime.
+    futures = {
+        inventory_item_id: executor.submit(
+            adjust_inventory_level, inventory_item_id,
+            adjustments[inventory_item_id][0], -adjustments[inventory_item_id][1], True
+        )
+        for inventory_item_id, (inventory_level, err_msg) in results.items()
+        if not err_msg
+    }
+    for inventory_item_id, future in futures.items():
+        inventory_level, err_msg = get_adjustment_result(inventory_item_id, future)
+        if err_msg:
+            logger.error(
+                'Failed to revert adjustment of %s for inventory item %s: %s',
+                adjustments[inventory_item_id][1], inventory_item_id, err_msg
             )
-    return True, ''
+    return [], err_msgs[0]
+
+
+def get_adjustment_result(inventory_item_id, future):
+    """
+        Returns the result of an adjust_inventory_level task. An unexpected
+        exception is returned as an error message, so that one failed task
+        does not keep the others from being reverted.
+    """
+
+    try:
+        return future.result()
+    except Exception:
+        logger.exception('Adjustment of inventory item %s failed', inventory_item_id)
+        return None, 'Error updating Inventory'
+
+
+def get_orders_memo_key(shopify_order_ids=[], user=None):
+    return ('orders', frozenset(str(_id) for _id in shopify_order_ids), user.id if user else None), True
 
 
+@memoize_in_request(get_orders_memo_key)
 def get_orders(shopify_order_ids=[], user=None):
     """
         Returns a tuple where first item is the list of orders and the
@@ -195,6 +571,38 @@ def get_orders(shopify_order_ids=[], user=None):
 
     shopify_order_ids = [str(shopify_order_id) for shopify_order_id in shopify_order_ids]
 
+    if user:
+        # For a user context, retrieve all orders or orders with requested ids that belong to that user
+        user_shopify_order_ids = Order.objects.filter(user=user).values_list('shopify_order_id', flat=True)
+        user_shopify_order_ids = [str(user_shopify_order_id) for user_shopify_order_id in user_shopify_order_ids]
+        shopify_order_ids = list(
+            set(shopify_order_ids).intersection(set(user_shopify_order_ids))
+        ) if shopify_order_ids else user_shopify_order_ids
+        if not shopify_order_ids:
+            return [], ''
+
+    # Retrieve orders. Without a user context all orders are retrieved, or
+    # those with the requested ids. This could be a call for an admin order
+    # page. Ids are requested in batches and the pages of each are merged.
+    try:
+        shopify_orders = list(iter_orders(shopify_order_ids))
+    except RequestException:
+        return [], 'Error retrieving Orders'
+    except ShopifyAPIError as e:
+        return [], 'Error retrieving orders: {}'.format(e)
+
+    return shopify_orders, ''
+
+
+def iter_orders(ids=[], extra_query_param=''):
+    """
+        Generator that yields orders from Shopify one by one, whatever
+        their status. If ids are passed, only orders with the given ids
+        are retrieved. extra_query_param is added to the query string of
+        every page, Eg: '&updated_at_min=...'
+        Raises RequestException or ShopifyAPIError.
+    """
+
     # Get only these fields from the Shopify API.
     # Other fields do not have relevancy for this
     # application as of now
@@ -207,6 +615,7 @@ def get_orders(shopify_order_ids=[], user=None):
         'financial_status',
         'fulfillment_status',
         'line_items',
+        'note_attributes',
         'order_status',
         'phone',
         'subtotal_price',
@@ -214,35 +623,7 @@ def get_orders(shopify_order_ids=[], user=None):
         'total_price'
     ]
 
-    if user:
-        # For a user context, retrieve all orders or orders with requested ids that belong to that user
-        user_shopify_order_ids = Order.objects.filter(user=user).values_list('shopify_order_id', flat=True)
-        user_shopify_order_ids = [str(user_shopify_order_id) for user_shopify_order_id in user_shopify_order_ids]
-        shopify_order_ids = list(
-            set(shopify_order_ids).intersection(set(user_shopify_order_ids))
-        ) if shopify_order_ids else shopify_order_ids
-        shopify_order_ids_query_param = 'ids={}'.format(','.join(shopify_order_ids))
-    else:
-        # If there is no user context retrieve all orders data. This could be a call for an admin order page.
-        shopify_order_ids_query_param = ''
-        if shopify_order_ids:
-            shopify_order_ids_query_param = 'ids={}'.format(','.join(shopify_order_ids))
-
-    # Retrieve orders
-    shopify_order_fields_query_param = 'fields={}'.format(','.join(shopify_order_required_fields))
-    shopify_orders_list_url = '{}/admin/orders.json?{}&status=any&{}'.format(settings.SHOPIFY_STORE_URL, shopify_order_fields_query_param, shopify_order_ids_query_param)
-    try:
-        shopify_orders_list_response = requests.get(shopify_orders_list_url, headers=settings.SHOPIFY_API_HEADERS)
-    except RequestException:
-        return [], 'Error retrieving Orders'
-    shopify_orders_list = shopify_orders_list_response.json()
-
-    if 'error' in shopify_orders_list or 'errors' in shopify_orders_list:
-        return [], 'Error retrieving orders: {}'.format(
-            shopify_orders_list.get('error', shopify_orders_list.get('errors'))
-        )
-
-    return shopify_orders_list['orders'], ''
+    return iter_shopify_resource('orders', shopify_order_required_fields, ids, '&status=any' + extra_query_param)
 
 
 def filter_relavant_order_information(orders):
@@ -267,9 +648,147 @@ def filter_relavant_order_information(orders):
     return orders
 
 
-def create_order(user, products):
+def save_orders(orders, variant_inventory_item_ids=None):
+    """
+        Copy the given Shopify orders to the matching Order objects, along
+        with their line items. Orders that do not exist in our internal
+        database are ignored.
+        Shopify line items do not have the inventory item id. It is taken
+        from variant_inventory_item_ids, a dict of variant id to inventory
+        item id, then from the line items already stored and then from the
+        Product table.
+    """
+
+    orders = list(filter_relavant_order_information(orders))
+    local_orders = {
+        local_order.shopify_order_id: local_order
+        for local_order in Order.objects.filter(shopify_order_id__in=[order['id'] for order in orders])
+    }
+
+    variant_ids = set(
+        line_item['variant_id'] for order in orders for line_item in order['line_items']
+        if line_item.get('variant_id')
+    )
+    inventory_item_ids = dict(Product.objects.filter(
+        variant_id__in=variant_ids
+    ).values_list('variant_id', 'inventory_item_id'))
+    inventory_item_ids.update(OrderLineItem.objects.filter(
+        order__in=local_orders.values(),
+        inventory_item_id__isnull=False
+    ).values_list('variant_id', 'inventory_item_id'))
+    inventory_item_ids.update(variant_inventory_item_ids or {})
+
+    with transaction.atomic():
+        saved_orders = []
+        for order in orders:
+            local_order = local_orders.get(order['id'])
+            if local_order is None:
+                continue
+
+            local_order.email = order.get('email') or ''
+            local_order.financial_status = order.get('financial_status') or ''
+            local_order.fulfillment_status = order.get('fulfillment_status') or ''
+            local_order.subtotal_price = order.get('subtotal_price')
+            local_order.total_line_items_price = order.get('total_line_items_price')
+            local_order.total_price = order.get('total_price')
+            if order.get('created_at'):
+                local_order.created_at = parse_datetime(order['created_at'])
+            local_order.cancelled_at = parse_datetime(order['cancelled_at']) if order.get('cancelled_at') else None
+            local_order.synced_at = timezone.now()
+            local_order.save()
+            saved_orders.append((local_order, order))
+
+        # Line items of all the orders are replaced together.
+        saved_order_ids = [local_order.id for local_order, order in saved_orders]
+        for index in range(0, len(saved_order_ids), SHOPIFY_PAGE_LIMIT):
+            OrderLineItem.objects.filter(order_id__in=saved_order_ids[index:index + SHOPIFY_PAGE_LIMIT]).delete()
+        OrderLineItem.objects.bulk_create([
+            OrderLineItem(
+                order=local_order,
+                shopify_line_item_id=line_item['id'],
+                product_id=line_item['product_id'],
+                variant_id=line_item['variant_id'],
+                inventory_item_id=inventory_item_ids.get(line_item['variant_id']),
+                title=line_item['title'],
+                quantity=line_item['quantity'],
+                price=line_item['price']
+            )
+            for local_order, order in saved_orders
+            for line_item in order['line_items']
+        ])
+
+
+# Name of the note attribute holding the reference of an order placed
+# through this application. See find_created_order
+ORDER_REFERENCE_ATTRIBUTE = 'mishipay_order_reference'
+
+
+def is_request_not_sent(e):
+    """
+        True if a call that raised e never reached Shopify: the circuit
+        breaker refused it, or the connection could not be established.
+        Otherwise, Eg: if the connection was reset after the request was
+        sent, Shopify may have acted on it.
+    """
+
+    if isinstance(e, (ShopifyUnavailable, ConnectTimeout)):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+def find_created_order(reference, created_at_min):
+    """
+        Look up an order whose creation failed without a response, by the
+        reference in its note attributes. Only orders created since
+        created_at_min are retrieved.
+        Returns a tuple where first item is the order, or None if it was
+        not created, and the second item is an error message.
+    """
+
+    created_at_min_query_param = '&created_at_min={}'.format(quote(created_at_min.isoformat()))
+    try:
+        for order in iter_orders(extra_query_param=created_at_min_query_param):
+            for note_attribute in order.get('note_attributes') or []:
+                if note_attribute.get('name') == ORDER_REFERENCE_ATTRIBUTE and note_attribute.get('value') == reference:
+                    return order, ''
+    except (RequestException, ValueError):
+        return None, 'Error retrieving orders'
+    except ShopifyAPIError as e:
+        return None, 'Error retrieving orders: {}'.format(e)
+    return None, ''
+
+
+def save_created_order(user, order, variant_inventory_item_ids=None):
+    """
+        Create the local copy of an order created on Shopify. It is safe
+        to call again for the same order. Errors are logged, as the order
+        has been placed anyway; it is copied later, Eg: by My Orders.
+        Returns a tuple where first item is the status and the second item
+        is an error message.
+    """
+
+    try:
+        with transaction.atomic():
+            Order.objects.get_or_create(
+                shopify_order_id=order['id'],
+                defaults={'user': user}
+            )
+            save_orders([order], variant_inventory_item_ids=variant_inventory_item_ids)
+    except DatabaseError:
+        logger.exception('Order %s was created but could not be saved locally', order['id'])
+        return False, 'Error saving order'
+    return True, ''
+
+
+def create_order(user, products, on_created=None):
     """
         Create an order and update the inventory.
+        If the order is not created, the inventory is restored. If the
+        call to create it fails after it was sent, the order is looked up
+        by its reference first, as Shopify may have created it.
+        on_created, if passed, is called with the Shopify order once it is
+        created, before the local copy is written.
     """
 
     if not products or type(products) not in (list, tuple, set):
@@ -282,11 +801,13 @@ def create_order(user, products):
     if err_msg:
         return False, err_msg
 
+    reference = uuid.uuid4().hex
     order_data = {
         'order': {
             'send_receipt': True,
             'send_fulfillment_receipt': True,
-            'line_items': []
+            'line_items': [],
+            'note_attributes': [{'name': ORDER_REFERENCE_ATTRIBUTE, 'value': reference}],
         }
     }
 
@@ -303,56 +824,149 @@ def create_order(user, products):
 
     # Create order
     create_order_url = '{}/admin/orders.json'.format(settings.SHOPIFY_STORE_URL)
+    # Allows for Shopify's clock being behind ours.
+    created_at_min = timezone.now() - timedelta(minutes=5)
     try:
-        create_order_response = requests.post(create_order_url, headers=settings.SHOPIFY_API_HEADERS, data=json.dumps(order_data))
-    except RequestException:
-        return False, 'Error creating order'
-    created_order = create_order_response.json()
+        create_order_response = get_session().post(create_order_url, data=json.dumps(order_data))
+        created_order = create_order_response.json()
+    except (RequestException, ValueError) as e:
+        if is_request_not_sent(e):
+            # The order did not reach Shopify, so put the items back in
+            # the inventory.
+            restore_inventory(products)
+            return False, SHOPIFY_UNAVAILABLE_MSG if isinstance(e, ShopifyUnavailable) else 'Error creating order'
+
+        # The order may have been created, Eg: if the connection was reset
+        # or the response timed out.
+        order, err_msg = find_created_order(reference, created_at_min)
+        if err_msg:
+            logger.error(
+                'Order %s of user %s may have been created. Inventory of %s was not restored: %s',
+                reference, user.id, [product['variants'][0]['inventory_item_id'] for product in products], err_msg
+            )
+            return False, 'Error creating order'
+        if order is None:
+            restore_inventory(products)
+            return False, 'Error creating order'
+        created_order = {'order': order}
 
     if 'error' in created_order or 'errors' in created_order:
+        # Shopify rejected the order, so put the items back in the inventory.
+        restore_inventory(products)
         return False, 'Error creating order: {}'.format(
             created_order.get('error', created_order.get('errors'))
         )
 
+    if on_created:
+        on_created(created_order['order'])
+
     # If creating order on shopify was successful, create an entry
     # in our internal database.
-    Order.objects.create(
-        shopify_order_id=created_order['order']['id'],
-        user=user,
-    )
+    save_created_order(user, created_order['order'], variant_inventory_item_ids={
+        product['variants'][0]['id']: product['variants'][0]['inventory_item_id'] for product in products
+    })
 
     return created_order['order'], ''
 
 
+def restore_inventory(products):
+    """
+        Put the items of an order that could not be created back in the
+        inventory. Errors are logged, as the order has failed anyway.
+    """
+
+    try:
+        inventory_update_status, err_msg = update_inventory(
+            products, order_type=ORDER_TYPE_CANCELLED, compensating=True
+        )
+    except Exception:
+        logger.exception('Error restoring inventory of a failed order')
+        return
+    if err_msg:
+        logger.error('Error restoring inventory of a failed order: %s', err_msg)
+
+
 def cancel_order(shopify_order_id):
     """
         Cancel an order and update the inventory.
+        Orders copied locally along with the inventory item ids of their
+        line items are cancelled with the cancel call and the inventory
+        adjustments alone. Other orders are retrieved from Shopify first.
     """
 
-    shopify_orders, err_msg = get_orders(shopify_order_ids=[str(shopify_order_id)])
+    local_order = Order.objects.filter(
+        shopify_order_id=shopify_order_id,
+        synced_at__isnull=False
+    ).prefetch_related('line_items').first()
+    line_items = list(local_order.line_items.all()) if local_order else []
+    if not line_items or any(line_item.inventory_item_id is None for line_item in line_items):
+        return cancel_shopify_order(shopify_order_id)
+
+    if local_order.cancelled_at:
+        return False, 'Order #{} is already cancelled'.format(shopify_order_id)
+
+    cancelled_order, err_msg = post_order_cancellation(shopify_order_id)
     if err_msg:
         return False, err_msg
 
-    if not shopify_orders:
-        return False, 'Order #{} does not exist'.format(shopify_order_id)
+    inventory_item_id_quantity_map = {}
+    for line_item in line_items:
+        inventory_item_id_quantity_map[line_item.inventory_item_id] = (
+            inventory_item_id_quantity_map.get(line_item.inventory_item_id, 0) + line_item.quantity
+        )
 
-    shopify_order = shopify_orders[0]
+    inventory_update_status, err_msg = adjust_inventory(inventory_item_id_quantity_map)
+    if err_msg:
+        logger.error('Error restoring inventory of cancelled order %s: %s', shopify_order_id, err_msg)
 
-    if shopify_order['cancelled_at']:
-        return False, 'Order #{} is already cancelled'.format(shopify_order_id)
+    return cancelled_order, ''
+
+
+def post_order_cancellation(shopify_order_id):
+    """
+        Cancel an order on Shopify and update the local copy of the order.
+        Returns a tuple where first item is the cancelled order and the
+        second item is an error message.
+    """
 
-    cancel_order_url = '{}/admin/orders/{}/cancel.json'.format(settings.SHOPIFY_STORE_URL, shopify_order['id'])
+    cancel_order_url = '{}/admin/orders/{}/cancel.json'.format(settings.SHOPIFY_STORE_URL, shopify_order_id)
     try:
-        cancel_order_response = requests.post(cancel_order_url, headers=settings.SHOPIFY_API_HEADERS, data={})
-    except RequestException:
+        cancel_order_response = get_session().post(cancel_order_url, data={})
+        cancelled_order = cancel_order_response.json()
+    except (RequestException, ValueError):
         return False, 'Error cancelling order'
-    cancelled_order = cancel_order_response.json()
 
     if 'error' in cancelled_order or 'errors' in cancelled_order:
         return False, 'Error cancelling order: {}'.format(
             cancelled_order.get('error', cancelled_order.get('errors'))
         )
 
+    save_orders([cancelled_order['order']])
+    return cancelled_order['order'], ''
+
+
+def cancel_shopify_order(shopify_order_id):
+    """
+        Cancel an order that is not copied locally, retrieving the order
+        and its products from Shopify to update the inventory.
+    """
+
+    shopify_orders, err_msg = get_orders(shopify_order_ids=[str(shopify_order_id)])
+    if err_msg:
+        return False, err_msg
+
+    if not shopify_orders:
+        return False, 'Order #{} does not exist'.format(shopify_order_id)
+
+    shopify_order = shopify_orders[0]
+
+    if shopify_order['cancelled_at']:
+        return False, 'Order #{} is already cancelled'.format(shopify_order_id)
+
+    cancelled_order, err_msg = post_order_cancellation(shopify_order['id'])
+    if err_msg:
+        return False, err_msg
+
     # Get product information of products in order to update inventory.
     # We can't simply use line items in the order dict because they do
     # not have inventory item id.
@@ -375,6 +989,6 @@ def cancel_order(shopify_order_id):
     inventory_update_status, err_msg = update_inventory(products, order_type=ORDER_TYPE_CANCELLED)
 
     if err_msg:
-        print('Error Updating inventory: ', err_msg, '\nTBD: Handle this case')
+        logger.error('Error restoring inventory of cancelled order %s: %s', shopify_order_id, err_msg)
 
-    return cancelled_order['order'], ''
+    return cancelled_order, ''
@@ -1,33 +1,93 @@
-$(document).on('change', '.product-quantity', function(event){
+// Quantity changes made in quick succession are sent to the cart API
+// as a single batch. The page is updated in place from the response.
+let pendingCartChanges = {};
+let cartChangesTimer = null;
 
-  $('input').prop('disabled', true)
-  let productInformation = event.target.dataset;
-  productInformation = Object.assign({}, productInformation);
+let sendCartChanges = function() {
+  let changes = pendingCartChanges;
+  pendingCartChanges = {};
+  cartChangesTimer = null;
 
-  data = {
-    "quantity": event.target.value
-  }
+  let data = {
+    "upserts": [],
+    "deletes": []
+  };
+  $.each(changes, function(productId, quantity) {
+    if (quantity == 0) {
+      data['deletes'].push(parseInt(productId));
+    } else {
+      data['upserts'].push({"product_id": parseInt(productId), "quantity": quantity});
+    }
+  });
 
-  request_type = 'PUT'
-  if (parseInt(event.target.value) == 0) {
-    request_type = 'DELETE'
-  }
+  $('.product-quantity').prop('disabled', true);
+  $('.quantity-update-error').text("");
 
   $.ajax({
-    type: request_type,
-    url: '/update-cart-item/' + productInformation['cartItemId'] + '/',
+    type: 'POST',
+    url: $('.cart-container').attr('data-cart-api-url'),
     data: JSON.stringify(data),
     contentType: "application/json",
 
     success: function(result){
-      // We don't simply reload because error message would be retained.
-      location.href = /cart/;
+      if (result['cart_items'].length == 0 || result['err_msg']) {
+        // We don't simply reload because error message would be retained.
+        location.href = '/cart/';
+        return;
+      }
+      let cartItems = {};
+      $.each(result['cart_items'], function(index, cartItem) {
+        cartItems[cartItem['product_id']] = cartItem;
+      });
+      $('.cart-item').each(function() {
+        let cartItem = cartItems[$(this).attr('data-product-id')];
+        if (!cartItem) {
+          $(this).remove();
+          return;
+        }
+        let quantityInput = $(this).find('.product-quantity');
+        quantityInput.val(cartItem['quantity']);
+        quantityInput.attr('prev-value', cartItem['quantity']);
+        $(this).find('.cart-item-amount').text(cartItem['amount']);
+
+        let warnings = [];
+        if (cartItem['price_changed']) {
+          warnings.push("Price changed to INR " + cartItem['current_price'] + ".");
+        }
+        if (cartItem['out_of_stock']) {
+          if (cartItem['inventory_quantity'] > 0) {
+            warnings.push("Only " + cartItem['inventory_quantity'] + " left in stock.");
+          } else {
+            warnings.push("Out of stock.");
+          }
+        }
+        $(this).find('.cart-item-warning').text(warnings.join(" "));
+      });
+      $('.cart-total').text(result['cart_total']);
+      $('.product-quantity').prop('disabled', false);
     },
 
     error: function() {
-      event.target.value = $(event.target).attr('prev-value');
-      $(event.target).siblings('.quantity-update-error').text("An error occured. Please try again.");
-      $('input').prop('disabled', false);
+      $.each(changes, function(productId, quantity) {
+        let quantityInput = $('.product-quantity[data-product-id="' + productId + '"]');
+        quantityInput.val(quantityInput.attr('prev-value'));
+        quantityInput.siblings('.quantity-update-error').text("An error occured. Please try again.");
+      });
+      $('.product-quantity').prop('disabled', false);
     }
   });
+};
+
+$(document).on('change', '.product-quantity', function(event){
+
+  let quantity = parseInt(event.target.value);
+  if (isNaN(quantity) || quantity < 0) {
+    event.target.value = $(event.target).attr('prev-value');
+    $(event.target).siblings('.quantity-update-error').text("Please enter a valid quantity.");
+    return;
+  }
+
+  pendingCartChanges[event.target.dataset['productId']] = quantity;
+  clearTimeout(cartChangesTimer);
+  cartChangesTimer = setTimeout(sendCartChanges, 300);
 });
@@ -0,0 +1,31 @@
+$(document).ready(function(){
+
+  let pendingJob = $('.order-job-pending');
+  if (pendingJob.length == 0) {
+    return;
+  }
+
+  let statusURL = pendingJob.attr('data-status-url');
+
+  let pollStatus = function() {
+    $.ajax({
+      type: 'GET',
+      url: statusURL,
+
+      success: function(result){
+        if (result['status'] == 'pending' || result['status'] == 'running') {
+          setTimeout(pollStatus, 1000);
+        } else {
+          // Page shows the order, or redirects with the error message.
+          location.reload();
+        }
+      },
+
+      error: function() {
+        setTimeout(pollStatus, 3000);
+      }
+    });
+  };
+
+  setTimeout(pollStatus, 1000);
+});
@@ -0,0 +1,191 @@
+"""
+    Loads the Shopify store into the local tables: products and their
+    variants, inventory levels and the orders placed through this
+    application. Used by the sync_shopify management command, Eg: run by
+    cron, so that pages are served from a local copy of the store that
+    webhooks keep current in between.
+    A full sync retrieves everything. An incremental sync retrieves only
+    what was updated since the last sync of each resource, which is kept
+    in SyncCheckpoint objects.
+"""
+from datetime import timedelta
+from urllib.parse import quote
+from django.conf import settings
+from django.utils import timezone
+from requests.exceptions import RequestException
+from mishipay.catalog import refresh_catalog
+from mishipay.constants import SHOPIFY_PAGE_LIMIT
+from mishipay.models import (
+    InventoryLevel,
+    Order,
+    Product,
+    ProductVariant,
+    SyncCheckpoint
+)
+from mishipay.shopify_client import (
+    SHOPIFY_UNAVAILABLE_MSG,
+    ShopifyUnavailable,
+)
+from mishipay.shopify_utils import (
+    ShopifyAPIError,
+    iter_orders,
+    iter_shopify_pages,
+    save_inventory_levels,
+    save_orders,
+)
+
+
+SYNC_RESOURCE_PRODUCTS = 'products'
+SYNC_RESOURCE_INVENTORY_LEVELS = 'inventory_levels'
+SYNC_RESOURCE_ORDERS = 'orders'
+# In the order they are synced. Inventory levels update the stock of the
+# products, so products are synced first.
+SYNC_RESOURCES = (SYNC_RESOURCE_PRODUCTS, SYNC_RESOURCE_INVENTORY_LEVELS, SYNC_RESOURCE_ORDERS)
+
+# Shopify accepts at most 50 inventory item or location ids per request.
+INVENTORY_LEVEL_IDS_LIMIT = 50
+
+# Items updated while the last sync ran, or stamped by a Shopify clock
+# slightly ahead of ours, are retrieved again.
+SYNC_CHECKPOINT_OVERLAP = timedelta(minutes=5)
+
+
+def get_updated_at_min_query_param(updated_at_min):
+    if updated_at_min is None:
+        return ''
+    return '&updated_at_min={}'.format(quote(updated_at_min.isoformat()))
+
+
+def iter_chunks(items, size=SHOPIFY_PAGE_LIMIT):
+    """
+        Generator that groups the items of an iterable into lists of at
+        most size items.
+    """
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_inventory_levels(updated_at_min=None):
+    """
+        Generator that yields inventory levels from Shopify one by one.
+        A full sync retrieves the levels of the inventory items of all
+        local variants. An incremental sync retrieves the levels updated
+        at the locations already known since updated_at_min.
+        Raises RequestException or ShopifyAPIError.
+    """
+
+    if updated_at_min is not None:
+        ids_query_param_name = 'location_ids'
+        ids = sorted(set(InventoryLevel.objects.values_list('location_id', flat=True)))
+    if updated_at_min is None or not ids:
+        ids_query_param_name = 'inventory_item_ids'
+        ids = sorted(
+            set(ProductVariant.objects.values_list('inventory_item_id', flat=True)) |
+            set(Product.objects.values_list('inventory_item_id', flat=True))
+        )
+        updated_at_min = None
+
+    for index in range(0, len(ids), INVENTORY_LEVEL_IDS_LIMIT):
+        url = '{}/admin/inventory_levels.json?limit={}&{}={}{}'.format(
+            settings.SHOPIFY_STORE_URL, SHOPIFY_PAGE_LIMIT, ids_query_param_name,
+            ','.join(str(_id) for _id in ids[index:index + INVENTORY_LEVEL_IDS_LIMIT]),
+            get_updated_at_min_query_param(updated_at_min)
+        )
+        for inventory_levels in iter_shopify_pages(url, 'inventory_levels'):
+            for inventory_level in inventory_levels:
+                yield inventory_level
+
+
+def sync_inventory_levels(updated_at_min=None, progress=None):
+    """
+        Load inventory levels from Shopify into the InventoryLevel table,
+        and the stock of products and variants, a page at a time.
+        progress, if passed, is called with the number of inventory levels
+        synced so far after every page.
+        Returns a tuple where first item is the number of inventory levels
+        synced and the second item is an error message.
+    """
+
+    count = 0
+    try:
+        for inventory_levels in iter_chunks(iter_inventory_levels(updated_at_min)):
+            save_inventory_levels(inventory_levels)
+            count = count + len(inventory_levels)
+            if progress:
+                progress(count)
+    except ShopifyUnavailable:
+        return count, SHOPIFY_UNAVAILABLE_MSG
+    except RequestException:
+        return count, 'Error retrieving inventory levels'
+    except ShopifyAPIError as e:
+        return count, 'Error retrieving inventory levels: {}'.format(e)
+    return count, ''
+
+
+def sync_orders(updated_at_min=None, progress=None):
+    """
+        Copy the orders placed through this application, and their line
+        items, from Shopify a page at a time. Other orders of the store
+        are not retrieved.
+        progress, if passed, is called with the number of orders synced
+        so far after every page.
+        Returns a tuple where first item is the number of orders synced
+        and the second item is an error message.
+    """
+
+    shopify_order_ids = list(Order.objects.values_list('shopify_order_id', flat=True))
+    if not shopify_order_ids:
+        return 0, ''
+
+    count = 0
+    try:
+        for orders in iter_chunks(iter_orders(shopify_order_ids, get_updated_at_min_query_param(updated_at_min))):
+            save_orders(orders)
+            count = count + len(orders)
+            if progress:
+                progress(count)
+    except ShopifyUnavailable:
+        return count, SHOPIFY_UNAVAILABLE_MSG
+    except RequestException:
+        return count, 'Error retrieving orders'
+    except ShopifyAPIError as e:
+        return count, 'Error retrieving orders: {}'.format(e)
+    return count, ''
+
+
+SYNC_FUNCTIONS = {
+    # Products are loaded along with their variants.
+    SYNC_RESOURCE_PRODUCTS: refresh_catalog,
+    SYNC_RESOURCE_INVENTORY_LEVELS: sync_inventory_levels,
+    SYNC_RESOURCE_ORDERS: sync_orders,
+}
+
+
+def sync_resource(resource, incremental=False, progress=None):
+    """
+        Sync a resource (one of SYNC_RESOURCES). An incremental sync
+        retrieves only what was updated since the checkpoint of the last
+        sync of the resource, or everything if there is none. The
+        checkpoint is moved only if the sync succeeds.
+        Returns a tuple where first item is the number of items synced and
+        the second item is an error message.
+    """
+
+    started_at = timezone.now()
+    updated_at_min = None
+    if incremental:
+        checkpoint = SyncCheckpoint.objects.filter(resource=resource).first()
+        if checkpoint is not None:
+            updated_at_min = checkpoint.synced_at - SYNC_CHECKPOINT_OVERLAP
+
+    count, err_msg = SYNC_FUNCTIONS[resource](updated_at_min, progress)
+    if not err_msg:
+        SyncCheckpoint.objects.update_or_create(resource=resource, defaults={'synced_at': started_at})
+    return count, err_msg
@@ -1,3 +1,867 @@
-from django.test import TestCase
+import base64
+import hashlib
+import hmac
+import json
+import re
+from collections import deque
+from datetime import (
+    datetime,
+    timedelta,
+)
+from unittest import mock
+from django.db import (
+    IntegrityError,
+    OperationalError,
+    connection,
+)
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+)
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.timezone import utc
+from requests.exceptions import (
+    ConnectionError,
+    ConnectTimeout,
+    ReadTimeout,
+)
+from urllib3.exceptions import (
+    MaxRetryError,
+    NewConnectionError,
+    ProtocolError,
+)
+from custom_user.models import User
+from mishipay.catalog import (
+    CATALOG_FILL_INTERVAL,
+    CATALOG_FILL_RESOURCE,
+    claim_catalog_fill,
+    get_product_page,
+    refresh_catalog,
+)
+from mishipay.constants import (
+    ORDER_JOB_STATUS_FAILED,
+    ORDER_JOB_STATUS_RUNNING,
+    ORDER_JOB_STATUS_SUCCEEDED,
+)
+from mishipay.db_utils import bulk_update
+from mishipay.fake_shopify import (
+    FakeShopifyServer,
+    FakeShopifyStore,
+)
+from mishipay.middleware import get_queries_logged_after
+from mishipay.models import (
+    CartItem,
+    InventoryLevel,
+    Order,
+    OrderJob,
+    Product,
+    SyncCheckpoint,
+    WebhookEvent,
+)
+from mishipay import order_jobs
+from mishipay.order_jobs import (
+    claim_next_order_job,
+    enqueue_order_placement,
+    get_idempotency_key,
+)
+from mishipay.shopify_client import (
+    PRIORITY_CHECKOUT,
+    CircuitBreaker,
+    LeakyBucket,
+    ShopifyUnavailable,
+    get_session,
+    reset_session,
+)
+from mishipay.shopify_utils import (
+    is_request_not_sent,
+    post_order_cancellation,
+    save_created_order,
+)
+from mishipay.views import MyOrders
+from mishipay.webhooks import (
+    coalesce_webhook_events,
+    process_webhook_events,
+)
+
+
+def create_user(username='user'):
+    return User.objects.create_user(
+        username, '{}@example.com'.format(username), 'password',
+        address='Address', phone_number=9999999999
+    )
+
+
+def create_product(shopify_product_id, **kwargs):
+    fields = {
+        'title': 'Product {}'.format(shopify_product_id),
+        'variant_id': 2000 + shopify_product_id,
+        'inventory_item_id': 3000 + shopify_product_id,
+        'price': '10.00',
+        'inventory_quantity': 5,
+        'in_stock': True,
+    }
+    fields.update(kwargs)
+    return Product.objects.create(shopify_product_id=shopify_product_id, **fields)
+
+
+class FakeClock(object):
+    """
+        Stands in for the time module in mishipay.shopify_client, so that
+        waits are recorded instead of slept.
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now = self.now + seconds
+
+
+class ShopifyClientTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('mishipay.shopify_client.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class LeakyBucketTests(ShopifyClientTestCase):
+
+    @override_settings(SHOPIFY_RATE_LIMIT_MAX_WAIT=10)
+    def test_checkout_calls_use_the_reserved_calls(self):
+        bucket = LeakyBucket(size=10, leak_rate=2, reserved=3)
+        bucket.level = 6
+
+        bucket.acquire(PRIORITY_CHECKOUT)
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(bucket.level, 7)
+
+        # Other calls leave 3 calls free, so they wait for the bucket to
+        # leak down to 5.
+        bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [1.0])
+        self.assertEqual(bucket.level, 6)
+
+    @override_settings(SHOPIFY_RATE_LIMIT_MAX_WAIT=0.5)
+    def test_calls_are_made_after_the_max_wait(self):
+        bucket = LeakyBucket(size=10, leak_rate=2, reserved=3)
+        bucket.fill()
+
+        bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+
+    def test_level_is_taken_from_the_call_limit_header(self):
+        bucket = LeakyBucket(size=40, leak_rate=2, reserved=10)
+
+        bucket.update('32/80')
+        self.assertEqual((bucket.level, bucket.size), (32, 80))
+
+        for invalid_header in (None, '', 'x/40'):
+            bucket.update(invalid_header)
+        self.assertEqual((bucket.level, bucket.size), (32, 80))
+
+
+class CircuitBreakerTests(ShopifyClientTestCase):
+
+    def setUp(self):
+        super(CircuitBreakerTests, self).setUp()
+        self.circuit_breaker = CircuitBreaker(failure_threshold=3, latency_budget=1, reset_timeout=30)
+
+    def open_circuit_breaker(self):
+        for attempt in range(3):
+            self.circuit_breaker.before_call()
+            self.circuit_breaker.record_call(None, 0.1)
+        self.assertTrue(self.circuit_breaker.is_open)
+
+    def test_opens_after_consecutive_failures(self):
+        for status_code in (500, 503, 200, None, 502):
+            self.circuit_breaker.record_call(status_code, 0.1)
+        self.assertFalse(self.circuit_breaker.is_open)
+
+        self.circuit_breaker.record_call(None, 0.1)
+        self.assertTrue(self.circuit_breaker.is_open)
+        with self.assertRaises(ShopifyUnavailable):
+            self.circuit_breaker.before_call()
+
+    def test_slow_calls_fail_and_rate_limited_calls_do_not(self):
+        for attempt in range(5):
+            self.circuit_breaker.record_call(429, 0.1)
+        self.assertFalse(self.circuit_breaker.is_open)
+
+        for attempt in range(3):
+            self.circuit_breaker.record_call(200, 1.5)
+        self.assertTrue(self.circuit_breaker.is_open)
+
+    def test_successful_trial_call_closes(self):
+        self.open_circuit_breaker()
+
+        self.clock.now = self.clock.now + 30
+        self.assertFalse(self.circuit_breaker.is_open)
+        self.circuit_breaker.before_call()
+        # Only a single trial call is let through.
+        with self.assertRaises(ShopifyUnavailable):
+            self.circuit_breaker.before_call()
+
+        self.circuit_breaker.record_call(200, 0.1)
+        self.assertFalse(self.circuit_breaker.is_open)
+        self.circuit_breaker.before_call()
+
+    def test_failed_trial_call_opens_again(self):
+        self.open_circuit_breaker()
+
+        self.clock.now = self.clock.now + 30
+        self.circuit_breaker.before_call()
+        self.circuit_breaker.record_call(None, 0.1)
+        self.assertTrue(self.circuit_breaker.is_open)
+
+        self.clock.now = self.clock.now + 29
+        self.assertTrue(self.circuit_breaker.is_open)
+        self.clock.now = self.clock.now + 1
+        self.assertFalse(self.circuit_breaker.is_open)
+
+
+class FakeShopifyTestCase(TestCase):
+    """
+        Points the Shopify session to a FakeShopifyServer.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(FakeShopifyTestCase, cls).setUpClass()
+        cls.server = FakeShopifyServer(store=FakeShopifyStore(product_count=5, inventory_quantity=10))
+        cls.server.start()
+        cls.settings_override = override_settings(SHOPIFY_STORE_URL=cls.server.url)
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.server.stop()
+        reset_session()
+        super(FakeShopifyTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        reset_session()
+
+    def get_available(self, inventory_item_id):
+        return self.server.store.inventory_levels[inventory_item_id]['available']
+
+
+class CompensatingCallTests(FakeShopifyTestCase):
+
+    def test_compensating_calls_are_made_while_the_circuit_breaker_is_open(self):
+        session = get_session()
+        url = '{}/admin/products.json'.format(self.server.url)
+        with mock.patch.object(session.circuit_breaker, 'before_call', side_effect=ShopifyUnavailable):
+            with self.assertRaises(ShopifyUnavailable):
+                session.get(url)
+            self.assertEqual(session.get(url, compensating=True).status_code, 200)
+
+
+@override_settings(ORDER_JOBS_ALWAYS_EAGER=False)
+class OrderJobTimeoutTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+        self.cart = {'1001': 1, '1002': 2}
+
+    @override_settings(ORDER_JOB_TIMEOUT=600)
+    def test_timed_out_running_job_is_failed(self):
+        job = enqueue_order_placement(self.user, self.cart, get_idempotency_key(client_key='key'))
+        self.assertEqual(claim_next_order_job(), job)
+        OrderJob.objects.filter(id=job.id).update(claimed_at=timezone.now() - timedelta(seconds=601))
+
+        self.assertIsNone(claim_next_order_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ORDER_JOB_STATUS_FAILED)
+        self.assertNotEqual(
+            enqueue_order_placement(self.user, self.cart, get_idempotency_key(client_key='key')), job
+        )
+
+    @override_settings(ORDER_JOB_TIMEOUT=600)
+    def test_timed_out_job_that_created_its_order_succeeds(self):
+        job = enqueue_order_placement(self.user, self.cart)
+        CartItem.objects.create(user=self.user, product_id=1001, quantity=1, product_title='Product', price='10.00')
+        claim_next_order_job()
+        OrderJob.objects.filter(id=job.id).update(
+            shopify_order_id=5001,
+            result=json.dumps({'id': 5001, 'line_items': [], 'total_price': '10.00'}),
+            claimed_at=timezone.now() - timedelta(seconds=601)
+        )
+
+        self.assertIsNone(claim_next_order_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ORDER_JOB_STATUS_SUCCEEDED)
+        order = Order.objects.get(shopify_order_id=5001)
+        self.assertEqual((order.user, str(order.total_price)), (self.user, '10.00'))
+        self.assertFalse(CartItem.objects.filter(user=self.user).exists())
+
+    def test_running_job_is_not_failed_before_the_timeout(self):
+        job = enqueue_order_placement(self.user, self.cart)
+        claim_next_order_job()
+
+        claim_next_order_job()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ORDER_JOB_STATUS_RUNNING)
+
+
+@override_settings(ORDER_JOBS_ALWAYS_EAGER=False)
+class OrderJobIdempotencyTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+        self.cart = {'1001': 1, '1002': 2}
+
+    def test_same_key_returns_the_same_job(self):
+        job = enqueue_order_placement(self.user, self.cart, get_idempotency_key(client_key='key'))
+
+        self.assertEqual(enqueue_order_placement(self.user, self.cart, get_idempotency_key(client_key='key')), job)
+        # Without a client key, the cart is the key.
+        cart_job = enqueue_order_placement(self.user, self.cart)
+        self.assertNotEqual(cart_job, job)
+        self.assertEqual(enqueue_order_placement(self.user, {'1002': 2, '1001': 1}), cart_job)
+        self.assertEqual(OrderJob.objects.count(), 2)
+
+    def test_failed_job_releases_its_key(self):
+        idempotency_key = get_idempotency_key(client_key='key')
+        job = enqueue_order_placement(self.user, self.cart, idempotency_key)
+        OrderJob.objects.filter(id=job.id).update(status=ORDER_JOB_STATUS_FAILED)
+
+        retried_job = enqueue_order_placement(self.user, self.cart, idempotency_key)
+        self.assertNotEqual(retried_job, job)
+        self.assertIsNone(OrderJob.objects.get(id=job.id).idempotency_key)
+
+    def test_job_created_by_a_concurrent_request_is_returned(self):
+        idempotency_key = get_idempotency_key(client_key='key')
+        concurrent_job = OrderJob.objects.create(
+            order_type='placed', user=self.user, payload='{}', idempotency_key=idempotency_key
+        )
+
+        # The concurrent job is created after this request looked for one,
+        # so creating another violates unique_together.
+        get_idempotent_order_job = order_jobs.get_idempotent_order_job
+        with mock.patch.object(
+            order_jobs, 'get_idempotent_order_job',
+            side_effect=[None, get_idempotent_order_job(self.user, idempotency_key)]
+        ):
+            job = enqueue_order_placement(self.user, self.cart, idempotency_key)
+
+        self.assertEqual(job, concurrent_job)
+        self.assertEqual(OrderJob.objects.count(), 1)
+
+    def test_job_that_keeps_conflicting_raises(self):
+        with mock.patch.object(order_jobs, 'get_idempotent_order_job', return_value=None), \
+                mock.patch.object(OrderJob.objects, 'create', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                enqueue_order_placement(self.user, self.cart, get_idempotency_key(client_key='key'))
+
+
+@override_settings(ORDER_JOBS_ALWAYS_EAGER=True)
+class PlaceOrderTests(FakeShopifyTestCase):
+
+    def setUp(self):
+        super(PlaceOrderTests, self).setUp()
+        self.user = create_user()
+        self.client.login(username='user', password='password')
+        self.product = self.server.store.get_products()[0]
+        self.variant = self.product['variants'][0]
+        CartItem.objects.create(
+            user=self.user,
+            product_id=self.product['id'],
+            quantity=2,
+            product_title=self.product['title'],
+            price=self.variant['price'],
+            variant_id=self.variant['id'],
+            inventory_item_id=self.variant['inventory_item_id'],
+            snapshot_at=timezone.now()
+        )
+
+    def test_repeated_placement_places_one_order(self):
+        order_count = len(self.server.store.orders)
+        available = self.get_available(self.variant['inventory_item_id'])
+
+        first_response = self.client.get(reverse('place_order'), {'idempotency_key': 'key'})
+        second_response = self.client.get(reverse('place_order'), {'idempotency_key': 'key'})
+
+        self.assertEqual(first_response['Location'], second_response['Location'])
+        job = OrderJob.objects.get()
+        self.assertEqual(job.status, ORDER_JOB_STATUS_SUCCEEDED)
+        self.assertEqual(len(self.server.store.orders), order_count + 1)
+        self.assertEqual(self.get_available(self.variant['inventory_item_id']), available - 2)
+        self.assertTrue(Order.objects.filter(user=self.user, shopify_order_id=job.shopify_order_id).exists())
+        self.assertFalse(CartItem.objects.filter(user=self.user).exists())
+
+    def test_order_is_placed_when_the_local_inventory_can_not_be_saved(self):
+        with mock.patch('mishipay.shopify_utils.bulk_update', side_effect=OperationalError('database is locked')):
+            self.client.get(reverse('place_order'), {'idempotency_key': 'key'})
+
+        self.assertEqual(OrderJob.objects.get().status, ORDER_JOB_STATUS_SUCCEEDED)
+
+    def test_order_is_recorded_when_it_can_not_be_saved_locally(self):
+        recorded_shopify_order_ids = []
+
+        def fail_local_write(*args, **kwargs):
+            recorded_shopify_order_ids.append(OrderJob.objects.get().shopify_order_id)
+            raise OperationalError('database is locked')
+
+        with mock.patch('mishipay.shopify_utils.save_orders', side_effect=fail_local_write):
+            self.client.get(reverse('place_order'), {'idempotency_key': 'key'})
+
+        job = OrderJob.objects.get()
+        self.assertEqual(job.status, ORDER_JOB_STATUS_SUCCEEDED)
+        # The order was recorded in the job before the local write.
+        self.assertEqual(recorded_shopify_order_ids, [job.shopify_order_id])
+        self.assertIn(job.shopify_order_id, self.server.store.orders)
+        self.assertFalse(Order.objects.exists())
+        # Saving the order again creates a single local copy.
+        for index in range(2):
+            self.assertEqual(save_created_order(self.user, json.loads(job.result)), (True, ''))
+        self.assertEqual(Order.objects.get().shopify_order_id, job.shopify_order_id)
+
+    def test_cancellation_with_an_invalid_response_fails(self):
+        shopify_order_id = Order.objects.create(shopify_order_id=5001, user=self.user).shopify_order_id
+
+        response = mock.Mock(status_code=502)
+        response.json.side_effect = ValueError('No JSON object could be decoded')
+        with mock.patch.object(get_session(), 'post', return_value=response):
+            self.assertEqual(post_order_cancellation(shopify_order_id), (False, 'Error cancelling order'))
+        self.assertIsNone(Order.objects.get(shopify_order_id=shopify_order_id).cancelled_at)
+
+    def place_order_failing(self, error, sent=False, lookup_error=None):
+        """
+            Place the order of the cart. Creating the Shopify order raises
+            error, after the order was created if sent is True. Looking up
+            orders raises lookup_error, if passed.
+        """
+
+        session = get_session()
+        request = session.request
+
+        def fail_order_creation(method, url, **kwargs):
+            if method == 'POST' and url.endswith('/admin/orders.json'):
+                if sent:
+                    request(method, url, **kwargs)
+                raise error
+            if lookup_error and method == 'GET' and '/admin/orders.json' in url:
+                raise lookup_error
+            return request(method, url, **kwargs)
+
+        with mock.patch.object(session, 'request', side_effect=fail_order_creation):
+            self.client.get(reverse('place_order'), {'idempotency_key': 'key'})
+        return OrderJob.objects.get()
+
+    def test_inventory_is_restored_when_the_order_does_not_reach_shopify(self):
+        available = self.get_available(self.variant['inventory_item_id'])
+
+        job = self.place_order_failing(ShopifyUnavailable())
+
+        self.assertEqual(job.status, ORDER_JOB_STATUS_FAILED)
+        self.assertEqual(self.get_available(self.variant['inventory_item_id']), available)
+        self.assertTrue(CartItem.objects.filter(user=self.user).exists())
+
+    def test_order_that_was_not_created_is_looked_up_before_restoring_inventory(self):
+        available = self.get_available(self.variant['inventory_item_id'])
+        order_count = len(self.server.store.orders)
+
+        job = self.place_order_failing(ConnectionError('Connection reset by peer'))
+
+        self.assertEqual(job.status, ORDER_JOB_STATUS_FAILED)
+        self.assertEqual(len(self.server.store.orders), order_count)
+        self.assertEqual(self.get_available(self.variant['inventory_item_id']), available)
+
+    def test_order_created_before_the_connection_was_reset_succeeds(self):
+        available = self.get_available(self.variant['inventory_item_id'])
+        order_count = len(self.server.store.orders)
+
+        job = self.place_order_failing(ConnectionError('Connection reset by peer'), sent=True)
+
+        self.assertEqual(job.status, ORDER_JOB_STATUS_SUCCEEDED)
+        self.assertEqual(len(self.server.store.orders), order_count + 1)
+        self.assertEqual(self.get_available(self.variant['inventory_item_id']), available - 2)
+        self.assertTrue(Order.objects.filter(user=self.user, shopify_order_id=job.shopify_order_id).exists())
+
+    def test_inventory_is_not_restored_when_the_order_can_not_be_looked_up(self):
+        available = self.get_available(self.variant['inventory_item_id'])
+
+        job = self.place_order_failing(ConnectionError('Connection reset by peer'), lookup_error=ShopifyUnavailable())
+
+        self.assertEqual(job.status, ORDER_JOB_STATUS_FAILED)
+        self.assertEqual(self.get_available(self.variant['inventory_item_id']), available - 2)
+
+    def test_refused_connection_is_not_sent(self):
+        refused = NewConnectionError(None, 'Connection refused')
+        self.assertTrue(is_request_not_sent(ConnectionError(MaxRetryError(None, '/admin/orders.json', refused))))
+        self.assertTrue(is_request_not_sent(ConnectTimeout()))
+        self.assertFalse(is_request_not_sent(ConnectionError(ProtocolError('Connection aborted.'))))
+        self.assertFalse(is_request_not_sent(ReadTimeout()))
+
+
+@override_settings(SHOPIFY_WEBHOOK_SECRET='secret', WEBHOOKS_ALWAYS_EAGER=False)
+class WebhookTests(TestCase):
+
+    def post_webhook(self, topic, payload, webhook_id, secret='secret'):
+        body = json.dumps(payload).encode('utf-8')
+        digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+        return self.client.post(
+            reverse('webhook'), body,
+            content_type='application/json',
+            HTTP_X_SHOPIFY_TOPIC=topic,
+            HTTP_X_SHOPIFY_HMAC_SHA256=base64.b64encode(digest).decode('utf-8'),
+            HTTP_X_SHOPIFY_WEBHOOK_ID=webhook_id
+        )
+
+    def inventory_level(self, available, updated_at):
+        return {
+            'inventory_item_id': 3001,
+            'location_id': 1,
+            'available': available,
+            'updated_at': updated_at,
+        }
+
+    def test_invalid_hmac_is_refused(self):
+        response = self.post_webhook('products/delete', {'id': 1}, 'webhook', secret='other')
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_repeated_delivery_is_stored_once(self):
+        for attempt in range(2):
+            response = self.post_webhook('products/delete', {'id': 1}, 'webhook')
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_latest_update_wins_whatever_the_delivery_order(self):
+        events = [
+            WebhookEvent(topic='inventory_levels/update', payload=json.dumps(payload))
+            for payload in (
+                self.inventory_level(5, '2026-01-01T10:00:00Z'),
+                self.inventory_level(3, '2026-01-01T12:00:00Z'),
+                # Delivered last, but older than the previous update.
+                self.inventory_level(8, '2026-01-01T11:00:00Z'),
+            )
+        ] + [
+            WebhookEvent(topic='products/update', payload=json.dumps({'id': 1, 'updated_at': '2026-01-01T10:00:00Z'})),
+            WebhookEvent(topic='products/delete', payload=json.dumps({'id': 1})),
+        ]
+
+        products, inventory_levels, orders = coalesce_webhook_events(events)
+
+        self.assertEqual(inventory_levels[3001]['available'], 3)
+        self.assertEqual(products[1][0], 'products/delete')
+        self.assertEqual(orders, {})
+
+    def test_events_are_applied_once_per_item(self):
+        create_product(1)
+        self.post_webhook('inventory_levels/update', self.inventory_level(5, '2026-01-01T10:00:00Z'), '1')
+        self.post_webhook('inventory_levels/update', self.inventory_level(0, '2026-01-01T11:00:00Z'), '2')
+
+        with mock.patch('mishipay.webhooks.save_inventory_levels') as save_inventory_levels:
+            self.assertEqual(process_webhook_events(), 2)
+        save_inventory_levels.assert_called_once_with([self.inventory_level(0, '2026-01-01T11:00:00Z')])
+        self.assertFalse(WebhookEvent.objects.filter(processed_at__isnull=True).exists())
+
+        self.post_webhook('inventory_levels/update', self.inventory_level(0, '2026-01-01T12:00:00Z'), '3')
+        process_webhook_events()
+        product = Product.objects.get(shopify_product_id=1)
+        self.assertEqual((product.inventory_quantity, product.in_stock), (0, False))
+        self.assertEqual(InventoryLevel.objects.get(inventory_item_id=3001).available, 0)
+
+    @override_settings(WEBHOOK_MAX_ATTEMPTS=2, WEBHOOK_RETRY_BACKOFF=30)
+    def test_failed_events_are_retried(self):
+        self.post_webhook('inventory_levels/update', self.inventory_level(5, '2026-01-01T10:00:00Z'), '1')
+        self.post_webhook('products/delete', {'id': 1}, '2')
+
+        with mock.patch('mishipay.webhooks.save_inventory_levels', side_effect=OperationalError('database is locked')):
+            self.assertEqual(process_webhook_events(), 2)
+        event = WebhookEvent.objects.get(webhook_id='1')
+        self.assertIsNone(event.processed_at)
+        self.assertEqual(event.attempts, 1)
+        self.assertIsNotNone(WebhookEvent.objects.get(webhook_id='2').processed_at)
+
+        # Later events of the same kind wait for the failed one.
+        self.post_webhook('inventory_levels/update', self.inventory_level(3, '2026-01-01T11:00:00Z'), '3')
+        self.assertEqual(process_webhook_events(), 0)
+
+        WebhookEvent.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(process_webhook_events(), 2)
+        self.assertEqual(InventoryLevel.objects.get(inventory_item_id=3001).available, 3)
+
+    @override_settings(WEBHOOK_MAX_ATTEMPTS=2)
+    def test_failed_events_are_given_up_on(self):
+        self.post_webhook('inventory_levels/update', self.inventory_level(5, '2026-01-01T10:00:00Z'), '1')
+
+        with mock.patch('mishipay.webhooks.save_inventory_levels', side_effect=OperationalError('database is locked')):
+            process_webhook_events()
+            WebhookEvent.objects.update(next_attempt_at=timezone.now())
+            process_webhook_events()
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.attempts, 2)
+        self.assertIsNotNone(event.processed_at)
+        self.assertIn('database is locked', event.err_msg)
+
+    def test_malformed_event_fails_alone(self):
+        products = FakeShopifyStore(product_count=3).get_products()
+        malformed_product = dict(products[1])
+        del malformed_product['variants']
+        self.post_webhook('products/update', products[0], '1')
+        self.post_webhook('products/update', malformed_product, '2')
+        self.post_webhook('inventory_levels/update', self.inventory_level(5, '2026-01-01T10:00:00Z'), '3')
+
+        self.assertEqual(process_webhook_events(), 3)
+
+        self.assertEqual(
+            list(Product.objects.values_list('shopify_product_id', flat=True)),
+            [products[0]['id']]
+        )
+        self.assertEqual(InventoryLevel.objects.get(inventory_item_id=3001).available, 5)
+        self.assertEqual(
+            list(WebhookEvent.objects.filter(processed_at__isnull=True).values_list('webhook_id', 'attempts')),
+            [('2', 1)]
+        )
+        self.assertIn('KeyError', WebhookEvent.objects.get(webhook_id='2').err_msg)
+
+        # Only later events of the same product wait for the failed one.
+        self.post_webhook('products/update', products[1], '4')
+        self.post_webhook('products/update', products[2], '5')
+        self.assertEqual(process_webhook_events(), 1)
+        self.assertTrue(Product.objects.filter(shopify_product_id=products[2]['id']).exists())
+        self.assertIsNone(WebhookEvent.objects.get(webhook_id='4').processed_at)
+
+    def test_failed_event_is_superseded_by_a_newer_one(self):
+        products = FakeShopifyStore(product_count=1).get_products()
+        malformed_product = dict(products[0], updated_at='2026-01-01T10:00:00Z')
+        del malformed_product['variants']
+        self.post_webhook('products/update', malformed_product, '1')
+        self.post_webhook('products/update', dict(products[0], updated_at='2026-01-01T11:00:00Z'), '2')
+
+        process_webhook_events()
+
+        self.assertFalse(WebhookEvent.objects.filter(processed_at__isnull=True).exists())
+        self.assertTrue(Product.objects.filter(shopify_product_id=products[0]['id']).exists())
+
+    def test_invalid_payload_is_given_up_on_at_once(self):
+        self.assertEqual(self.post_webhook('products/update', [], '1').status_code, 400)
+        WebhookEvent.objects.create(webhook_id='1', topic='products/update', payload='[]')
+
+        self.assertEqual(process_webhook_events(), 1)
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.attempts, event.err_msg), (1, 'Invalid payload'))
+        self.assertIsNotNone(event.processed_at)
+
+
+class BulkUpdateTests(TestCase):
+
+    def setUp(self):
+        for shopify_product_id in range(1, 6):
+            create_product(shopify_product_id)
+
+    def get_prices(self):
+        return dict(Product.objects.values_list('shopify_product_id', 'price'))
+
+    def test_changed_rows_are_updated(self):
+        bulk_update(Product, 'shopify_product_id', {
+            1: {'price': '12.50', 'inventory_quantity': 0},
+            2: {'price': '10.00', 'inventory_quantity': 7},
+        }, ['price', 'inventory_quantity'])
+
+        self.assertEqual(
+            list(Product.objects.order_by('shopify_product_id').values_list('price', 'inventory_quantity')),
+            [(12.5, 0), (10, 7), (10, 5), (10, 5), (10, 5)]
+        )
+
+    def test_unchanged_rows_are_skipped(self):
+        with self.assertNumQueries(1):
+            bulk_update(Product, 'shopify_product_id', {
+                shopify_product_id: {'price': '10.00'} for shopify_product_id in range(1, 6)
+            }, ['price'])
+
+    def test_rows_are_updated_in_batches(self):
+        with mock.patch.object(connection.ops, 'bulk_batch_size', return_value=2):
+            # A SELECT and an UPDATE per batch.
+            with self.assertNumQueries(6):
+                bulk_update(Product, 'shopify_product_id', {
+                    shopify_product_id: {'price': '{}.00'.format(shopify_product_id)}
+                    for shopify_product_id in range(1, 6)
+                }, ['price'])
+
+        self.assertEqual(self.get_prices(), {1: 1, 2: 2, 3: 3, 4: 4, 5: 5})
+
+
+class ProductPageTests(TestCase):
+
+    def setUp(self):
+        for shopify_product_id in range(1, 7):
+            create_product(shopify_product_id, in_stock=shopify_product_id != 3)
+
+    def get_page(self, **kwargs):
+        products, previous_cursor, next_cursor = get_product_page(limit=2, **kwargs)
+        return [product.shopify_product_id for product in products], previous_cursor, next_cursor
+
+    def test_pages_follow_the_cursors(self):
+        self.assertEqual(self.get_page(), ([1, 2], None, 2))
+        self.assertEqual(self.get_page(after=2), ([4, 5], 4, 5))
+        self.assertEqual(self.get_page(after=5), ([6], 6, None))
+
+    def test_previous_pages_follow_the_cursors(self):
+        self.assertEqual(self.get_page(before=6), ([4, 5], 4, 5))
+        self.assertEqual(self.get_page(before=4), ([1, 2], None, 2))
+
+
+class RefreshCatalogTests(FakeShopifyTestCase):
+
+    def get_shopify_product_ids(self):
+        return set(Product.objects.values_list('shopify_product_id', flat=True))
+
+    @mock.patch('mishipay.catalog.SHOPIFY_PAGE_LIMIT', 2)
+    def test_products_that_were_not_seen_are_deleted(self):
+        create_product(1)
+        # Created by a webhook while the catalog is loaded.
+        create_product(2, synced_at=timezone.now() + timedelta(minutes=1))
+
+        self.assertEqual(refresh_catalog(), (5, ''))
+
+        store_product_ids = set(product['id'] for product in self.server.store.get_products())
+        self.assertEqual(self.get_shopify_product_ids(), store_product_ids | {2})
+
+    def test_incremental_load_deletes_nothing(self):
+        create_product(1)
+
+        refresh_catalog(updated_at_min=timezone.now())
+
+        self.assertIn(1, self.get_shopify_product_ids())
+
+
+class CatalogFillTests(FakeShopifyTestCase):
+
+    def test_catalog_fill_is_claimed_once_per_interval(self):
+        self.assertTrue(claim_catalog_fill())
+        self.assertFalse(claim_catalog_fill())
+
+        SyncCheckpoint.objects.filter(resource=CATALOG_FILL_RESOURCE).update(
+            synced_at=timezone.now() - timedelta(seconds=CATALOG_FILL_INTERVAL)
+        )
+        self.assertTrue(claim_catalog_fill())
+        self.assertFalse(claim_catalog_fill())
+
+    @override_settings(CATALOG_FILL_ALWAYS_EAGER=True)
+    def test_empty_catalog_is_loaded_by_the_product_listing(self):
+        create_user()
+        self.client.login(username='user', password='password')
+
+        response = self.client.get(reverse('product_listing'))
+
+        self.assertEqual(
+            [product.shopify_product_id for product in response.context['products']],
+            [product['id'] for product in self.server.store.get_products()]
+        )
+
+
+class MyOrdersTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+        self.client.login(username='user', password='password')
+        created_at = timezone.now()
+        # Orders 3 and 4 were placed at the same time.
+        for index, minutes in enumerate((50, 40, 30, 30, 20), 1):
+            Order.objects.create(
+                shopify_order_id=index,
+                user=self.user,
+                created_at=created_at - timedelta(minutes=minutes),
+                synced_at=created_at
+            )
+        Order.objects.create(shopify_order_id=6, user=create_user('other'), created_at=created_at, synced_at=created_at)
+
+    def get_page(self, after=None):
+        params = {'limit': 2}
+        if after:
+            params['after'] = after
+        response = self.client.get(reverse('my_orders'), params)
+        self.assertEqual(response.status_code, 200)
+        return [order.shopify_order_id for order in response.context['orders']], response.context['next_cursor']
+
+    def test_pages_follow_the_cursor(self):
+        shopify_order_ids, cursor = self.get_page()
+        self.assertEqual(shopify_order_ids, [5, 4])
+        shopify_order_ids, cursor = self.get_page(cursor)
+        self.assertEqual(shopify_order_ids, [3, 2])
+        shopify_order_ids, cursor = self.get_page(cursor)
+        self.assertEqual((shopify_order_ids, cursor), ([1], None))
+
+    def test_invalid_cursor_serves_the_first_page(self):
+        for cursor in ('invalid', '1_2_3', '99999999999999999999_1', '-99999999999999999999_1'):
+            self.assertEqual(self.get_page(cursor)[0], [5, 4])
+
+    def test_cursor_keeps_every_microsecond(self):
+        Order.objects.all().delete()
+        # Far enough from the epoch for a float to lose microseconds.
+        created_at = datetime(3000, 1, 1, 0, 0, 0, 36, tzinfo=utc)
+        for index in range(1, 4):
+            Order.objects.create(
+                shopify_order_id=index,
+                user=self.user,
+                created_at=created_at + timedelta(microseconds=index),
+                synced_at=created_at
+            )
+
+        self.assertEqual(MyOrders.decode_cursor(MyOrders.encode_cursor(Order.objects.get(shopify_order_id=1))), (
+            created_at + timedelta(microseconds=1), Order.objects.get(shopify_order_id=1).id
+        ))
+        shopify_order_ids, cursor = self.get_page()
+        self.assertEqual(shopify_order_ids, [3, 2])
+        self.assertEqual(self.get_page(cursor), ([1], None))
+
+    @mock.patch('mishipay.views.is_shopify_available', return_value=False)
+    def test_unsynced_orders_are_listed_as_pending_sync(self, is_shopify_available):
+        Order.objects.create(shopify_order_id=7, user=self.user)
+
+        shopify_order_ids, cursor = self.get_page()
+        self.assertEqual(shopify_order_ids, [7, 5])
+        response = self.client.get(reverse('my_orders'), {'limit': 2})
+        self.assertContains(response, 'Pending sync', count=1)
+
+
+class RequestTimingTests(TestCase):
+
+    def setUp(self):
+        create_user()
+        self.client.login(username='user', password='password')
+
+    def get_db_timing(self):
+        response = self.client.get(reverse('my_orders'))
+        return [timing for timing in response['Server-Timing'].split(', ') if timing.startswith('db;')][0]
+
+    def test_queries_are_not_counted_by_default(self):
+        self.assertIn('desc="0 queries"', self.get_db_timing())
+        self.assertFalse(connection.force_debug_cursor)
+
+    @override_settings(REQUEST_TIMING_DB_QUERIES=True)
+    def test_queries_are_counted_when_the_log_is_full(self):
+        db_query_count = int(re.search(r'(\d+) queries', self.get_db_timing()).group(1))
+        self.assertGreater(db_query_count, 0)
+
+        # Filled by earlier requests.
+        connection.queries_log.extend({'sql': '', 'time': '0'} for index in range(connection.queries_log.maxlen))
+        self.assertIn('desc="{} queries"'.format(db_query_count), self.get_db_timing())
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_queries_logged_after_the_last_query_are_returned(self):
+        queries = [{'sql': str(index)} for index in range(5)]
+        queries_log = deque(queries[:2], maxlen=3)
+        queries_log.extend(queries[2:])
+
+        self.assertEqual(get_queries_logged_after(queries_log, queries[1]), queries[2:])
+        self.assertEqual(get_queries_logged_after(queries_log, queries[4]), [])
+        self.assertEqual(get_queries_logged_after(deque(queries[:2]), None), queries[:2])
 
-# Create your tests here.
@@ -3,12 +3,18 @@ from mishipay.views import (
     get_access_token,
     access_token,
     ProductListing,
+    ProductListAPI,
     AddtoCartAPI,
     UpdateDestroyCartItemAPI,
     Cart,
+    CartAPI,
     place_order,
     cancel_order,
-    MyOrders
+    OrderJobView,
+    OrderJobStatusAPI,
+    MyOrders,
+    webhook,
+    metrics_view
 )
 
 urlpatterns = [
@@ -16,10 +22,21 @@ urlpatterns = [
     url(r'^get-access-token/', get_access_token, name="get_access_token"),
     url(r'^access-token/', access_token, name="access_token"),
     url(r'^products/$', ProductListing.as_view(), name='product_listing'),
+    url(r'^api/products/$', ProductListAPI.as_view(), name='product_list_api'),
     url(r'^add-to-cart/$', AddtoCartAPI.as_view(), name='add_to_cart'),
     url(r'^update-cart-item/(?P<pk>[0-9]+)/$', UpdateDestroyCartItemAPI.as_view(), name='add_to_cart'),
     url(r'^cart/$', Cart.as_view(), name='cart'),
+    url(r'^api/cart/$', CartAPI.as_view(), name='cart_api'),
     url(r'^my-orders/$', MyOrders.as_view(), name='my_orders'),
     url(r'^place-order/$', place_order, name='place_order'),
     url(r'^cancel-order/(?P<shopify_order_id>[0-9]+)$', cancel_order, name='cancel_order'),
+    url(r'^orders/(?P<pk>[0-9]+)/$', OrderJobView.as_view(), name='order_job'),
+    url(r'^api/orders/(?P<pk>[0-9]+)/status/$', OrderJobStatusAPI.as_view(), name='order_job_status'),
+    url(r'^webhooks/$', webhook, name='webhook'),
+    url(
+        r'^webhooks/(?P<topic>products/(?:create|update|delete)|inventory_levels/update|orders/(?:updated|cancelled))/$',
+        webhook,
+        name='topic_webhook'
+    ),
+    url(r'^metrics/$', metrics_view, name='metrics'),
 ]
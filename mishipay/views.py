@@ -1,11 +1,19 @@
+import hmac
 import urllib
+import uuid
 import requests
 import json
 import shopify
+from datetime import (
+    datetime,
+    timedelta,
+)
 
 from django.conf import settings
 
 from django.urls import reverse
+from django.db.models import Q
+from django.utils.timezone import utc
 
 from django.contrib.auth import (
     login,
@@ -22,39 +30,98 @@ from mishipay.custom_authentication import CsrfExemptSessionAuthentication
 
 from django.views import View
 from django.views.generic.base import TemplateView
+from rest_framework.filters import OrderingFilter
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.generics import (
     CreateAPIView,
+    ListAPIView,
+    RetrieveAPIView,
     UpdateAPIView,
     DestroyAPIView
 )
 
 from django.http import (
     HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
     HttpResponseRedirect,
 )
 from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from mishipay.models import (
     CartItem,
-    Order
+    Order,
+    OrderJob,
+    Product
+)
+from mishipay.serializers import (
+    AddToCartSerializer,
+    CartChangesSerializer,
+    CartItemSerializer,
+    OrderJobSerializer,
+    ProductSerializer
+)
+from mishipay.constants import (
+    ORDER_TYPE_PLACED,
+    ORDER_JOB_STATUS_SUCCEEDED,
+    ORDER_JOB_STATUS_FAILED,
+)
+from mishipay.order_jobs import (
+    enqueue_order_placement,
+    enqueue_order_cancellation,
+    get_idempotency_key,
+    get_idempotent_order_job,
+)
+from mishipay.pagination import ProductCursorPagination
+from mishipay.cart import (
+    add_to_cart,
+    apply_cart_changes,
+    get_cart,
+)
+from mishipay.catalog import (
+    fill_catalog_in_background,
+    get_product_page,
 )
-from mishipay.serializers import CartItemSerializer
 from mishipay.forms import (
     SignupForm,
     LoginForm
 )
+from mishipay.instrumentation import metrics
+from mishipay.shopify_client import (
+    SHOPIFY_UNAVAILABLE_MSG,
+    is_shopify_available,
+)
 
-from mishipay.shopify_utils import (
-    create_order,
-    cancel_order as cancel_shopify_order,
-    get_products,
-    get_orders,
-    filter_relevant_product_information,
-    filter_relavant_order_information,
-    filter_out_of_stock_products,
+from mishipay.shopify_utils import save_orders
+from mishipay.shopify_async import (
+    get_orders_async,
+    run_sync,
+)
+from mishipay.webhooks import (
+    WEBHOOK_TOPICS,
+    get_payload_key,
+    get_webhook_id,
+    is_valid_webhook,
+    store_webhook_event,
 )
 
 
+def get_positive_int(value, default=None):
+    """
+        Parse a query param as a positive integer. Returns default
+        if it is missing or invalid.
+    """
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
 class SignUp(View):
     """
         Signup View. Renders a template with form to create user for 'GET'
@@ -137,54 +204,92 @@ class Login(View):
 
 class ProductListing(LoginRequiredMixin, View):
     """
-        Renders a Product Listing page. Products are fetched from a
-        shopify store using APIs
+        Renders a page of the Product Listing. Products are served from the
+        local Product table, which is loaded from the shopify store by the
+        sync_shopify command, or in the background while it is empty.
+        Pages are selected using the 'after' or 'before' cursor and the
+        'limit' query params.
+        While Shopify is unavailable, the page is marked as possibly out
+        of date.
     """
     template_name = 'product_listing.html'
 
     def get(self, request, *args, **kwargs):
-        products, err_msg = get_products()
-        if err_msg:
-            context = {
-                'err_msg': err_msg,
-                'products': [],
-                'cart_products_ids': []
-            }
-            return render(request, self.template_name, context)
+        if not Product.objects.exists():
+            # The catalog is loaded by the sync_shopify command. Until
+            # it is, an empty listing is served while it is loaded in the
+            # background.
+            fill_catalog_in_background()
+
+        limit = min(
+            get_positive_int(request.GET.get('limit'), settings.PRODUCT_LISTING_PAGE_SIZE),
+            settings.PRODUCT_LISTING_MAX_PAGE_SIZE
+        )
+        products, previous_cursor, next_cursor = get_product_page(
+            after=get_positive_int(request.GET.get('after')),
+            before=get_positive_int(request.GET.get('before')),
+            limit=limit
+        )
 
         context = {
-            'products': filter_out_of_stock_products(
-                filter_relevant_product_information(
-                    products
-                )
-            ),
+            'products': products,
+            'limit': limit,
+            'previous_cursor': previous_cursor,
+            'next_cursor': next_cursor,
+            'shopify_unavailable': not is_shopify_available(),
             # 'cart_products_ids' will be used to determine
             # if an item been added to cart.
             'cart_products_ids': CartItem.objects.filter(
                 user=self.request.user,
+                product_id__in=[product.shopify_product_id for product in products],
                 quantity__gt=0
             ).values_list('product_id', flat=True)
         }
         return render(request, self.template_name, context)
 
 
+class ProductListAPI(ListAPIView):
+    """
+        Lists in stock products from the local Product table. Paginated
+        using a cursor, with page size set by the 'limit' query param.
+        Products can be ordered by price using '?ordering=price'.
+    """
+    serializer_class = ProductSerializer
+    pagination_class = ProductCursorPagination
+    permission_classes = (IsAuthenticated,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+    filter_backends = (OrderingFilter,)
+    ordering_fields = ('shopify_product_id', 'price')
+    ordering = ('shopify_product_id',)
+    queryset = Product.objects.filter(in_stock=True)
+
+
 class AddtoCartAPI(CreateAPIView):
     """
         Adds an item to cart. Shopify Product IDs and respective quantities
-        are stored as CartItem objects against each user.
+        are stored as CartItem objects against each user. Adding an item
+        that is already in cart increments its quantity.
     """
-    serializer_class = CartItemSerializer
+    serializer_class = AddToCartSerializer
     permission_classes = (IsAuthenticated,)
     authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
 
-    def get_queryset(self):
-        user = self.request.user
-        return CartItem.objects.filter(user=user)
-
     def create(self, request, *args, **kwargs):
-        user = self.request.user
-        request.data['user'] = user.id
-        return super(AddtoCartAPI, self).create(request, *args, **kwargs)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cart_item, err_msg = add_to_cart(
+            request.user,
+            serializer.validated_data['product_id'],
+            serializer.validated_data['quantity']
+        )
+        if err_msg:
+            return Response({'err_msg': err_msg}, status=status.HTTP_400_BAD_REQUEST)
+        cart_item_id, quantity = cart_item
+        return Response({
+            'id': cart_item_id,
+            'product_id': serializer.validated_data['product_id'],
+            'quantity': quantity,
+        }, status=status.HTTP_201_CREATED)
 
 
 class UpdateDestroyCartItemAPI(DestroyAPIView, UpdateAPIView):
@@ -206,12 +311,62 @@ class UpdateDestroyCartItemAPI(DestroyAPIView, UpdateAPIView):
         return CartItem.objects.filter(user=user)
 
 
+class CartAPI(APIView):
+    """
+        Applies a batch of changes to the current user's cart in one
+        transaction and returns the updated cart.
+
+        Request:
+            {
+                "upserts": [{"product_id": 1, "quantity": 2}],
+                "deletes": [3]
+            }
+        Response:
+            {
+                "cart_items": [{
+                    "id": .., "product_id": 1, "product_title": .., "price": .., "quantity": 2, "amount": ..,
+                    "price_changed": false, "current_price": .., "out_of_stock": false, "inventory_quantity": ..
+                }],
+                "cart_total": ..,
+                "err_msg": ""
+            }
+    """
+    permission_classes = (IsAuthenticated,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get(self, request, *args, **kwargs):
+        return self.get_cart_response(request.user)
+
+    def post(self, request, *args, **kwargs):
+        serializer = CartChangesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        err_msg = apply_cart_changes(
+            request.user,
+            serializer.validated_data['upserts'],
+            serializer.validated_data['deletes']
+        )
+        if err_msg:
+            return Response({'err_msg': err_msg}, status=status.HTTP_400_BAD_REQUEST)
+        return self.get_cart_response(request.user)
+
+    def get_cart_response(self, user):
+        cart_items, cart_total, err_msg = get_cart(user)
+        return Response({
+            'cart_items': cart_items,
+            'cart_total': cart_total,
+            'err_msg': err_msg,
+        })
+
+
 class Cart(LoginRequiredMixin, TemplateView):
     """
         Displays information about the products that the current user
-        has added to cart. Items in cart are stored as CartItem objects.
-        Products are fetched from Shopify store using Shopify APIs and
-        product ids stored in CartItem objects.
+        has added to cart. Items in cart are stored as CartItem objects,
+        along with a snapshot of the product taken when it was added, so
+        Shopify is not called. Items whose price or stock has changed
+        since are flagged. Quantities are changed in place through CartAPI.
+        While Shopify is unavailable, the page is marked as possibly out
+        of date.
     """
     template_name = 'cart.html'
 
@@ -224,89 +379,59 @@ class Cart(LoginRequiredMixin, TemplateView):
         if 'err_msg' in self.request.GET:
             context['err_msg'] = self.request.GET['err_msg']
 
-        cart_product_id_quantities = CartItem.objects.filter(
-            user=user
-        ).values('product_id', 'id', 'quantity')
-
-        cart_product_id_quantity_map = {}
-        cart_product_ids = []
-        for cart_product_id_quantity in cart_product_id_quantities:
-            cart_product_ids.append(cart_product_id_quantity['product_id'])
-            cart_product_id_quantity_map[cart_product_id_quantity['product_id']] = {
-                'id': cart_product_id_quantity['id'],
-                'quantity': cart_product_id_quantity['quantity']
-            }
-
-        # Try to retrieve products from shopify only if there are any
-        # products in cart
-        if cart_product_ids:
-            cart_shopify_products, err_msg = get_products(
-                ids=cart_product_ids
-            )
-            if err_msg:
-                context['err_msg'] = err_msg
-                cart_shopify_products = []
-        else:
-            cart_shopify_products = []
-
-        cart_items = []
-        cart_total = 0
-        for product in cart_shopify_products:
-            # Internal database cart item id
-            cart_item_id = cart_product_id_quantity_map[product['id']]['id']
-            product_quantity = cart_product_id_quantity_map[product['id']]['quantity']
-            product_price = product['variants'][0]['price']
-            cart_item = {
-                'id': cart_item_id,
-                'product_id': product['id'],
-                'product_title': product['title'],
-                'price': float(product_price),
-                'quantity': product_quantity
-            }
-            cart_items.append(cart_item)
-            cart_total = cart_total + product_quantity * float(product_price)
+        cart_items, cart_total, err_msg = get_cart(user)
+        if err_msg:
+            context['err_msg'] = err_msg
 
         context['cart_items'] = cart_items
         context['cart_total'] = cart_total
+        context['shopify_unavailable'] = not is_shopify_available()
+        # Sent with Place Order, so that a double submit places one order.
+        context['idempotency_key'] = uuid.uuid4().hex
         return context
 
 
 @login_required()
 def place_order(request):
     """
-        Place an order on the Shopify store for all the items in the Cart
-        (all CartItem objects) and update the Shopify store inventory.
+        Queue an order on the Shopify store for all the items in the Cart
+        (all CartItem objects). The order is placed and the Shopify store
+        inventory updated by the process_order_jobs worker, while the user
+        is shown the status of the order.
+        Repeated requests, Eg: a double submit or a retry by a proxy, are
+        shown the order queued by the first one. They are matched by the
+        idempotency key sent by the Cart page (idempotency_key parameter or
+        Idempotency-Key header), or else by the contents of the cart.
+        While Shopify is unavailable, the user is sent back to the Cart
+        page at once with a message to try again later.
     """
     user = request.user
 
-    cart_items = CartItem.objects.filter(user=user)
-    cart_product_id_quantities = cart_items.values('product_id', 'id', 'quantity')
-
-    cart_product_id_quantity_map = {}
-    cart_product_ids = []
-    for cart_product_id_quantity in cart_product_id_quantities:
-        cart_product_ids.append(cart_product_id_quantity['product_id'])
-        cart_product_id_quantity_map[cart_product_id_quantity['product_id']] = {
-            'id': cart_product_id_quantity['id'],
-            'quantity': cart_product_id_quantity['quantity']
-        }
-
-    if cart_product_ids:
-        cart_shopify_products, err_msg = get_products(
-            ids=cart_product_ids
-        )
-        if err_msg:
-            return HttpResponseRedirect('{}?err_msg={}'.format(reverse('cart'), urllib.parse.quote(err_msg)))
+    client_idempotency_key = (
+        request.GET.get('idempotency_key') or request.META.get('HTTP_IDEMPOTENCY_KEY')
+    )
+    if client_idempotency_key:
+        idempotency_key = get_idempotency_key(client_key=client_idempotency_key)
+        # The cart is emptied once the order is placed, so a retry is
+        # matched before the cart is read.
+        job = get_idempotent_order_job(user, idempotency_key)
+        if job is not None:
+            return HttpResponseRedirect(reverse('order_job', kwargs={'pk': job.id}))
+    else:
+        idempotency_key = None
 
-        for product in cart_shopify_products:
-            product['quantity'] = cart_product_id_quantity_map[product['id']]['quantity']
+    if not is_shopify_available():
+        return HttpResponseRedirect('{}?err_msg={}'.format(
+            reverse('cart'), urllib.parse.quote(SHOPIFY_UNAVAILABLE_MSG)
+        ))
 
-        order, err_msg = create_order(user, cart_shopify_products)
-        if err_msg:
-            return HttpResponseRedirect('{}?err_msg={}'.format(reverse('cart'), urllib.parse.quote(err_msg)))
+    cart_product_id_quantity_map = dict(
+        CartItem.objects.filter(user=user).values_list('product_id', 'quantity')
+    )
 
-        cart_items.delete()
-        return render(request, 'order_success.html', {'order': order, 'order_status': 'placed'})
+    if cart_product_id_quantity_map:
+        job = enqueue_order_placement(user, cart_product_id_quantity_map, idempotency_key)
+        return HttpResponseRedirect(reverse('order_job', kwargs={'pk': job.id}))
     else:
         return HttpResponseRedirect(reverse('product_listing'))
 
@@ -314,11 +439,18 @@ def place_order(request):
 @login_required()
 def cancel_order(request, shopify_order_id):
     """
-        Cancels the order with the given order id
-        and updates the store inventory using Shopify APIs.
+        Queue the cancellation of the order with the given order id. The
+        order is cancelled and the store inventory updated by the
+        process_order_jobs worker, while the user is shown the status of
+        the cancellation.
     """
     user = request.user
 
+    if not is_shopify_available():
+        return HttpResponseRedirect('{}?err_msg={}'.format(
+            reverse('my_orders'), urllib.parse.quote(SHOPIFY_UNAVAILABLE_MSG)
+        ))
+
     # Verify that order belongs to current user.
     try:
         Order.objects.get(user=user, shopify_order_id=shopify_order_id)
@@ -326,17 +458,65 @@ def cancel_order(request, shopify_order_id):
         err_msg = 'Order #{} does not exist'.format(shopify_order_id)
         return HttpResponseRedirect('{}?err_msg={}'.format(reverse('my_orders'), urllib.parse.quote(err_msg)))
 
-    order, err_msg = cancel_shopify_order(shopify_order_id)
-    if err_msg:
-        return HttpResponseRedirect('{}?err_msg={}'.format(reverse('my_orders'), urllib.parse.quote(err_msg)))
-    else:
-        return render(request, 'order_success.html', {'order': order, 'order_status': 'cancelled'})
+    job = enqueue_order_cancellation(user, shopify_order_id)
+    return HttpResponseRedirect(reverse('order_job', kwargs={'pk': job.id}))
+
+
+class OrderJobView(LoginRequiredMixin, View):
+    """
+        Shows the outcome of a queued order placement or cancellation. While
+        the job is being processed, the page polls OrderJobStatusAPI and
+        reloads once it is done. On failure, the user is sent back to the
+        Cart or My Orders page with the error message.
+    """
+    template_name = 'order_success.html'
+
+    def get(self, request, pk, *args, **kwargs):
+        try:
+            job = OrderJob.objects.get(id=pk, user=request.user)
+        except OrderJob.DoesNotExist:
+            return HttpResponseRedirect(reverse('my_orders'))
+
+        if job.status == ORDER_JOB_STATUS_FAILED:
+            redirect_url = reverse('cart') if job.order_type == ORDER_TYPE_PLACED else reverse('my_orders')
+            return HttpResponseRedirect('{}?err_msg={}'.format(redirect_url, urllib.parse.quote(job.err_msg)))
+
+        context = {
+            'job': job,
+            'order_status': job.order_type,
+        }
+        if job.status == ORDER_JOB_STATUS_SUCCEEDED:
+            context['order'] = json.loads(job.result)
+        return render(request, self.template_name, context)
+
+
+class OrderJobStatusAPI(RetrieveAPIView):
+    """
+        Returns the status of a queued order placement or cancellation.
+    """
+    serializer_class = OrderJobSerializer
+    permission_classes = (IsAuthenticated,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get_queryset(self):
+        user = self.request.user
+        return OrderJob.objects.filter(user=user)
+
+
+# My Orders cursors count microseconds from this time.
+CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=utc)
 
 
 class MyOrders(LoginRequiredMixin, TemplateView):
     """
-        Renders an Order Listing page. Order information and also constituent product
-        information for each order is fetched from the shopify store using APIs.
+        Renders a page of the Order Listing, newest first. Orders and their
+        line items are served from the local copy kept in Order and
+        OrderLineItem objects. Orders that have not been copied yet are
+        fetched from the shopify store using APIs once. While Shopify is
+        unavailable or the fetch fails they are still listed, marked as
+        pending sync, and the page is marked as possibly out of date.
+        Pages are selected using the 'after' cursor, which points to the
+        last order of the previous page, and the 'limit' query params.
     """
     template_name = 'my_orders.html'
 
@@ -346,20 +526,65 @@ class MyOrders(LoginRequiredMixin, TemplateView):
             context['err_msg'] = self.request.GET['err_msg']
 
         user = self.request.user
-        orders = Order.objects.filter(user=user)
-        if not orders:
-            context['orders'] = []
-            return context
+        context['shopify_unavailable'] = not is_shopify_available()
+
+        unsynced_shopify_order_ids = list(Order.objects.filter(
+            user=user,
+            synced_at__isnull=True
+        ).values_list('shopify_order_id', flat=True))
+        if unsynced_shopify_order_ids and not context['shopify_unavailable']:
+            # Orders have already been filtered by user. More orders than
+            # fit in a page are retrieved in concurrent batches.
+            shopify_orders, err_msg = run_sync(get_orders_async(shopify_order_ids=unsynced_shopify_order_ids))
+            if err_msg:
+                context['err_msg'] = err_msg
+            else:
+                save_orders(shopify_orders)
 
-        shopify_order_ids = orders.values_list('shopify_order_id', flat=True)
-        shopify_orders, err_msg = get_orders(shopify_order_ids=shopify_order_ids, user=user)
-        if err_msg:
-            context['orders'] = []
-            context['err_msg'] = err_msg
-        else:
-            context['orders'] = filter_relavant_order_information(shopify_orders)
+        limit = min(
+            get_positive_int(self.request.GET.get('limit'), settings.MY_ORDERS_PAGE_SIZE),
+            settings.MY_ORDERS_MAX_PAGE_SIZE
+        )
+        orders = Order.objects.filter(user=user).order_by('-created_at', '-id')
+
+        cursor = self.decode_cursor(self.request.GET.get('after'))
+        if cursor:
+            created_at, order_id = cursor
+            orders = orders.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=order_id)
+            )
+
+        orders = list(orders.prefetch_related('line_items')[:limit + 1])
+
+        context['orders'] = orders[:limit]
+        context['limit'] = limit
+        context['is_first_page'] = cursor is None
+        context['next_cursor'] = self.encode_cursor(orders[limit - 1]) if len(orders) > limit else None
         return context
 
+    @staticmethod
+    def encode_cursor(order):
+        """
+            Returns a cursor of the created_at, in whole microseconds since
+            the epoch, and the id of the order.
+        """
+        created_at = order.created_at - CURSOR_EPOCH
+        timestamp = (created_at.days * 24 * 60 * 60 + created_at.seconds) * 1000000 + created_at.microseconds
+        return '{}_{}'.format(timestamp, order.id)
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+            Returns a tuple of (created_at, id) of the order the
+            cursor points to, or None if the cursor is invalid.
+        """
+        try:
+            timestamp, order_id = [int(value) for value in cursor.split('_')]
+            return CURSOR_EPOCH + timedelta(microseconds=timestamp), order_id
+        except (AttributeError, ValueError, OverflowError):
+            # Eg: a timestamp out of the range of dates.
+            return None
+
 
 def get_access_token(request):
 
@@ -406,3 +631,66 @@ def access_token(request):
         return HttpResponse("Access Token: {}".format(json.loads(access_token_api_response.text)['access_token']))
     else:
         return HttpResponse("Failed to get Access Token: {}".format(access_token_api_response.text))
+
+
+@csrf_exempt
+@require_POST
+def webhook(request, topic=None):
+    """
+        Receives Shopify webhooks of the topics in WEBHOOK_TOPICS, taken
+        from the URL or else from the X-Shopify-Topic header. Verified
+        webhooks are stored as received and applied to the local tables by
+        the process_webhooks worker, so Shopify gets its response at once.
+        Webhooks of other topics are acknowledged and ignored.
+    """
+
+    if not is_valid_webhook(request):
+        return HttpResponseForbidden("Invalid HMAC")
+
+    topic = topic or request.META.get('HTTP_X_SHOPIFY_TOPIC', '')
+    if topic not in WEBHOOK_TOPICS:
+        return HttpResponse(status=200)
+
+    payload = request.body.decode('utf-8')
+    try:
+        get_payload_key(topic, json.loads(payload))
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest("Invalid payload")
+
+    store_webhook_event(get_webhook_id(request, topic), topic, payload)
+    return HttpResponse(status=200)
+
+
+# Headers added by reverse proxies. Behind a proxy on the same host, every
+# client has the proxy's address, Eg: 127.0.0.1.
+PROXY_HEADERS = ('HTTP_X_FORWARDED_FOR', 'HTTP_X_REAL_IP', 'HTTP_FORWARDED')
+
+
+def is_metrics_request_allowed(request):
+    """
+        Scrapes must come from an address in METRICS_ALLOWED_IPS. If
+        METRICS_TOKEN is set, they must also send it in an
+        'Authorization: Bearer <token>' header, which is required behind a
+        reverse proxy. Without a token, requests forwarded by a proxy are
+        refused, as their REMOTE_ADDR is the proxy's.
+    """
+
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return False
+    if not settings.METRICS_TOKEN:
+        return not any(request.META.get(header) for header in PROXY_HEADERS)
+    return hmac.compare_digest(
+        request.META.get('HTTP_AUTHORIZATION', ''),
+        'Bearer {}'.format(settings.METRICS_TOKEN)
+    )
+
+
+def metrics_view(request):
+    """
+        Serves the metrics of this process in the Prometheus text format.
+        See is_metrics_request_allowed
+    """
+
+    if not is_metrics_request_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
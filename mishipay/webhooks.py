@@ -0,0 +1,401 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import (
+    IntegrityError,
+    transaction,
+)
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from mishipay.cache_utils import (
+    cache_products,
+    invalidate_products,
+)
+from mishipay.constants import (
+    WEBHOOK_TOPIC_PRODUCTS_CREATE,
+    WEBHOOK_TOPIC_PRODUCTS_UPDATE,
+    WEBHOOK_TOPIC_PRODUCTS_DELETE,
+    WEBHOOK_TOPIC_INVENTORY_LEVELS_UPDATE,
+    WEBHOOK_TOPIC_ORDERS_UPDATED,
+    WEBHOOK_TOPIC_ORDERS_CANCELLED,
+)
+from mishipay.models import (
+    Product,
+    WebhookEvent
+)
+from mishipay.shopify_utils import (
+    filter_relevant_product_information,
+    save_inventory_levels,
+    save_orders,
+)
+from mishipay.catalog import (
+    save_products,
+    delete_products,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+PRODUCT_TOPICS = (
+    WEBHOOK_TOPIC_PRODUCTS_CREATE,
+    WEBHOOK_TOPIC_PRODUCTS_UPDATE,
+    WEBHOOK_TOPIC_PRODUCTS_DELETE,
+)
+INVENTORY_LEVEL_TOPICS = (
+    WEBHOOK_TOPIC_INVENTORY_LEVELS_UPDATE,
+)
+ORDER_TOPICS = (
+    WEBHOOK_TOPIC_ORDERS_UPDATED,
+    WEBHOOK_TOPIC_ORDERS_CANCELLED,
+)
+WEBHOOK_TOPICS = PRODUCT_TOPICS + INVENTORY_LEVEL_TOPICS + ORDER_TOPICS
+# Topics whose events are applied together.
+WEBHOOK_TOPIC_KINDS = (PRODUCT_TOPICS, INVENTORY_LEVEL_TOPICS, ORDER_TOPICS)
+
+
+def is_valid_webhook(request):
+    """
+        Verify that a webhook was sent by Shopify. Shopify signs the raw
+        request body with the app's shared secret and sends the base64
+        encoded HMAC-SHA256 digest in the X-Shopify-Hmac-Sha256 header.
+    """
+
+    received_hmac = request.META.get('HTTP_X_SHOPIFY_HMAC_SHA256', '')
+    digest = hmac.new(
+        settings.SHOPIFY_WEBHOOK_SECRET.encode('utf-8'),
+        request.body,
+        hashlib.sha256
+    ).digest()
+    calculated_hmac = base64.b64encode(digest).decode('utf-8')
+    return hmac.compare_digest(calculated_hmac, received_hmac)
+
+
+def get_webhook_id(request, topic):
+    """
+        Returns the id Shopify sends in the X-Shopify-Webhook-Id header,
+        which is the same for every delivery of a webhook. Webhooks sent
+        without one are identified by their topic and body.
+    """
+
+    webhook_id = request.META.get('HTTP_X_SHOPIFY_WEBHOOK_ID', '')
+    if webhook_id:
+        return webhook_id[:64]
+    return hashlib.sha256(topic.encode('utf-8') + b':' + request.body).hexdigest()
+
+
+def store_webhook_event(webhook_id, topic, payload):
+    """
+        Store a webhook to be applied by the process_webhooks worker.
+        A webhook that has already been stored, Eg: one that Shopify
+        delivered again as it did not see our response in time, is
+        ignored. Returns True if the webhook was stored.
+    """
+
+    try:
+        with transaction.atomic():
+            WebhookEvent.objects.create(
+                webhook_id=webhook_id,
+                topic=topic,
+                payload=payload
+            )
+    except IntegrityError:
+        return False
+
+    if settings.WEBHOOKS_ALWAYS_EAGER:
+        process_webhook_events()
+    return True
+
+
+def get_payload_key(topic, payload):
+    """
+        Returns the id of the product, inventory item or order a webhook
+        payload is about. Raises KeyError or TypeError for an invalid
+        payload.
+    """
+
+    if topic in INVENTORY_LEVEL_TOPICS:
+        return payload['inventory_item_id']
+    return payload['id']
+
+
+def get_event_key(event):
+    """
+        Returns a tuple of the kind of a webhook event, as an index in
+        WEBHOOK_TOPIC_KINDS, and the id of the product, inventory item or
+        order it is about. Returns None if its payload is invalid.
+    """
+
+    try:
+        payload_key = get_payload_key(event.topic, json.loads(event.payload))
+    except (KeyError, TypeError, ValueError):
+        return None
+    for kind, topics in enumerate(WEBHOOK_TOPIC_KINDS):
+        if event.topic in topics:
+            return kind, payload_key
+    return None
+
+
+def is_older(payload, current_payload):
+    """
+        True if both payloads have an updated_at and payload was updated
+        before current_payload. Shopify does not guarantee that webhooks
+        are delivered in order.
+    """
+
+    updated_at = parse_datetime(payload.get('updated_at') or '')
+    current_updated_at = parse_datetime(current_payload.get('updated_at') or '')
+    return bool(updated_at and current_updated_at and updated_at < current_updated_at)
+
+
+def coalesce_webhook_events(events):
+    """
+        Returns a tuple of dicts of the latest payload of every product,
+        inventory item and order in the given events, so that a product
+        updated several times within a batch is saved once. The product
+        dict maps product id to (topic, payload).
+    """
+
+    products = {}
+    inventory_levels = {}
+    orders = {}
+    for event in events:
+        payload = json.loads(event.payload)
+        key = get_payload_key(event.topic, payload)
+        if event.topic in PRODUCT_TOPICS:
+            current = products.get(key)
+            if current is None or not is_older(payload, current[1]):
+                products[key] = (event.topic, payload)
+        elif event.topic in INVENTORY_LEVEL_TOPICS:
+            current = inventory_levels.get(key)
+            if current is None or not is_older(payload, current):
+                inventory_levels[key] = payload
+        elif event.topic in ORDER_TOPICS:
+            current = orders.get(key)
+            if current is None or not is_older(payload, current):
+                orders[key] = payload
+    return products, inventory_levels, orders
+
+
+def apply_product_updates(products):
+    """
+        products/create and products/update webhooks. The payload is the
+        complete product, so the cached copies and the local Products are
+        replaced rather than waiting for them to expire.
+    """
+
+    invalidate_products([product['id'] for product in products])
+    products = list(filter_relevant_product_information(products))
+    cache_products(products)
+    save_products(products)
+
+
+def apply_product_deletes(product_ids):
+    """
+        products/delete webhooks. The payload only has the product id.
+    """
+
+    invalidate_products(product_ids)
+    delete_products(product_ids)
+
+
+def apply_inventory_level_updates(inventory_levels):
+    """
+        inventory_levels/update webhooks. Keeps the location and available
+        quantity of the inventory items, and the stock of their products,
+        up to date.
+    """
+
+    save_inventory_levels(inventory_levels)
+    invalidate_products(list(Product.objects.filter(
+        inventory_item_id__in=[inventory_level['inventory_item_id'] for inventory_level in inventory_levels]
+    ).values_list('shopify_product_id', flat=True)))
+
+
+def apply_order_updates(orders):
+    """
+        orders/updated and orders/cancelled webhooks. The payload is the
+        complete order. Only orders placed through this application are
+        kept locally.
+    """
+
+    save_orders(orders)
+
+
+def apply_webhook_event(topic, payload):
+    """
+        Apply a single webhook, Eg: when its batch could not be applied.
+    """
+
+    if topic == WEBHOOK_TOPIC_PRODUCTS_DELETE:
+        apply_product_deletes([payload['id']])
+    elif topic in PRODUCT_TOPICS:
+        apply_product_updates([payload])
+    elif topic in INVENTORY_LEVEL_TOPICS:
+        apply_inventory_level_updates([payload])
+    elif topic in ORDER_TOPICS:
+        apply_order_updates([payload])
+
+
+def apply_webhook_events_one_by_one(events):
+    """
+        Apply the given events one at a time, in the order they were
+        received, so that an event that can not be applied, Eg: as its
+        payload is malformed, does not fail the others. An event older
+        than one already applied for the same item is skipped, and a
+        failed event is superseded by a newer one that is applied.
+        Returns a dict of the id of every event that failed to its error
+        message.
+    """
+
+    events_by_key = {}
+    for event in events:
+        events_by_key.setdefault(get_event_key(event), []).append(event)
+
+    err_msgs = {}
+    for key, key_events in events_by_key.items():
+        applied_payload = None
+        failed_payloads = {}
+        for event in key_events:
+            payload = json.loads(event.payload)
+            if applied_payload is not None and is_older(payload, applied_payload):
+                continue
+            try:
+                apply_webhook_event(event.topic, payload)
+            except Exception as e:
+                logger.exception('Could not apply webhook %s', event.webhook_id)
+                err_msgs[event.id] = '{}: {!r}'.format(event.topic, e)[:1024]
+                failed_payloads[event.id] = payload
+                continue
+            applied_payload = payload
+            for event_id, failed_payload in list(failed_payloads.items()):
+                if not is_older(payload, failed_payload):
+                    del err_msgs[event_id]
+                    del failed_payloads[event_id]
+    return err_msgs
+
+
+def get_pending_webhook_events(limit):
+    """
+        Returns up to limit of the oldest unprocessed webhook events that
+        are due. Events that failed are retried from their next_attempt_at.
+        Until then, later events of the same product, inventory item or
+        order wait for them as well, so that an older update is never
+        applied after a newer one. Events of other items are not held up.
+    """
+
+    now = timezone.now()
+    waiting_event_ids = {}
+    for event in WebhookEvent.objects.filter(processed_at__isnull=True, next_attempt_at__gt=now):
+        key = get_event_key(event)
+        if key is not None:
+            waiting_event_ids[key] = min(event.id, waiting_event_ids.get(key, event.id))
+
+    events = []
+    for event in WebhookEvent.objects.filter(
+        processed_at__isnull=True
+    ).exclude(
+        next_attempt_at__gt=now
+    ).order_by('id').iterator():
+        waiting_event_id = waiting_event_ids.get(get_event_key(event))
+        if waiting_event_id is not None and waiting_event_id < event.id:
+            continue
+        events.append(event)
+        if len(events) >= limit:
+            break
+    return events
+
+
+def fail_webhook_events(events, err_msg, retry=True):
+    """
+        Record a failed attempt to apply the given events. They are retried
+        after WEBHOOK_RETRY_BACKOFF seconds, doubled for every earlier
+        attempt, until they have failed WEBHOOK_MAX_ATTEMPTS times, after
+        which they are marked as processed with the error. Events that can
+        never be applied, Eg: with a payload that is not valid JSON, are
+        given up on at once by passing retry=False.
+    """
+
+    now = timezone.now()
+    for event in events:
+        event.attempts = event.attempts + 1
+        event.err_msg = err_msg
+        if not retry or event.attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+            logger.error('Giving up on webhook %s after %s attempts: %s', event.webhook_id, event.attempts, err_msg)
+            event.processed_at = now
+        else:
+            event.next_attempt_at = now + timedelta(
+                seconds=settings.WEBHOOK_RETRY_BACKOFF * (2 ** (event.attempts - 1))
+            )
+        event.save(update_fields=['attempts', 'err_msg', 'processed_at', 'next_attempt_at'])
+
+
+def process_webhook_events(limit=None):
+    """
+        Apply up to limit (default WEBHOOK_BATCH_SIZE) of the oldest
+        unprocessed webhook events to the local tables and mark them as
+        processed. Events are coalesced, so that every product, inventory
+        item and order is saved once, and each kind is applied in bulk.
+        If applying a kind fails, its events are applied one by one, and
+        only those that fail again, Eg: as the database is locked or their
+        payload is malformed, are left unprocessed and retried later. See
+        fail_webhook_events
+        Returns the number of events processed or failed.
+    """
+
+    events = get_pending_webhook_events(limit or settings.WEBHOOK_BATCH_SIZE)
+    if not events:
+        return 0
+
+    invalid_events = [event for event in events if get_event_key(event) is None]
+    events = [event for event in events if get_event_key(event) is not None]
+    fail_webhook_events(invalid_events, 'Invalid payload', retry=False)
+
+    products, inventory_levels, orders = coalesce_webhook_events(events)
+    updated_products = [payload for topic, payload in products.values() if topic != WEBHOOK_TOPIC_PRODUCTS_DELETE]
+    deleted_product_ids = [
+        product_id for product_id, (topic, payload) in products.items() if topic == WEBHOOK_TOPIC_PRODUCTS_DELETE
+    ]
+
+    failed_kinds = []
+    for topics, apply, items in (
+        (PRODUCT_TOPICS, apply_product_updates, updated_products),
+        (PRODUCT_TOPICS, apply_product_deletes, deleted_product_ids),
+        (INVENTORY_LEVEL_TOPICS, apply_inventory_level_updates, list(inventory_levels.values())),
+        (ORDER_TOPICS, apply_order_updates, list(orders.values())),
+    ):
+        if not items or topics in failed_kinds:
+            continue
+        try:
+            apply(items)
+        except Exception as e:
+            logger.warning('Could not apply %s webhooks, applying them one by one: %r', apply.__name__, e)
+            failed_kinds.append(topics)
+
+    err_msgs = {}
+    for topics in failed_kinds:
+        err_msgs.update(apply_webhook_events_one_by_one([event for event in events if event.topic in topics]))
+
+    WebhookEvent.objects.filter(
+        id__in=[event.id for event in events if event.id not in err_msgs]
+    ).update(processed_at=timezone.now(), err_msg='', next_attempt_at=None)
+    for event in events:
+        if event.id in err_msgs:
+            fail_webhook_events([event], err_msgs[event.id])
+    return len(events) + len(invalid_events)
+
+
+def delete_processed_webhook_events():
+    """
+        Delete events processed more than WEBHOOK_EVENT_RETENTION seconds
+        ago. Until then, a repeated delivery of a webhook is recognised by
+        its id and ignored.
+    """
+
+    return WebhookEvent.objects.filter(
+        processed_at__lt=timezone.now() - timedelta(seconds=settings.WEBHOOK_EVENT_RETENTION)
+    ).delete()[0]